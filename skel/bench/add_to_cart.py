@@ -0,0 +1,51 @@
+"""
+This module measures the add_to_cart latency while the number of producers grows.
+
+Run it from the skel folder with: python3 -m bench.add_to_cart
+"""
+import logging
+import time
+
+from tema.marketplace import Marketplace
+
+PRODUCER_COUNTS = [10, 100, 1000, 10000]
+ADDS = 2000
+
+
+def measure(num_producers):
+    """
+    Registers num_producers producers, gives stock only to the last one
+    and returns the mean add_to_cart latency in microseconds.
+
+    :type num_producers: Int
+    :param num_producers: the number of registered producers
+    """
+    marketplace = Marketplace(ADDS)
+    for producer_id in range(num_producers):
+        marketplace.register_producer()
+        # every producer holds something, but only the last one holds "wanted"
+        marketplace.publish(producer_id, "filler")
+    for _ in range(ADDS):
+        marketplace.publish(num_producers - 1, "wanted")
+
+    cart_id = marketplace.new_cart()
+    start = time.perf_counter()
+    for _ in range(ADDS):
+        marketplace.add_to_cart(cart_id, "wanted")
+    elapsed = time.perf_counter() - start
+    return elapsed / ADDS * 1e6
+
+
+def main():
+    """
+    Prints the mean add_to_cart latency for every producer count
+    """
+    # we measure the data structures, not the log file
+    logging.disable(logging.INFO)
+    print(f"{'producers':>10} {'add_to_cart (us)':>18}")
+    for num_producers in PRODUCER_COUNTS:
+        print(f"{num_producers:>10} {measure(num_producers):>18.2f}")
+
+
+if __name__ == '__main__':
+    main()
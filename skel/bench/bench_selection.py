@@ -0,0 +1,67 @@
+"""
+This module compares the selection strategies of the Marketplace on the tests/*.in
+scenarios: for every strategy it reports how many products the producers manage to
+publish per second and how long the consumers wait for a product.
+
+Every run gets its own process, the producers never stop on their own.
+
+Run it from the skel folder with: python3 -m bench.bench_selection [tests/01.in ...]
+"""
+import argparse
+import contextlib
+import glob
+import logging
+import multiprocessing
+import os
+
+from tema.config import load_config
+from tema.selection import STRATEGIES
+from bench.harness import MeasuredMarketplace, play
+
+
+def measure(run):
+    """
+    Runs a scenario with a selection strategy, like test.py does.
+
+    :type run: Tuple
+    :param run: (the scenario file, the name of the strategy)
+
+    :returns a tuple (scenario, strategy, elapsed seconds, publishes per second,
+    mean wait in milliseconds for a product)
+    """
+    filename, selection = run
+    # we measure the strategies, not the log file or the output
+    logging.disable(logging.INFO)
+
+    market_config = load_config(filename)
+    marketplace = MeasuredMarketplace(**market_config['marketplace'], selection=selection)
+    with open(os.devnull, "w", encoding="utf-8") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        elapsed = play(marketplace, market_config)
+    return (filename, selection, elapsed, len(marketplace.published) / elapsed,
+            1000 * sum(marketplace.add_times) / max(sum(marketplace.added), 1))
+
+
+def main():
+    """
+    Prints the results of every strategy for every scenario
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenarios", nargs="*", default=sorted(glob.glob("tests/*.in")),
+                        help="the market configurations, all of tests/*.in by default")
+    parser.add_argument("--jobs", type=int, default=len(STRATEGIES),
+                        help="how many runs at once")
+    args = parser.parse_args()
+
+    runs = [(filename, selection) for filename in args.scenarios for selection in STRATEGIES]
+    print(f"{'scenario':>14} {'strategy':>14} {'time (s)':>9} {'publish/s':>10}"
+          f" {'wait (ms)':>10}")
+    # a new process for every run, its producers are killed with it
+    with multiprocessing.Pool(args.jobs, maxtasksperchild=1) as pool:
+        for filename, selection, elapsed, throughput, wait in pool.imap(measure, runs):
+            print(f"{filename:>14} {selection:>14} {elapsed:>9.2f} {throughput:>10.1f}"
+                  f" {wait:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
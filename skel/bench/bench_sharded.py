@@ -0,0 +1,82 @@
+"""
+This module measures how the throughput of the ShardedMarketplace scales with the
+number of shards.
+
+Every client process publishes a product then adds it to its cart, with the
+products spread over all the shards. Without enough cores for the clients and the
+shards the numbers can't scale, check os.cpu_count() first.
+
+Run it from the skel folder with: python3 -m bench.bench_sharded [--clients 8]
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+
+from tema.sharded import ShardedMarketplace
+
+SHARD_COUNTS = [1, 2, 4, 8]
+OPS_PER_CLIENT = 2000
+# how many different products every client uses
+PRODUCTS_PER_CLIENT = 16
+
+
+def client(args):
+    """
+    Publishes a product then adds it to the client's cart, OPS_PER_CLIENT times.
+
+    :type args: Tuple
+    :param args: (the ShardedMarketplace, the number of the client)
+    """
+    marketplace, index = args
+    producer_id = marketplace.register_producer()
+    cart_id = marketplace.new_cart()
+    products = [index * PRODUCTS_PER_CLIENT + i for i in range(PRODUCTS_PER_CLIENT)]
+    for i in range(OPS_PER_CLIENT):
+        product = products[i % PRODUCTS_PER_CLIENT]
+        marketplace.publish(producer_id, product)
+        marketplace.add_to_cart(cart_id, product)
+    marketplace.place_order(cart_id)
+
+
+def measure(num_shards, num_clients):
+    """
+    Returns the number of publish + add_to_cart pairs per second.
+
+    :type num_shards: Int
+    :param num_shards: how many shard processes to start
+
+    :type num_clients: Int
+    :param num_clients: how many client processes run at once
+    """
+    marketplace = ShardedMarketplace(PRODUCTS_PER_CLIENT, num_shards=num_shards)
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(num_clients, initializer=logging.disable,
+                      initargs=(logging.INFO,)) as pool:
+        # start the workers before the clock
+        pool.map(abs, range(num_clients))
+        start = time.perf_counter()
+        pool.map(client, [(marketplace, i) for i in range(num_clients)])
+        elapsed = time.perf_counter() - start
+    marketplace.close()
+    return num_clients * OPS_PER_CLIENT / elapsed
+
+
+def main():
+    """
+    Prints the throughput for every number of shards
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=8, help="how many client processes")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    print(f"{os.cpu_count()} cpus, {args.clients} clients")
+    print(f"{'shards':>8} {'ops/s':>10}")
+    for num_shards in SHARD_COUNTS:
+        print(f"{num_shards:>8} {measure(num_shards, args.clients):>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,428 @@
+"""
+This module is a reproducible load generator and benchmark harness for the
+Marketplace, built on the generators from test-gen/test_generator.py.
+
+The "run" command generates a scenario for every combination of the parameters,
+with a fixed seed, and runs every scenario in its own process, like test.py does,
+with the publish cooldowns of the producers scaled by --time-scale (0 disables
+them). It writes, as JSON, the number of operations per second, the p50/p99
+latency of publish() and add_many(), the lock wait and hold times of every
+operation, from Marketplace.stats(), and the peak RSS of every run. The "compare"
+command flags the regressions between two such files.
+
+Every generated producer makes a single product, so a full queue always holds
+products someone can buy and no scenario deadlocks, whatever its size.
+
+Run it from the skel folder with:
+    python3 -m bench.harness run --producers 10 100 1000 -o new.json
+    python3 -m bench.harness compare old.json new.json [--threshold 0.1]
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import time
+
+from tema.consumer import Consumer
+from tema.producer import Producer
+from tema.marketplace import Marketplace, GLOBAL_LOCK, STRIPED_LOCKS
+from tema.config import build_config, participants
+from tema.pool import run_pool
+from tema.order_sink import open_sink
+from tema.selection import FIRST_FIT, STRATEGIES
+
+# test-gen is not a package, its modules import each other by name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "test-gen"))
+# pylint: disable=wrong-import-position,wrong-import-order
+from test_generator import generate_products, generate_marketplace, compute_expected_cart
+from test_utils import COFFEE_NAMES, TEA_NAMES_TYPES, PRODUCER_NAME_PREFIX, \
+    CONSUMER_NAME_PREFIX, ADD_TO_CART_OP, REMOVE_FROM_CART_OP
+
+# generate_products() gives every product its own name, half of them are coffees
+MAX_PRODUCTS = 2 * min(len(COFFEE_NAMES), len(TEA_NAMES_TYPES))
+QUANTITY_DISTRIBUTIONS = ["uniform", "geometric", "constant"]
+
+# the metrics compared by the "compare" command, with True if bigger is better
+METRICS = {"ops_per_sec": True, "units_per_sec": True,
+           "publish_latency_us.p50": False, "publish_latency_us.p99": False,
+           "add_latency_us.p50": False, "add_latency_us.p99": False,
+           "lock_wait_ms": False, "lock_hold_ms": False, "peak_rss_kib": False}
+
+
+def draw_quantity(distribution, max_quantity):
+    """
+    Returns a quantity between 1 and max_quantity from the given distribution.
+    """
+    if distribution == "uniform":
+        return random.randint(1, max_quantity)
+    if distribution == "geometric":
+        # 1 with probability 1/2, 2 with 1/4 and so on
+        quantity = 1
+        while quantity < max_quantity and random.random() < 0.5:
+            quantity += 1
+        return quantity
+    return max_quantity
+
+
+def generate_scenario(scenario):
+    """
+    Generates a market configuration in the format of tests/*.in.
+
+    :type scenario: Dict
+    :param scenario: the parameters of the scenario:
+    "producers", how many producers, every one of them makes a single product;
+    "consumers", how many consumers;
+    "products", how many products, at most MAX_PRODUCTS;
+    "carts", how many carts every consumer buys;
+    "ops_per_cart", how many add operations every cart has;
+    "skew", the popularity of the product of rank k is 1 / k ** skew, both for
+    the consumers and the producers, 0 makes all the products equally popular;
+    "quantity", the distribution of the quantities, from QUANTITY_DISTRIBUTIONS;
+    "max_quantity", the biggest quantity of an operation;
+    "removals", the probability that a cart has a remove operation;
+    "queue_size", the queue size of every producer;
+    "seed", the same seed generates the same scenario
+
+    :returns a tuple (the market configuration, how many units the consumers buy)
+    """
+    products = scenario["products"]
+    if not 0 < products <= MAX_PRODUCTS:
+        raise ValueError(f"between 1 and {MAX_PRODUCTS} products can be generated")
+    random.seed(scenario["seed"])
+    product_defs = generate_products(products)
+    for product in product_defs.values():
+        del product["is_produced"]
+    product_ids = list(product_defs)
+    weights = [1 / (rank + 1) ** scenario["skew"] for rank in range(products)]
+
+    # every product gets a producer first, as long as there are enough of them
+    made = product_ids[:scenario["producers"]]
+    made += random.choices(product_ids, weights, k=scenario["producers"] - len(made))
+    producer_defs = [{"name": PRODUCER_NAME_PREFIX + str(i + 1),
+                      "products": [[product_id,
+                                    draw_quantity(scenario["quantity"],
+                                                  scenario["max_quantity"]),
+                                    round(random.uniform(0.05, 0.4), 2)]],
+                      "republish_wait_time": round(random.uniform(0.05, 0.4), 2)}
+                     for i, product_id in enumerate(made)]
+
+    # the consumers only buy the products someone makes
+    sold = sorted(set(made), key=product_ids.index)
+    sold_weights = [weights[product_ids.index(product_id)] for product_id in sold]
+    consumer_defs = []
+    expected = 0
+    for i in range(scenario["consumers"]):
+        consumer = {"name": CONSUMER_NAME_PREFIX + str(i + 1),
+                    "retry_wait_time": round(random.uniform(0.05, 0.4), 2),
+                    "carts": []}
+        for _ in range(scenario["carts"]):
+            operations = generate_cart(scenario, sold, sold_weights)
+            expected += sum(compute_expected_cart(operations).values())
+            consumer["carts"].append(operations)
+        consumer_defs.append(consumer)
+
+    return ({"products": product_defs, "producers": producer_defs,
+             "consumers": consumer_defs,
+             "marketplace": generate_marketplace(scenario["queue_size"])},
+            expected)
+
+
+def generate_cart(scenario, sold, sold_weights):
+    """
+    Returns the operations of a cart, see generate_scenario() for the scenario.
+
+    :type sold: List
+    :param sold: the ids of the products someone makes
+
+    :type sold_weights: List
+    :param sold_weights: the popularity of every product in sold
+    """
+    operations = [{"type": ADD_TO_CART_OP, "product": product_id,
+                   "quantity": draw_quantity(scenario["quantity"], scenario["max_quantity"])}
+                  for product_id in random.choices(sold, sold_weights,
+                                                   k=scenario["ops_per_cart"])]
+    if random.random() < scenario["removals"]:
+        added = random.choice(operations)
+        operations.append({"type": REMOVE_FROM_CART_OP, "product": added["product"],
+                           "quantity": random.randint(1, added["quantity"])})
+    return operations
+
+
+class MeasuredMarketplace(Marketplace):
+    """
+    Marketplace that times the calls to publish(), add_many() and reserve_many(), the
+    latter from the pool engine, and counts the operations, the published products,
+    the added units and the ordered units. The locks are measured by the Marketplace
+    itself, with lock_stats.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.publish_times = []
+        self.add_times = []
+        # list.append() is atomic, so the counters are lists too
+        self.other_ops = []
+        self.published = []
+        self.added = []
+        self.ordered = []
+        Marketplace.__init__(self, *args, lock_stats=True, **kwargs)
+
+    def publish(self, producer_id, product, block=False, timeout=None):
+        start = time.perf_counter()
+        is_ok = Marketplace.publish(self, producer_id, product, block, timeout)
+        self.publish_times.append(time.perf_counter() - start)
+        if is_ok:
+            self.published.append(1)
+        return is_ok
+
+    def add_many(self, cart_id, product, quantity, block=False, timeout=None):
+        start = time.perf_counter()
+        added = Marketplace.add_many(self, cart_id, product, quantity, block, timeout)
+        self.add_times.append(time.perf_counter() - start)
+        self.added.append(added)
+        return added
+
+    def reserve_many(self, cart_id, product, quantity, block=False, timeout=None):
+        start = time.perf_counter()
+        taken = Marketplace.reserve_many(self, cart_id, product, quantity, block, timeout)
+        self.add_times.append(time.perf_counter() - start)
+        self.added.append(len(taken))
+        return taken
+
+    def remove_many(self, cart_id, product, quantity):
+        Marketplace.remove_many(self, cart_id, product, quantity)
+        self.other_ops.append(1)
+
+    def place_order(self, cart_id):
+        order = Marketplace.place_order(self, cart_id)
+        self.other_ops.append(1)
+        self.ordered.append(len(order))
+        return order
+
+
+def percentiles(durations):
+    """
+    Returns the p50 and the p99 of a list of durations, in microseconds.
+    """
+    if not durations:
+        return {"p50": None, "p99": None}
+    durations = sorted(durations)
+    return {name: round(1e6 * durations[min(len(durations) - 1, int(q * len(durations)))], 1)
+            for name, q in [("p50", 0.5), ("p99", 0.99)]}
+
+
+def run_scenario(run):
+    """
+    Generates and runs a scenario, in a process of its own: the producers never stop.
+
+    :type run: Dict
+    :param run: the "scenario" parameters for generate_scenario() and the "time_scale",
+    "locking", "selection" and "workers" of the run, no workers runs a thread per
+    producer and consumer
+
+    :returns the run with its metrics added
+    """
+    # we measure the marketplace, not the log file or the output
+    logging.disable(logging.INFO)
+
+    config, expected = generate_scenario(run["scenario"])
+    market_config = build_config(config)
+    for producer in market_config["producers"]:
+        producer["products"] = [(product, quantity, cooldown * run["time_scale"])
+                                for product, quantity, cooldown in producer["products"]]
+    marketplace = MeasuredMarketplace(**market_config["marketplace"], locking=run["locking"],
+                                      selection=run["selection"])
+    with open(os.devnull, "w", encoding="utf-8") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        elapsed = play(marketplace, market_config, run.get("workers"))
+
+    # the producers keep running, take a copy of what they changed so far
+    publish_times = list(marketplace.publish_times)
+    locks = marketplace.stats()
+    ops = len(publish_times) + len(marketplace.add_times) + len(marketplace.other_ops)
+    ordered = sum(marketplace.ordered)
+    return dict(run, ok=ordered == expected, elapsed=round(elapsed, 3), ops=ops,
+                ops_per_sec=round(ops / elapsed, 1), units_per_sec=round(ordered / elapsed, 1),
+                publish_latency_us=percentiles(publish_times),
+                add_latency_us=percentiles(marketplace.add_times),
+                lock_wait_ms=round(sum(kinds["wait"]["total_ms"] for kinds in locks.values()), 3),
+                lock_hold_ms=round(sum(kinds["hold"]["total_ms"] for kinds in locks.values()), 3),
+                locks=locks,
+                peak_rss_kib=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def play(marketplace, market_config, workers=None):
+    """
+    Runs the producers and the consumers of a market configuration until the consumers
+    are done, on a pool of workers threads or, with no workers, on a thread each. The
+    producers keep running.
+
+    :returns the elapsed seconds
+    """
+    # the orders still go through a buffered sink, like in test.py
+    sink = open_sink(os.devnull)
+    try:
+        if workers:
+            start = time.perf_counter()
+            run_pool(marketplace, participants(market_config), workers, sink)
+        else:
+            producers = [Producer(**p_market_config, marketplace=marketplace, daemon=True)
+                         for p_market_config in market_config["producers"]]
+            consumers = [Consumer(**c_market_config, marketplace=marketplace, sink=sink)
+                         for c_market_config in market_config["consumers"]]
+
+            start = time.perf_counter()
+            for thread in producers + consumers:
+                thread.start()
+            for consumer in consumers:
+                consumer.join()
+    finally:
+        sink.close()
+    return time.perf_counter() - start
+
+
+def run_all(runs, timeout):
+    """
+    Runs every scenario in a new process, one after the other so they don't slow
+    each other down, and prints a line for each of them to stderr.
+
+    :returns the list of results, a run that took more than timeout seconds only gets
+    "ok": False and "timeout": True
+    """
+    results = []
+    for run in runs:
+        with multiprocessing.Pool(1) as pool:
+            try:
+                result = pool.apply_async(run_scenario, (run,)).get(timeout)
+            except multiprocessing.TimeoutError:
+                result = dict(run, ok=False, timeout=True)
+        results.append(result)
+        print(json.dumps(result["scenario"]), "ok" if result["ok"] else "FAILED",
+              result.get("ops_per_sec", ""), file=sys.stderr)
+    return results
+
+
+def run_key(run):
+    """
+    Returns what identifies a run in two result files.
+    """
+    # the results from before the pool engine have no workers
+    return json.dumps({k: run.get(k) for k in ["scenario", "time_scale", "locking",
+                                               "selection", "workers"]},
+                      sort_keys=True)
+
+
+def metric(result, name):
+    """
+    Returns a metric from a result, like "add_latency_us.p99", or None.
+    """
+    value = result
+    for part in name.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def compare(old_results, new_results, threshold):
+    """
+    Returns the regressions of the new results, as a list of tuples
+    (run key, metric, old value, new value). A metric regresses when it gets worse
+    by more than threshold, relative to its old value.
+    """
+    old_runs = {run_key(run): run for run in old_results["runs"]}
+    regressions = []
+    for run in new_results["runs"]:
+        key = run_key(run)
+        if key not in old_runs:
+            continue
+        if old_runs[key]["ok"] and not run["ok"]:
+            regressions.append((key, "ok", True, False))
+            continue
+        for name, bigger_is_better in METRICS.items():
+            old, new = metric(old_runs[key], name), metric(run, name)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (-change if bigger_is_better else change) > threshold:
+                regressions.append((key, name, old, new))
+    return regressions
+
+
+def main():
+    """
+    Runs the "run" or the "compare" command
+    """
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="generate and run the scenarios")
+    run_parser.add_argument("--producers", type=int, nargs="+", default=[10, 100, 1000])
+    run_parser.add_argument("--consumers", type=int, nargs="+", default=[10])
+    run_parser.add_argument("--products", type=int, default=MAX_PRODUCTS,
+                            help=f"at most {MAX_PRODUCTS}")
+    run_parser.add_argument("--carts", type=int, default=5, help="carts per consumer")
+    run_parser.add_argument("--ops-per-cart", type=int, default=5)
+    run_parser.add_argument("--skew", type=float, nargs="+", default=[0.0, 1.0],
+                            help="the Zipf exponent of the product popularity")
+    run_parser.add_argument("--quantity", choices=QUANTITY_DISTRIBUTIONS, nargs="+",
+                            default=["uniform"])
+    run_parser.add_argument("--max-quantity", type=int, default=5)
+    run_parser.add_argument("--removals", type=float, default=0.5,
+                            help="the probability that a cart has a remove operation")
+    run_parser.add_argument("--queue-size", type=int, default=8)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--time-scale", type=float, default=0.0,
+                            help="multiplies the publish cooldowns, 0 disables them")
+    run_parser.add_argument("--locking", choices=[GLOBAL_LOCK, STRIPED_LOCKS],
+                            default=STRIPED_LOCKS)
+    run_parser.add_argument("--selection", choices=sorted(STRATEGIES), default=FIRST_FIT)
+    run_parser.add_argument("--workers", type=int,
+                            help="run the producers and the consumers on a pool of this "
+                                 "many threads, not a thread each")
+    run_parser.add_argument("--timeout", type=float, default=300,
+                            help="the maximum number of seconds of a run")
+    run_parser.add_argument("-o", "--output", help="the result file, stdout by default")
+
+    compare_parser = commands.add_parser("compare", help="flag the regressions")
+    compare_parser.add_argument("old", help="the result file of the baseline")
+    compare_parser.add_argument("new", help="the result file to check")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="the relative change that counts as a regression")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        with open(args.old, encoding="utf-8") as old_file, \
+                open(args.new, encoding="utf-8") as new_file:
+            regressions = compare(json.load(old_file), json.load(new_file), args.threshold)
+        for key, name, old, new in regressions:
+            print(f"REGRESSION {name}: {old} -> {new} in {key}")
+        print(f"{len(regressions)} regressions")
+        sys.exit(1 if regressions else 0)
+
+    runs = [{"scenario": {"producers": producers, "consumers": consumers,
+                          "products": args.products, "carts": args.carts,
+                          "ops_per_cart": args.ops_per_cart, "skew": skew,
+                          "quantity": quantity, "max_quantity": args.max_quantity,
+                          "removals": args.removals, "queue_size": args.queue_size,
+                          "seed": args.seed},
+             "time_scale": args.time_scale, "locking": args.locking,
+             "selection": args.selection, "workers": args.workers}
+            for producers, consumers, skew, quantity
+            in itertools.product(args.producers, args.consumers, args.skew, args.quantity)]
+    results = {"python": platform.python_version(), "cpus": os.cpu_count(),
+               "runs": run_all(runs, args.timeout)}
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=4)
+    else:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
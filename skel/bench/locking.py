@@ -0,0 +1,75 @@
+"""
+This module compares the GLOBAL_LOCK and STRIPED_LOCKS modes of the Marketplace.
+
+Every thread publishes and buys its own product, so in the striped mode the
+threads never need the same lock.
+
+Run it from the skel folder with: python3 -m bench.locking
+"""
+import logging
+import threading
+import time
+
+from tema.marketplace import Marketplace, GLOBAL_LOCK, STRIPED_LOCKS
+
+THREAD_COUNTS = [8, 64, 512]
+OPS_PER_THREAD = 500
+
+
+def worker(marketplace, barrier):
+    """
+    Publishes a product then adds it to the thread's cart, OPS_PER_THREAD times.
+
+    :type marketplace: Marketplace
+    :param marketplace: the marketplace under test
+
+    :type barrier: Barrier
+    :param barrier: used to start all the threads at once
+    """
+    producer_id = marketplace.register_producer()
+    cart_id = marketplace.new_cart()
+    product = f"product{producer_id}"
+    barrier.wait()
+    for _ in range(OPS_PER_THREAD):
+        marketplace.publish(producer_id, product)
+        marketplace.add_to_cart(cart_id, product)
+
+
+def measure(locking, num_threads):
+    """
+    Returns the number of publish + add_to_cart pairs per second.
+
+    :type locking: String
+    :param locking: the locking mode of the marketplace
+
+    :type num_threads: Int
+    :param num_threads: how many threads run the worker
+    """
+    marketplace = Marketplace(1, locking=locking)
+    barrier = threading.Barrier(num_threads + 1)
+    threads = [threading.Thread(target=worker, args=(marketplace, barrier))
+               for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return num_threads * OPS_PER_THREAD / elapsed
+
+
+def main():
+    """
+    Prints the throughput of both locking modes for every thread count
+    """
+    # we measure the locks, not the log file
+    logging.disable(logging.INFO)
+    print(f"{'threads':>8} {GLOBAL_LOCK + ' (ops/s)':>16} {STRIPED_LOCKS + ' (ops/s)':>17}")
+    for num_threads in THREAD_COUNTS:
+        print(f"{num_threads:>8} {measure(GLOBAL_LOCK, num_threads):>16.0f}"
+              f" {measure(STRIPED_LOCKS, num_threads):>17.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+This module compares the threaded Marketplace with the SharedMarketplace, whose
+inventory lives in shared memory and is used by worker processes.
+
+Every worker (a thread or a process) publishes its own product then adds it to its
+cart. The processes can only run in parallel with enough free cores, check
+os.cpu_count() first.
+
+Run it from the skel folder with: python3 -m bench.shared_memory
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from tema.marketplace import Marketplace
+from tema.shm_inventory import SharedInventory, SharedMarketplace, attach, attached
+
+WORKER_COUNTS = [1, 2, 4, 8, 16]
+OPS_PER_WORKER = 5000
+
+
+def threaded_worker(marketplace, barrier):
+    """
+    Publishes a product then adds it to the thread's cart, OPS_PER_WORKER times.
+
+    :type marketplace: Marketplace
+    :param marketplace: the marketplace under test
+
+    :type barrier: Barrier
+    :param barrier: used to start all the threads at once
+    """
+    producer_id = marketplace.register_producer()
+    cart_id = marketplace.new_cart()
+    barrier.wait()
+    for _ in range(OPS_PER_WORKER):
+        marketplace.publish(producer_id, producer_id)
+        marketplace.add_to_cart(cart_id, producer_id)
+
+
+def process_worker(_):
+    """
+    Like threaded_worker(), in a process attached to the SharedInventory.
+    """
+    marketplace = SharedMarketplace(attached())
+    producer_id = marketplace.register_producer()
+    cart_id = marketplace.new_cart()
+    for _ in range(OPS_PER_WORKER):
+        marketplace.publish(producer_id, producer_id)
+        marketplace.add_to_cart(cart_id, producer_id)
+
+
+def measure_threads(num_workers):
+    """
+    Returns the number of publish + add_to_cart pairs per second of the threads.
+    """
+    marketplace = Marketplace(1)
+    barrier = threading.Barrier(num_workers + 1)
+    threads = [threading.Thread(target=threaded_worker, args=(marketplace, barrier))
+               for _ in range(num_workers)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return num_workers * OPS_PER_WORKER / (time.perf_counter() - start)
+
+
+def measure_processes(num_workers):
+    """
+    Returns the number of publish + add_to_cart pairs per second of the processes.
+    """
+    inventory = SharedInventory(num_workers, num_workers, 1)
+    with ProcessPoolExecutor(num_workers, inventory.context,
+                             initializer=attach,
+                             initargs=(inventory,)) as executor:
+        # start the workers before the clock
+        list(executor.map(abs, range(num_workers)))
+        start = time.perf_counter()
+        list(executor.map(process_worker, range(num_workers)))
+        elapsed = time.perf_counter() - start
+    inventory.close()
+    inventory.unlink()
+    return num_workers * OPS_PER_WORKER / elapsed
+
+
+def main():
+    """
+    Prints the throughput of the threads and of the processes for every worker count
+    """
+    # we measure the inventories, not the log file
+    logging.disable(logging.INFO)
+    print(f"{os.cpu_count()} cpus")
+    print(f"{'workers':>8} {'threads (ops/s)':>16} {'processes (ops/s)':>18}")
+    for num_workers in WORKER_COUNTS:
+        print(f"{num_workers:>8} {measure_threads(num_workers):>16.0f}"
+              f" {measure_processes(num_workers):>18.0f}")
+
+
+if __name__ == '__main__':
+    main()
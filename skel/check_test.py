@@ -1,22 +1,137 @@
 """
 This module checks that the homework's solution output is correct
 
+By default the output is sorted and compared with the reference by diff. With
+--stream, both files are read once, in chunks, and only the number of purchases of
+every (consumer, product) pair is kept, so runs with tens of millions of lines are
+checked in linear time and with memory bounded by the number of distinct pairs.
+
 Computer Systems Architecture Course
 Assignment 1
 March 2021
 """
+import argparse
+import io
 import subprocess
-import sys
+import unittest
+from collections import Counter
 
+# how much of a file is read at once by the streaming check
+CHUNK_SIZE = 1 << 20
+# the separator between the consumer and the product of a purchase line
+BOUGHT = " bought "
 
-def main():
-    if len(sys.argv) != 4:
-        print("Invalid number of arguments\nUsage: check_test.py testname output_filepath ref_filepath")
-        return
 
-    testname = sys.argv[1]
-    output_filename = sys.argv[2]
-    ref_filename = sys.argv[3]
+class TestStreamingCheck(unittest.TestCase):
+    """
+    Class that represents the unit testing for the streaming check.
+    """
+
+    def test_missing_newline(self):
+        """
+        Test that the purchases printed without a newline between them are split
+        """
+        purchases = Counter()
+        count_purchases(io.StringIO("cons1 bought Tea(name='Linden')cons2 bought Tea(name="
+                                    "'Linden')\ncons1 bought Tea(name='Linden')\n"),
+                        purchases, 1, chunk_size=7)
+        self.assertEqual(purchases, Counter({("cons1", "Tea(name='Linden')"): 2,
+                                             ("cons2", "Tea(name='Linden')"): 1}))
+
+    def test_missing_parenthesis(self):
+        """
+        Test that the last line counts the same without its final ")"
+        """
+        purchases = Counter()
+        count_purchases(io.StringIO("cons1 bought id1)\ncons1 bought id1\n"), purchases, 1,
+                        chunk_size=4)
+        self.assertEqual(purchases, Counter({("cons1", "id1)"): 2}))
+
+    def test_mismatches(self):
+        """
+        Test that the extra and the missing purchases are reported by consumer
+        """
+        purchases = Counter()
+        count_purchases(io.StringIO("cons1 bought id1)\ncons1 bought id1)\ncons2 bought id2)"),
+                        purchases, 1)
+        count_purchases(io.StringIO("cons1 bought id1)\ncons2 bought id3)\n"), purchases, -1)
+        self.assertEqual(mismatches(purchases),
+                         {"cons1": [("id1)", 1)], "cons2": [("id2)", 1), ("id3)", -1)]})
+
+
+def count_lines(input_file, chunk_size=CHUNK_SIZE):
+    """
+    Returns how many times every purchase line is in a file, read in chunks. A line
+    ends with the ")" of its product, sometimes there is no new line between consumer
+    outputs.
+    """
+    lines = Counter()
+    rest = ""
+    while True:
+        chunk = input_file.read(chunk_size)
+        if not chunk:
+            break
+        parts = (rest + chunk).split(")")
+        # the last part isn't complete yet
+        rest = parts.pop()
+        # counted without a Python loop, the ")" are added back to the distinct lines
+        lines.update(map(str.strip, parts))
+    lines = Counter({line + ")": count for line, count in lines.items() if line})
+    # like check_sorted(), the last line gets its ")" even if it was cut off
+    if rest.strip():
+        lines[rest.strip() + ")"] += 1
+    return lines
+
+
+def count_purchases(input_file, purchases, sign, chunk_size=CHUNK_SIZE):
+    """
+    Adds sign to the count of every (consumer, product) pair bought in a file.
+    A line without BOUGHT is counted whole as the consumer, with an empty product.
+    """
+    for line, count in count_lines(input_file, chunk_size).items():
+        consumer, _, product = line.partition(BOUGHT)
+        purchases[consumer, product] += sign * count
+
+
+def mismatches(purchases):
+    """
+    Returns the pairs that were bought a different number of times, as a dictionary
+    of type { consumer : [ (product, how many more than in the reference) ] }.
+    """
+    by_consumer = {}
+    for (consumer, product), difference in sorted(purchases.items()):
+        if difference != 0:
+            by_consumer.setdefault(consumer, []).append((product, difference))
+    return by_consumer
+
+
+def check_streaming(output_filename, ref_filename):
+    """
+    Compares the purchases of the output and of the reference and prints the
+    mismatches of every consumer.
+
+    :returns True if they are the same
+    """
+    purchases = Counter()
+    with open(output_filename, encoding="utf-8") as output_file:
+        count_purchases(output_file, purchases, 1)
+    with open(ref_filename, encoding="utf-8") as ref_file:
+        count_purchases(ref_file, purchases, -1)
+
+    by_consumer = mismatches(purchases)
+    for consumer, products in by_consumer.items():
+        for product, difference in products:
+            print(f"{consumer}: {abs(difference)} {'extra' if difference > 0 else 'missing'}"
+                  f" {product}")
+    return not by_consumer
+
+
+def check_sorted(output_filename, ref_filename):
+    """
+    Sorts the output in a .sorted file and compares it with the reference by diff.
+
+    :returns True if they are the same
+    """
     # load the lines from the output file and sort them
     with open(output_filename) as output_file:
         output_lines = output_file.read()
@@ -35,11 +150,32 @@ def main():
 
     command = subprocess.Popen(["diff", sorted_output_filename, ref_filename], stdout=subprocess.PIPE)
     out, err = command.communicate()
+    return len(out) == 0
+
+
+def main():
+    """
+    Checks an output against its reference and prints if the test passed
+    """
+    parser = argparse.ArgumentParser(
+        usage="check_test.py testname output_filepath ref_filepath [--stream]")
+    parser.add_argument("testname")
+    parser.add_argument("output_filename")
+    parser.add_argument("ref_filename")
+    parser.add_argument("--stream", action="store_true",
+                        help="compare the purchases of every consumer in a single pass, "
+                             "for very large outputs")
+    args = parser.parse_args()
+
+    if args.stream:
+        is_ok = check_streaming(args.output_filename, args.ref_filename)
+    else:
+        is_ok = check_sorted(args.output_filename, args.ref_filename)
 
-    if len(out) == 0:
-        print(f"Test {testname}" + ":\t\t" + "PASSED")
+    if is_ok:
+        print(f"Test {args.testname}" + ":\t\t" + "PASSED")
     else:
-        print(f"Test {testname}" + ":\t\t" + "FAILED")
+        print(f"Test {args.testname}" + ":\t\t" + "FAILED")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,246 @@
+"""
+This module runs the tests of the homework in parallel and checks their output
+
+Every scenario runs test.py in a process of its own, up to --jobs at a time (the
+number of CPUs by default), with the timeouts of the original run_tests.sh. Its
+purchases go to tests/NN.out and its logs to out/NN/. The passed scenarios are
+cached in .test_cache/ by a hash of the tema/ sources, test.py, check_test.py, the
+scenario files and the arguments, so a scenario whose inputs didn't change isn't
+run again. It exits with 1 if a scenario failed, run_tests.sh still exits with 0
+like before, check.sh reads its output.
+
+Usage: python3 run_tests.py [--tests 1 2 ...] [--jobs N] [-- test.py arguments]
+
+Computer Systems Architecture Course
+Assignment 1
+March 2022
+"""
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from check_test import check_sorted, check_streaming
+
+SRC = "tema"
+TESTS = "tests"
+OUT = "out"
+CACHE = ".test_cache"
+# the timeouts of run_tests.sh, in seconds
+TIMEOUTS = {i: 30 for i in range(1, 9)}
+TIMEOUTS.update({9: 60, 10: 60})
+# how often a running scenario is checked, in seconds
+POLL_INTERVAL = 0.05
+
+PASSED = "PASSED"
+FAILED = "FAILED"
+TIMEOUT = "TIMEOUT"
+
+
+class TestRunTests(unittest.TestCase):
+    """
+    Class that represents the unit testing for the test runner.
+    """
+
+    def test_cache_key(self):
+        """
+        Test that the cache key changes with the sources and the arguments only
+        """
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, SRC))
+            os.makedirs(os.path.join(root, TESTS))
+            for name in ["test.py", "check_test.py", f"{SRC}/marketplace.py",
+                         f"{TESTS}/01.in", f"{TESTS}/01.ref.out"]:
+                with open(os.path.join(root, name), "w", encoding="utf-8") as source:
+                    source.write(name)
+            key = cache_key(root, 1, [], False)
+            self.assertEqual(cache_key(root, 1, [], False), key)
+            self.assertNotEqual(cache_key(root, 1, ["--engine", "pool"], False), key)
+            for name in [f"{SRC}/marketplace.py", "check_test.py"]:
+                with open(os.path.join(root, name), "a", encoding="utf-8") as source:
+                    source.write("# changed")
+                self.assertNotEqual(cache_key(root, 1, [], False), key)
+                key = cache_key(root, 1, [], False)
+
+    def test_run_process(self):
+        """
+        Test that a process is timed out and its peak memory is measured
+        """
+        status, _, peak_rss = run_process([sys.executable, "-c", "pass"], 10,
+                                          subprocess.DEVNULL, subprocess.DEVNULL, None)
+        self.assertEqual(status, 0)
+        self.assertGreater(peak_rss, 0)
+        status, wall_time, _ = run_process([sys.executable, "-c", "import time; "
+                                            "time.sleep(10)"], 0.2, subprocess.DEVNULL,
+                                           subprocess.DEVNULL, None)
+        self.assertEqual(status, None)
+        self.assertLess(wall_time, 5)
+
+
+def cache_key(root, test, test_args, stream):
+    """
+    Returns the hash of everything the result of a scenario depends on: the tema/
+    sources, test.py, check_test.py, the scenario and its reference, the arguments
+    of test.py and the kind of check.
+    """
+    digest = hashlib.sha256()
+    sources = sorted(glob.glob(os.path.join(root, SRC, "**", "*.py"), recursive=True))
+    sources += [os.path.join(root, "test.py"), os.path.join(root, "check_test.py"),
+                *scenario_files(root, test)]
+    for path in sources:
+        digest.update(os.path.relpath(path, root).encode() + b"\0")
+        with open(path, "rb") as source:
+            digest.update(source.read())
+        digest.update(b"\0")
+    digest.update(json.dumps([test_args, stream]).encode())
+    return digest.hexdigest()
+
+
+def scenario_files(root, test):
+    """
+    Returns the input and the reference output of a scenario.
+    """
+    prefix = os.path.join(root, TESTS, f"{test:02d}")
+    return [prefix + ".in", prefix + ".ref.out"]
+
+
+def run_process(command, timeout, stdout, stderr, cwd):
+    """
+    Runs a command and waits for it with os.wait4(), which also gives its resource
+    usage. Its peak RSS is the one of the largest process among the command and the
+    children it waited for, like the shards of test.py, not the sum of the processes
+    that ran together.
+
+    :returns a tuple (exit status or None if it timed out, wall time in seconds,
+    peak RSS in KiB)
+    """
+    start = time.monotonic()
+    with subprocess.Popen(command, stdout=stdout, stderr=stderr, cwd=cwd) as process:
+        deadline = start + timeout
+        is_killed = False
+        while True:
+            pid, status, usage = os.wait4(process.pid, 0 if is_killed else os.WNOHANG)
+            if pid:
+                break
+            if time.monotonic() >= deadline:
+                process.kill()
+                is_killed = True
+            else:
+                time.sleep(POLL_INTERVAL)
+        wall_time = time.monotonic() - start
+        # we reaped it, Popen must not wait for it again
+        process.returncode = os.waitstatus_to_exitcode(status)
+    return (None if is_killed else process.returncode), wall_time, usage.ru_maxrss
+
+
+def run_scenario(root, test, timeout, test_args, stream):
+    """
+    Runs a scenario and checks its output.
+
+    :returns a dictionary with the "result" (PASSED, FAILED or TIMEOUT), the
+    "wall_time" in seconds and the "peak_rss_kib"
+    """
+    in_filename, ref_filename = scenario_files(root, test)
+    out_filename = os.path.join(root, TESTS, f"{test:02d}.out")
+    # the logs of every scenario go to their own folder, the scenarios run together
+    work_dir = os.path.join(root, OUT, f"{test:02d}")
+    os.makedirs(work_dir, exist_ok=True)
+    with open(out_filename, "w", encoding="utf-8") as out_file, \
+            open(os.path.join(work_dir, "stderr"), "w", encoding="utf-8") as err_file:
+        status, wall_time, peak_rss = run_process(
+            [sys.executable, os.path.join(root, "test.py"), *test_args, in_filename],
+            timeout, out_file, err_file, work_dir)
+
+    if status is None:
+        result = TIMEOUT
+    else:
+        check = check_streaming if stream else check_sorted
+        result = PASSED if status == 0 and check(out_filename, ref_filename) else FAILED
+    return {"result": result, "wall_time": round(wall_time, 2), "peak_rss_kib": peak_rss}
+
+
+def report(test, timeout, outcome, is_cached):
+    """
+    Prints the result of a scenario, in the format of run_tests.sh that parse.awk
+    reads, with the wall time and the peak memory.
+    """
+    if outcome["result"] == TIMEOUT:
+        print(f"TIMEOUT. Test {test} exceeded maximum allowed time of {timeout}")
+        result = FAILED
+    else:
+        result = outcome["result"]
+    print(f"Test {test}:\t\t{result}\t{outcome['wall_time']:.2f} s\t"
+          f"{outcome['peak_rss_kib'] / 1024:.1f} MiB" + ("\t(cached)" if is_cached else ""),
+          flush=True)
+
+
+def main():
+    """
+    Runs the scenarios, or takes their cached results, and prints a line for each of
+    them and the number of passed ones
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tests", type=int, nargs="+", default=sorted(TIMEOUTS),
+                        help="the scenarios to run, all of them by default")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="how many scenarios run at the same time")
+    parser.add_argument("--timeout", type=float,
+                        help="the timeout of every scenario, in seconds, instead of the "
+                             "ones of run_tests.sh")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="run every scenario, even if its result is cached")
+    parser.add_argument("--stream", action="store_true",
+                        help="check the outputs with check_test.py --stream")
+    parser.add_argument("test_args", nargs=argparse.REMAINDER,
+                        help="after --, the arguments of test.py, like --engine pool")
+    args = parser.parse_args()
+    test_args = args.test_args[1:] if args.test_args[:1] == ["--"] else args.test_args
+    root = os.path.dirname(os.path.abspath(__file__))
+    cache_dir = os.path.join(root, CACHE)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # a process with shards has several, os.wait4() gives the largest one
+    print("(the memory is the peak RSS of the largest process of a scenario)", flush=True)
+    start = time.monotonic()
+    outcomes = {}
+    with concurrent.futures.ThreadPoolExecutor(max(1, args.jobs)) as executor:
+        # every thread waits for a process, the scenarios run in parallel
+        futures = {}
+        for test in args.tests:
+            timeout = args.timeout or TIMEOUTS.get(test, 60)
+            key = cache_key(root, test, test_args, args.stream)
+            cache_filename = os.path.join(cache_dir, key + ".json")
+            if not args.no_cache and os.path.exists(cache_filename):
+                with open(cache_filename, encoding="utf-8") as cache_file:
+                    outcomes[test] = json.load(cache_file)
+                report(test, timeout, outcomes[test], True)
+                continue
+            future = executor.submit(run_scenario, root, test, timeout, test_args,
+                                     args.stream)
+            futures[future] = (test, timeout, cache_filename)
+
+        for future in concurrent.futures.as_completed(futures):
+            test, timeout, cache_filename = futures[future]
+            outcomes[test] = future.result()
+            report(test, timeout, outcomes[test], False)
+            # only the passed scenarios are cached, a failure may be a flaky one
+            if outcomes[test]["result"] == PASSED:
+                with tempfile.NamedTemporaryFile("w", dir=cache_dir, delete=False) as cache_file:
+                    json.dump(outcomes[test], cache_file)
+                shutil.move(cache_file.name, cache_filename)
+
+    passed = sum(outcome["result"] == PASSED for outcome in outcomes.values())
+    print(f"\n{passed}/{len(outcomes)} passed in {time.monotonic() - start:.2f} s")
+    sys.exit(0 if passed == len(outcomes) else 1)
+
+
+if __name__ == "__main__":
+    main()
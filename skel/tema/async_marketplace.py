@@ -0,0 +1,379 @@
+"""
+This module represents the asyncio version of the Marketplace, where producers and
+consumers are coroutines instead of threads.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2022
+"""
+import asyncio
+import unittest
+
+from tema.marketplace import Marketplace, GLOBAL_LOCK
+from tema.order_sink import PrintSink, MemorySink
+
+
+class TestAsyncMarketplaceMethods(unittest.TestCase):
+    """
+    Class that represents the unit testing for the AsyncMarketplace methods.
+    """
+
+    def setUp(self):
+        """
+        Constructor for setting up the tests
+        Initialize the marketplace with queue_limit = 8
+        """
+        self.marketplace = AsyncMarketplace(8)
+
+    def test_add_to_cart_blocking(self):
+        """
+        Test that a blocking add_to_cart waits for the product to be published
+        """
+        async def scenario():
+            cart_id = await self.marketplace.new_cart()
+            # nobody publishes id1, so it should give up after the timeout
+            self.assertEqual(await self.marketplace.add_to_cart(cart_id, "id1", block=True,
+                                                                timeout=0.01), False)
+            consumer = asyncio.ensure_future(
+                self.marketplace.add_to_cart(cart_id, "id1", block=True, timeout=5))
+            await self.marketplace.publish(0, "id1")
+            self.assertEqual(await consumer, True)
+            return await self.marketplace.place_order(cart_id)
+
+        self.assertEqual(asyncio.run(scenario()), ["id1"])
+
+    def test_publish_blocking(self):
+        """
+        Test that a blocking publish waits for a slot in the producer's queue
+        """
+        async def scenario():
+            for _ in range(8):
+                await self.marketplace.publish(0, "id1")
+            # nobody buys anything, so it should give up after the timeout
+            self.assertEqual(await self.marketplace.publish(0, "id1", block=True,
+                                                            timeout=0.01), False)
+            producer = asyncio.ensure_future(
+                self.marketplace.publish(0, "id2", block=True, timeout=5))
+            cart_id = await self.marketplace.new_cart()
+            await self.marketplace.add_to_cart(cart_id, "id1")
+            return await producer
+
+        self.assertEqual(asyncio.run(scenario()), True)
+
+    def test_run_market(self):
+        """
+        Test that the consumers buy everything from their carts
+        """
+        market_config = {
+            # big enough to hold everything the consumers buy
+            "marketplace": {"queue_size_per_producer": 50},
+            "producers": [{"name": "prod1", "products": [("id1", 1, 0), ("id2", 1, 0)],
+                           "republish_wait_time": 0.01}],
+            "consumers": [{"name": f"cons{i}", "retry_wait_time": 0.01,
+                           "carts": [[{"type": "add", "product": "id1", "quantity": 2},
+                                      {"type": "remove", "product": "id1", "quantity": 1},
+                                      {"type": "add", "product": "id2", "quantity": 1}]]}
+                          for i in range(10)]
+        }
+        sink = MemorySink()
+        asyncio.run(run_market(market_config, sink=sink))
+        self.assertEqual(len(sink.lines), 20)
+        self.assertEqual(sink.lines.count("cons7 bought id1"), 1)
+
+    def test_failed_add(self):
+        """
+        Test that a consumer tries again when a blocking add_to_cart comes back
+        without the unit
+        """
+        marketplace = self.marketplace
+        failures = [True, True]
+        add_to_cart = marketplace.add_to_cart
+
+        async def flaky_add_to_cart(cart_id, product, block=False, timeout=None):
+            if failures:
+                failures.pop()
+                return False
+            return await add_to_cart(cart_id, product, block, timeout)
+
+        marketplace.add_to_cart = flaky_add_to_cart
+
+        async def scenario():
+            await marketplace.publish(0, "id1")
+            await marketplace.publish(0, "id1")
+            sink = MemorySink()
+            await run_consumer(marketplace, "cons1", [[{"type": "add", "product": "id1",
+                                                        "quantity": 2}]], sink)
+            return sink.lines
+
+        self.assertEqual(asyncio.run(scenario()), ["cons1 bought id1"] * 2)
+
+
+async def _wait(condition, predicate, timeout):
+    """
+    Waits on condition until predicate is true or timeout seconds have passed.
+    """
+    async with condition:
+        try:
+            await asyncio.wait_for(condition.wait_for(predicate), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def _notify(condition):
+    """
+    Wakes up one of the coroutines waiting on condition.
+    """
+    async with condition:
+        condition.notify()
+
+
+class AsyncMarketplace:
+    """
+    Class that represents the Marketplace for coroutines. All of them run on the same
+    event loop, so it keeps the state in a Marketplace that is never used concurrently
+    and, instead of blocking a thread, waits on asyncio conditions.
+    """
+    # dictionary of type { "product_id" : Condition }, notified every time
+    # a unit of the product becomes available
+    product_conditions: dict
+    # dictionary of type { "producer_id" : Condition }, notified every time
+    # a slot from the producer's queue is freed
+    producer_conditions: dict
+
+    def __init__(self, queue_size_per_producer, **kwargs):
+        """
+        Constructor
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type kwargs: Dict
+        :param kwargs: passed to the Marketplace, like event_log, registry or inventory
+        """
+        # the event loop is the only thread using it, the global lock is never contended
+        self.marketplace = Marketplace(queue_size_per_producer, locking=GLOBAL_LOCK, **kwargs)
+        self.queue_size_per_producer = queue_size_per_producer
+        self.product_conditions = {}
+        self.producer_conditions = {}
+
+    @staticmethod
+    def _condition_of(conditions, key):
+        """
+        Returns the condition of key from conditions, creating it inside the running loop.
+        """
+        condition = conditions.get(key)
+        if condition is None:
+            condition = conditions[key] = asyncio.Condition()
+        return condition
+
+    async def register_producer(self):
+        """
+        Returns an id for the producer that calls this.
+        """
+        return self.marketplace.register_producer()
+
+    async def publish(self, producer_id, product, block=False, timeout=None):
+        """
+        Adds the product provided by the producer to the marketplace
+
+        :type producer_id: String
+        :param producer_id: producer id
+
+        :type product: Product
+        :param product: the Product that will be published in the Marketplace
+
+        :type block: Bool
+        :param block: if True and the producer's queue is full, wait until a consumer
+        takes a product out of it
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to block, None means forever
+
+        :returns True or False. If the caller receives False, it should wait and then try again.
+        """
+        if block:
+            await _wait(self._condition_of(self.producer_conditions, producer_id),
+                        lambda: self.marketplace.queue_occupancy(producer_id)
+                        < self.queue_size_per_producer, timeout)
+        is_ok = self.marketplace.publish(producer_id, product)
+        if is_ok:
+            await _notify(self._condition_of(self.product_conditions, product))
+        return is_ok
+
+    async def new_cart(self):
+        """
+        Creates a new cart for the consumer
+
+        :returns an int representing the cart_id
+        """
+        return self.marketplace.new_cart()
+
+    async def add_to_cart(self, cart_id, product, block=False, timeout=None):
+        """
+        Adds a product to the given cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product: Product
+        :param product: the product to add to cart
+
+        :type block: Bool
+        :param block: if True and the product is not available, wait until a producer
+        publishes it or another consumer removes it from its cart
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to block, None means forever
+
+        :returns True or False. If the caller receives False, it should wait and then try again
+        """
+        if block:
+            await _wait(self._condition_of(self.product_conditions, product),
+                        lambda: self.marketplace.available.get(product), timeout)
+        producer_id = self.marketplace.reserve(cart_id, product)
+        if producer_id is None:
+            return False
+        await _notify(self._condition_of(self.producer_conditions, producer_id))
+        return True
+
+    async def remove_from_cart(self, cart_id, product):
+        """
+        Removes a product from cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product: Product
+        :param product: the product to remove from cart
+        """
+        self.marketplace.remove_from_cart(cart_id, product)
+        await _notify(self._condition_of(self.product_conditions, product))
+
+    async def place_order(self, cart_id):
+        """
+        Return a list with all the products in the cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+        """
+        return self.marketplace.place_order(cart_id)
+
+    def shutdown(self):
+        """
+        Writes the queued log records and closes the log file and the event log.
+        """
+        self.marketplace.shutdown()
+
+
+async def run_producer(marketplace, stop, products, republish_wait_time, **_):
+    """
+    Coroutine version of Producer.run(), it publishes the products until stop is set.
+
+    :type marketplace: AsyncMarketplace
+    :param marketplace: a reference to the marketplace
+
+    :type stop: Event
+    :param stop: set when the consumers are done
+
+    :type products: List()
+    :param products: a list of products that the producer will produce
+
+    :type republish_wait_time: Time
+    :param republish_wait_time: the maximum number of seconds that a producer
+    waits for a free slot before asking the marketplace again
+    """
+    id_producer = await marketplace.register_producer()
+    while not stop.is_set():
+        for (product_id, qty, publish_cooldown) in products:
+            for _ in range(qty):
+                while not await marketplace.publish(id_producer, product_id, block=True,
+                                                    timeout=republish_wait_time):
+                    if stop.is_set():
+                        return
+                await asyncio.sleep(publish_cooldown)
+
+
+async def run_consumer(marketplace, name, carts, sink=None, **_):
+    """
+    Coroutine version of Consumer.run(), it fills and places every cart. The
+    retry_wait_time is not needed, the consumer is woken up as soon as a product
+    it waits for becomes available.
+
+    :type marketplace: AsyncMarketplace
+    :param marketplace: a reference to the marketplace
+
+    :type name: String
+    :param name: the name of the consumer, printed for every bought product
+
+    :type carts: List
+    :param carts: a list of add and remove operations
+
+    :type sink: OrderSink
+    :param sink: gets the placed orders, they are printed by default
+    """
+    if sink is None:
+        sink = PrintSink()
+    for ops in carts:
+        cart_id = await marketplace.new_cart()
+        for operation in ops:
+            if operation["type"] == "add":
+                for _ in range(operation["quantity"]):
+                    # every new unit wakes up exactly one waiting consumer, so there is
+                    # no need for a timeout; with thousands of consumers waiting for the
+                    # same product the timeouts would only cost CPU. A wait can still end
+                    # without the unit, like in Consumer.run() it's tried again then
+                    while not await marketplace.add_to_cart(cart_id, operation["product"],
+                                                            block=True):
+                        pass
+            elif operation["type"] == "remove":
+                for _ in range(operation["quantity"]):
+                    await marketplace.remove_from_cart(cart_id, operation["product"])
+
+        sink.order(name, await marketplace.place_order(cart_id))
+
+
+async def run_market(market_config, sink=None, event_log=None, until=None):
+    """
+    Runs every producer and consumer from the market configuration as a task and
+    returns when all the consumers are done.
+
+    :type market_config: Dict
+    :param market_config: the configuration returned by tema.config.load_config()
+
+    :type sink: OrderSink
+    :param sink: gets the placed orders, they are printed by default
+
+    :type event_log: EventLog
+    :param event_log: if given, every operation is also recorded in this binary log
+
+    :type until: Float
+    :param until: if given, the consumers still running after this many seconds are
+    cancelled
+
+    :returns True if all the consumers are done, False if some were cancelled
+    """
+    marketplace = AsyncMarketplace(**market_config['marketplace'], event_log=event_log)
+    stop = asyncio.Event()
+    producers = [asyncio.ensure_future(run_producer(marketplace, stop, **p_market_config))
+                 for p_market_config in market_config['producers']]
+    consumers = asyncio.gather(*(run_consumer(marketplace, **c_market_config, sink=sink)
+                                 for c_market_config in market_config['consumers']))
+    await asyncio.wait([consumers], timeout=until)
+    is_done = consumers.done()
+    if is_done:
+        # raises what a consumer raised
+        await consumers
+    else:
+        # the consumers only wait on conditions, without asyncio.wait_for(), so they
+        # can be cancelled safely
+        consumers.cancel()
+        try:
+            await consumers
+        except asyncio.CancelledError:
+            pass
+    # the producers are stopped instead of cancelled, a task cancelled while its
+    # asyncio.wait_for() times out can miss the cancellation and never finish
+    stop.set()
+    await asyncio.gather(*producers)
+    marketplace.shutdown()
+    return is_done
@@ -0,0 +1,371 @@
+"""
+This module loads a market configuration (tests/*.in) file.
+
+Big configurations can also be streamed from a JSON-lines file (*.jsonl), with an
+object per line, in this order:
+    {"product": "id1", "product_type": "Coffee", "name": ..., ...}   every product
+    {"marketplace": {"queue_size_per_producer": 8}}
+    {"producer": {"name": "prod1", "products": [...], "republish_wait_time": 0.1}}
+    {"consumer": {"name": "cons1", "retry_wait_time": 0.1}}
+    {"cart": [{"type": "add", "product": "id1", "quantity": 2}, ...]}
+where the cart lines follow the consumer they belong to, and the producers and the
+consumers can be mixed. Convert a tests/*.in file with:
+    python3 -m tema.config tests/01.in tests/01.jsonl
+
+Computer Systems Architecture Course
+Assignment 1
+March 2022
+"""
+import argparse
+import json
+import os
+import tempfile
+import unittest
+from json import loads
+
+from tema.product import Product, Coffee, Tea, ProductRegistry  # pylint: disable=unused-import
+
+PRODUCER = "producer"
+CONSUMER = "consumer"
+CART = "cart"
+# the prefix of the cart lines written by write_stream(), the participants loader
+# skips them without parsing them
+CART_PREFIX = b'{"cart"'
+# how many bytes of cart lines a consumer reads at once, every consumer reading
+# its carts has a buffer of this size
+CART_BUFFER_SIZE = 1 << 12
+
+
+class TestStreamConfig(unittest.TestCase):
+    """
+    Class that represents the unit testing for the streaming loader.
+    """
+
+    def test_stream(self):
+        """
+        Test that a streamed configuration has the same participants as the loaded one
+        """
+        with open(os.path.join(os.path.dirname(__file__), "..", "tests", "02.in"),
+                  encoding="utf-8") as input_file:
+            market_config = loads(input_file.read())
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "02.jsonl")
+            with open(path, "w", encoding="utf-8") as output_file:
+                write_stream(json.loads(json.dumps(market_config)), output_file)
+            loaded = build_config(market_config)
+            streamed, streamed_participants = stream_config(path)
+            self.assertEqual(streamed["marketplace"]["queue_size_per_producer"],
+                             loaded["marketplace"]["queue_size_per_producer"])
+            # the products are interned in the same order
+            self.assertEqual(streamed["marketplace"]["registry"].products,
+                             loaded["marketplace"]["registry"].products)
+            streamed_participants = list(streamed_participants)
+            self.assertEqual([kwargs for kind, kwargs in streamed_participants
+                              if kind == PRODUCER], loaded["producers"])
+            consumers = [kwargs for kind, kwargs in streamed_participants if kind == CONSUMER]
+            self.assertEqual([dict(kwargs, carts=list(kwargs["carts"])) for kwargs in consumers],
+                             loaded["consumers"])
+            # the carts can be read again
+            self.assertEqual(list(consumers[0]["carts"]), loaded["consumers"][0]["carts"])
+            streamed["carts_file"].close()
+
+    def test_cart_lines(self):
+        """
+        Test that the carts are parsed whatever their spacing, across blank lines,
+        and that an unexpected line is an error
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "carts.jsonl")
+            with open(path, "w", encoding="utf-8") as output_file:
+                output_file.write('{"product": "id1", "product_type": "Tea", "name": "Linden",'
+                                  ' "type": "Herbal", "price": 9}\n'
+                                  '{"marketplace": {"queue_size_per_producer": 8}}\n'
+                                  '{"consumer": {"name": "cons1", "retry_wait_time": 0.1}}\n'
+                                  '{ "cart" : [{"type": "add", "product": "id1", '
+                                  '"quantity": 1}]}\n\n'
+                                  '{"cart": []}\n'
+                                  '{"consumer": {"name": "cons2", "retry_wait_time": 0.1}}\n'
+                                  '{"cart": []}\n'
+                                  '{"marketplace": {}}\n')
+            streamed, streamed_participants = stream_config(path)
+            consumers = []
+            # the marketplace line can't follow the participants
+            with self.assertRaises(ValueError):
+                for _, kwargs in streamed_participants:
+                    consumers.append(kwargs)
+            self.assertEqual(list(consumers[0]["carts"]),
+                             [[{"type": "add", "product": 0, "quantity": 1}], []])
+            # nor end the carts of a consumer
+            with self.assertRaises(ValueError):
+                list(consumers[1]["carts"])
+            # the lines longer than the buffer are read whole
+            with open(path, "rb") as input_file:
+                self.assertEqual(list(streamed["carts_file"].lines(0, buffer_size=16)),
+                                 input_file.read().splitlines())
+            streamed["carts_file"].close()
+
+
+def load_config(filename, intern_products=True):
+    """
+    Reads the market configuration and turns the product ids from the producers and
+    the consumers' carts into actual products.
+
+    :type filename: String
+    :param filename: the path of the input file
+
+    :type intern_products: Bool
+    :param intern_products: if True, the products are replaced by their integer id
+    from a ProductRegistry, passed to the Marketplace as "registry"
+
+    :returns a dictionary with the "producers", "consumers" and "marketplace" sections
+    """
+    with open(filename, encoding="utf-8") as input_file:
+        market_config = loads(input_file.read())
+    return build_config(market_config, intern_products)
+
+
+def build_config(market_config, intern_products=True):
+    """
+    Same as load_config(), for a market configuration that is already parsed.
+
+    :type market_config: Dict
+    :param market_config: the content of an input file, it is changed in place
+
+    :type intern_products: Bool
+    :param intern_products: if True, the products are replaced by their integer id
+    from a ProductRegistry, passed to the Marketplace as "registry"
+
+    :returns a dictionary with the "producers", "consumers" and "marketplace" sections
+    """
+    # turn product definitions into actual products
+    products = {}
+
+    for k, products_dict in market_config['products'].items():
+        params = {k: products_dict[k] for k in products_dict.keys() if k != 'product_type'}
+        products[k] = globals()[products_dict['product_type']](**params)
+    del market_config['products']
+
+    if intern_products:
+        registry = ProductRegistry()
+        products = {k: registry.intern(product) for k, product in products.items()}
+        # the marketplace turns the ids back into products when an order is placed
+        market_config['marketplace']['registry'] = registry
+
+    # turn product ids into products in producers
+    for producer in market_config['producers']:
+        producer['products'] = [(products[i], quantity, sleep_time)
+                                for i, quantity, sleep_time
+                                in producer['products']]
+
+    # turn product ids into products in consumer order lists and expected carts
+    for consumer in market_config['consumers']:
+        for cart in consumer['carts']:
+            for operation in cart:
+                operation['product'] = products[operation['product']]
+
+    return market_config
+
+
+def participants(market_config):
+    """
+    Returns the producers and the consumers of a loaded configuration, like the
+    second result of stream_config().
+    """
+    for producer in market_config['producers']:
+        yield PRODUCER, producer
+    for consumer in market_config['consumers']:
+        yield CONSUMER, consumer
+
+
+class CartsFile:
+    """
+    Class that represents a JSON-lines configuration opened for reading the carts.
+    It's shared by all the consumers, which read it with os.pread(), so it has no
+    position to guard and a single file descriptor serves any number of them.
+    """
+
+    def __init__(self, filename):
+        self.fd = os.open(filename, os.O_RDONLY)
+
+    def lines(self, offset, buffer_size=CART_BUFFER_SIZE):
+        """
+        Yields the lines from offset on, without the newline. Every generator has
+        its own buffer, filled buffer_size bytes at a time.
+        """
+        buffer = b""
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end >= 0:
+                yield buffer[start:end]
+                start = end + 1
+                continue
+            chunk = os.pread(self.fd, buffer_size, offset)
+            if not chunk:
+                if start < len(buffer):
+                    yield buffer[start:]
+                return
+            offset += len(chunk)
+            # the unfinished line is kept for the next chunk
+            buffer = buffer[start:] + chunk
+            start = 0
+
+    def close(self):
+        """
+        Closes the file.
+        """
+        os.close(self.fd)
+
+
+class LazyCarts:
+    """
+    Class that represents the carts of a consumer from a JSON-lines configuration.
+    Every iteration reads them one by one from the file, so only the cart being
+    filled is in memory.
+    """
+
+    def __init__(self, carts_file, offset, products):
+        """
+        Constructor.
+
+        :type carts_file: CartsFile
+        :param carts_file: the configuration file
+
+        :type offset: Int
+        :param offset: where the first cart line of the consumer starts
+
+        :type products: Dict
+        :param products: the products of the configuration, by their id from the file
+        """
+        self.carts_file = carts_file
+        self.offset = offset
+        self.products = products
+
+    def __iter__(self):
+        for line in self.carts_file.lines(self.offset):
+            if not line.strip():
+                continue
+            entry = loads(line)
+            if CART not in entry:
+                # the carts of the consumer end at the next participant
+                if PRODUCER in entry or CONSUMER in entry:
+                    return
+                raise ValueError(f"unexpected line among the carts: {line[:100]!r}")
+            operations = entry[CART]
+            for operation in operations:
+                operation['product'] = self.products[operation['product']]
+            yield operations
+
+
+def stream_config(filename, intern_products=True):
+    """
+    Opens a JSON-lines market configuration. The products and the marketplace
+    section are read right away, the producers and the consumers while the second
+    result is iterated, so they can be started as soon as they are read.
+
+    :type filename: String
+    :param filename: the path of the *.jsonl file
+
+    :type intern_products: Bool
+    :param intern_products: if True, the products are replaced by their integer id
+    from a ProductRegistry, passed to the Marketplace as "registry"
+
+    :returns a tuple (a dictionary with the "marketplace" section and the
+    "carts_file", an iterator of tuples (PRODUCER or CONSUMER, the arguments of the
+    participant)); the carts of a consumer are a LazyCarts reading from carts_file,
+    which is closed when the run is over
+    """
+    products = {}
+    registry = ProductRegistry() if intern_products else None
+    with open(filename, "rb") as input_file:
+        while True:
+            line = input_file.readline()
+            if not line:
+                raise ValueError(f"{filename} has no marketplace line")
+            entry = loads(line)
+            if "marketplace" in entry:
+                break
+            params = {k: v for k, v in entry.items() if k not in ("product", "product_type")}
+            product = globals()[entry['product_type']](**params)
+            products[entry['product']] = product if registry is None \
+                else registry.intern(product)
+        # the participants are read from there by the iterator
+        offset = input_file.tell()
+    marketplace = entry['marketplace']
+    if registry is not None:
+        marketplace['registry'] = registry
+    carts_file = CartsFile(filename)
+    return ({'marketplace': marketplace, 'carts_file': carts_file},
+            _stream_participants(filename, offset, products, carts_file))
+
+
+def _stream_participants(filename, offset, products, carts_file):
+    """
+    Yields the participants of stream_config(), from offset on, skipping the cart
+    lines.
+    """
+    with open(filename, "rb") as input_file:
+        input_file.seek(offset)
+        while True:
+            offset = input_file.tell()
+            line = input_file.readline()
+            if not line:
+                return
+            # most cart lines are skipped before being parsed
+            if line.startswith(CART_PREFIX) or not line.strip():
+                continue
+            entry = loads(line)
+            if CART in entry:
+                continue
+            if PRODUCER in entry:
+                producer = entry[PRODUCER]
+                producer['products'] = [(products[i], quantity, sleep_time)
+                                        for i, quantity, sleep_time in producer['products']]
+                yield PRODUCER, producer
+            elif CONSUMER in entry:
+                consumer = entry[CONSUMER]
+                consumer['carts'] = LazyCarts(carts_file, offset + len(line), products)
+                yield CONSUMER, consumer
+            else:
+                raise ValueError(f"unexpected line among the participants: {line[:100]!r}")
+
+
+def write_stream(market_config, output_file):
+    """
+    Writes a market configuration, as read from a tests/*.in file, in the
+    JSON-lines format.
+
+    :type market_config: Dict
+    :param market_config: the parsed content of an input file, it's changed in place
+
+    :type output_file: File
+    :param output_file: where the lines go
+    """
+    for product_id, product in market_config['products'].items():
+        print(json.dumps({"product": product_id, **product}), file=output_file)
+    print(json.dumps({"marketplace": market_config['marketplace']}), file=output_file)
+    for producer in market_config['producers']:
+        print(json.dumps({PRODUCER: producer}), file=output_file)
+    for consumer in market_config['consumers']:
+        carts = consumer.pop('carts')
+        print(json.dumps({CONSUMER: consumer}), file=output_file)
+        for cart in carts:
+            print(json.dumps({CART: cart}), file=output_file)
+
+
+def main():
+    """
+    Converts a tests/*.in file to the JSON-lines format
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help="the market configuration (tests/*.in)")
+    parser.add_argument("output", help="the *.jsonl file")
+    args = parser.parse_args()
+    with open(args.input, encoding="utf-8") as input_file:
+        market_config = loads(input_file.read())
+    with open(args.output, "w", encoding="utf-8") as output_file:
+        write_stream(market_config, output_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,8 @@ Assignment 1
 March 2022
 """
 from threading import Thread
-from time import sleep
+
+from tema.order_sink import PrintSink
 
 
 class Consumer(Thread):
@@ -17,7 +18,7 @@ class Consumer(Thread):
     # on add_to_cart(), remove_from_cart() and place_order()
     cart_id: int
 
-    def __init__(self, carts, marketplace, retry_wait_time, **kwargs):
+    def __init__(self, carts, marketplace, retry_wait_time, sink=None, **kwargs):
         """
         Constructor.
 
@@ -28,8 +29,11 @@ class Consumer(Thread):
         :param marketplace: a reference to the marketplace
 
         :type retry_wait_time: Time
-        :param retry_wait_time: the number of seconds that a producer must wait
-        until the Marketplace becomes available
+        :param retry_wait_time: the maximum number of seconds that a consumer waits
+        for a product before asking the Marketplace again
+
+        :type sink: OrderSink
+        :param sink: gets the placed orders, they are printed by default
 
         :type kwargs:
         :param kwargs: other arguments that are passed to the Thread's __init__()
@@ -42,31 +46,28 @@ class Consumer(Thread):
         self.carts_ops = carts
         # marketplace reference
         self.marketplace = marketplace
-        # if product is not found in queue, wait this time
+        # if product is not found in queue, wait at most this time for it
         self.retry_wait_time = retry_wait_time
+        # where the placed orders go
+        self.sink = PrintSink() if sink is None else sink
 
     def run(self):
+        # the marketplace synchronizes every call by itself
         for ops in self.carts_ops:
-            with self.marketplace.lock:
-                self.cart_id = self.marketplace.new_cart()
+            self.cart_id = self.marketplace.new_cart()
             # operation is a dictionary of type: ["type": "add", "product": "id2", "quantity": 1]
             for operation in ops:
                 if operation["type"] == "add":
-                    for _ in range(operation["quantity"]):
-                        with self.marketplace.lock:
-                            while True:
-                                is_ok = self.marketplace.add_to_cart(
-                                    self.cart_id, operation["product"])
-                                if is_ok is False:
-                                    sleep(self.retry_wait_time)
-                                else:
-                                    break
+                    # reserve as many units as possible at once, then wait for the rest
+                    # without holding any lock, publish() and remove_from_cart() wake us up
+                    remaining = operation["quantity"]
+                    while remaining > 0:
+                        remaining -= self.marketplace.add_many(
+                            self.cart_id, operation["product"], remaining,
+                            block=True, timeout=self.retry_wait_time)
                 elif operation["type"] == "remove":
-                    for _ in range(operation["quantity"]):
-                        with self.marketplace.lock:
-                            self.marketplace.remove_from_cart(self.cart_id, operation["product"])
+                    self.marketplace.remove_many(self.cart_id, operation["product"],
+                                                 operation["quantity"])
 
-            with self.marketplace.lock:
-                final_list = self.marketplace.place_order(self.cart_id)
-                for item in final_list:
-                    print(f"{self.name} bought {item}")
+            # place_order() released every lock, the sink doesn't hold any of them
+            self.sink.order(self.name, self.marketplace.place_order(self.cart_id))
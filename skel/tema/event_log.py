@@ -0,0 +1,267 @@
+"""
+This module represents the binary event log of the Marketplace and its decoder.
+
+Every event is a fixed-width record appended to the file, so the file can be
+memory-mapped and read without parsing text:
+    timestamp (double), op code (uint8), producer or cart id (uint32),
+    product id (uint32), result (int32)
+The products are interned, their repr is written once in a "<path>.products" file.
+The threads recording events only put them in a queue, a writer thread packs and
+writes them in batches, so the operations don't serialize on the log.
+
+Decode a log with: python3 -m tema.event_log marketplace.events [--json]
+
+Computer Systems Architecture Course
+Assignment 1
+March 2022
+"""
+import argparse
+import contextlib
+import json
+import mmap
+import os
+import queue
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+MAGIC = b"MKTEVT01"
+RECORD = struct.Struct("<dB3xIIi")
+# product id of the events that don't have a product
+NO_PRODUCT = 0xFFFFFFFF
+# the maximum number of events written at once by the writer thread
+BATCH_SIZE = 1024
+
+# op codes
+REGISTER_PRODUCER = 1
+PUBLISH = 2
+NEW_CART = 3
+ADD_TO_CART = 4
+REMOVE_FROM_CART = 5
+PLACE_ORDER = 6
+
+OP_NAMES = {REGISTER_PRODUCER: "register_producer", PUBLISH: "publish", NEW_CART: "new_cart",
+            ADD_TO_CART: "add_to_cart", REMOVE_FROM_CART: "remove_from_cart",
+            PLACE_ORDER: "place_order"}
+
+
+class TestEventLog(unittest.TestCase):
+    """
+    Class that represents the unit testing for the EventLog.
+    """
+
+    def test_decode(self):
+        """
+        Test that the decoder returns the recorded events
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "marketplace.events")
+            event_log = EventLog(path)
+            event_log.record(PUBLISH, 3, "id1", 1)
+            event_log.record(NEW_CART, 0, None, 0)
+            event_log.record(ADD_TO_CART, 0, "id1", 1)
+            event_log.close()
+
+            self.assertEqual(os.path.getsize(path), len(MAGIC) + 3 * RECORD.size)
+            events = [(event["op"], event["id"], event["product"], event["result"])
+                      for event in decode(path)]
+            self.assertEqual(events, [("publish", 3, "'id1'", 1),
+                                      ("new_cart", 0, None, 0),
+                                      ("add_to_cart", 0, "'id1'", 1)])
+
+    def test_threads(self):
+        """
+        Test that the events of concurrent threads are all written, in the order
+        every thread recorded them
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "marketplace.events")
+            event_log = EventLog(path)
+
+            def publish(producer_id):
+                for i in range(1000):
+                    event_log.record(PUBLISH, producer_id, f"id{i % 7}", i)
+
+            threads = [threading.Thread(target=publish, args=(i,)) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            event_log.close()
+            # ignored after the close
+            event_log.record(NEW_CART, 0, None, 0)
+
+            results = {}
+            for event in decode(path):
+                results.setdefault(event["id"], []).append(event["result"])
+            self.assertEqual(results, {i: list(range(1000)) for i in range(4)})
+
+
+class EventLog:
+    """
+    Class that appends the Marketplace events to a binary file.
+    """
+    # put in the queue by close() after the last event
+    STOP = None
+
+    def __init__(self, path, registry=None, clock=time.time):
+        """
+        Constructor.
+
+        :type path: String
+        :param path: the file of the events, the products go to path + ".products"
+
+        :type registry: ProductRegistry
+        :param registry: if given, the recorded products are ids from it and the
+        products file gets the product they stand for
+
+        :type clock: Callable
+        :param clock: returns the timestamp of an event, like the time of a simulation
+        """
+        self.path = path
+        self.registry = registry
+        self.clock = clock
+        # dictionary of type { product : product_id }, only used by the writer thread
+        self.product_ids = {}
+        # both files stay open until close()
+        self.files = contextlib.ExitStack()
+        self.events_file = self.files.enter_context(open(path, "wb", buffering=1 << 16))
+        self.events_file.write(MAGIC)
+        self.products_file = self.files.enter_context(
+            open(path + ".products", "w", encoding="utf-8"))
+        # the recorded events waiting for the writer, of type
+        # (timestamp, op_code, subject_id, product, result), then STOP
+        self.events = queue.SimpleQueue()
+        self.closed = False
+        self.writer = threading.Thread(target=self._write_events, name="EventLog",
+                                       daemon=True)
+        self.writer.start()
+
+    def _product_id(self, product):
+        """
+        Returns the interned id of the product, only called by the writer thread.
+        """
+        if product is None:
+            return NO_PRODUCT
+        product_id = self.product_ids.get(product)
+        if product_id is None:
+            product_id = self.product_ids[product] = len(self.product_ids)
+            if self.registry is not None:
+                product = self.registry.product(product)
+            print(json.dumps({"id": product_id, "product": repr(product)}),
+                  file=self.products_file)
+        return product_id
+
+    def record(self, op_code, subject_id, product, result):
+        """
+        Appends an event. Events recorded after close() are ignored.
+
+        :type op_code: Int
+        :param op_code: one of the op codes, like PUBLISH
+
+        :type subject_id: Int
+        :param subject_id: the producer id or the cart id
+
+        :type product: Product
+        :param product: the product of the operation or None
+
+        :type result: Int
+        :param result: what the operation returned, as an int
+        """
+        # the producers are daemon threads and may still publish after the close
+        if self.closed:
+            return
+        # SimpleQueue.put() doesn't take a lock shared with the other threads
+        self.events.put((self.clock(), op_code, subject_id, product, result))
+
+    def _write_events(self):
+        """
+        Packs and writes the queued events in batches, until close().
+        """
+        running = True
+        while running:
+            # wait for an event, then take whatever else is already queued
+            batch = [self.events.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.events.get_nowait())
+                except queue.Empty:
+                    break
+            records = []
+            for event in batch:
+                if event is self.STOP:
+                    running = False
+                    break
+                timestamp, op_code, subject_id, product, result = event
+                records.append(RECORD.pack(timestamp, op_code, subject_id,
+                                           self._product_id(product), result))
+            self.events_file.write(b"".join(records))
+
+    def close(self):
+        """
+        Writes the queued events, then flushes and closes the files. Events recorded
+        afterwards are ignored.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.events.put(self.STOP)
+        self.writer.join()
+        self.files.close()
+
+
+def decode(path):
+    """
+    Generates the events from the file as dictionaries.
+
+    :type path: String
+    :param path: the file written by an EventLog
+    """
+    products = {}
+    with open(path + ".products", encoding="utf-8") as products_file:
+        for line in products_file:
+            entry = json.loads(line)
+            products[entry["id"]] = entry["product"]
+
+    with open(path, "rb") as events_file:
+        if os.fstat(events_file.fileno()).st_size <= len(MAGIC):
+            return
+        with mmap.mmap(events_file.fileno(), 0, access=mmap.ACCESS_READ) as events:
+            if events[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{path} is not a marketplace event log")
+            # a record cut by a crash is ignored
+            end = len(MAGIC) + (len(events) - len(MAGIC)) // RECORD.size * RECORD.size
+            # unpack straight from the mapped pages, without copying the file
+            view = memoryview(events)[len(MAGIC):end]
+            records = RECORD.iter_unpack(view)
+            try:
+                for timestamp, op_code, subject_id, product_id, result in records:
+                    yield {"time": timestamp, "op": OP_NAMES[op_code], "id": subject_id,
+                           "product": products.get(product_id), "result": result}
+            finally:
+                del records
+                view.release()
+
+
+def main():
+    """
+    Prints the events from the file given in the command line as text or JSON lines.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="the file written by an EventLog")
+    parser.add_argument("--json", action="store_true", help="print JSON lines")
+    args = parser.parse_args()
+
+    for event in decode(args.path):
+        if args.json:
+            print(json.dumps(event))
+        else:
+            moment = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(event["time"]))
+            product = "" if event["product"] is None else f" product={event['product']}"
+            print(f"{moment} {event['op']}: id={event['id']}{product} ret={event['result']}")
+
+
+if __name__ == '__main__':
+    main()
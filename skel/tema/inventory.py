@@ -0,0 +1,289 @@
+"""
+This module represents the inventory of the Marketplace: how many units of every
+product are in every producer's queue.
+
+DictInventory keeps nested dictionaries and works with any hashable product.
+ArrayInventory keeps a producers x products matrix of ints in NumPy arrays, so the
+aggregate queries are vectorized; it needs the products interned by a ProductRegistry.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2022
+"""
+import threading
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    # only ArrayInventory needs it
+    numpy = None
+
+# how many producer rows are allocated at once by ArrayInventory
+BLOCK_SIZE = 256
+
+
+class TestInventory(unittest.TestCase):
+    """
+    Class that represents the unit testing for the inventories, run on DictInventory.
+    """
+
+    def new_inventory(self):
+        """
+        Returns the inventory under test, with 3 products
+        """
+        return DictInventory()
+
+    def test_add_remove(self):
+        """
+        Test the quantities and the occupancy after adding and removing units
+        """
+        inventory = self.new_inventory()
+        inventory.add_producer(0)
+        inventory.add(0, 1, 3)
+        self.assertEqual(inventory.quantity(0, 1), 3)
+        self.assertEqual(inventory.remove(0, 1, 2), 1)
+        self.assertEqual(inventory.occupancy_of(0), 1)
+        # producers that never published anything have nothing
+        self.assertEqual(inventory.occupancy_of(7), 0)
+
+    def test_aggregates(self):
+        """
+        Test the stock per product, the occupancy per producer and the full producers
+        """
+        inventory = self.new_inventory()
+        for producer_id in range(BLOCK_SIZE + 2):
+            inventory.add_producer(producer_id)
+        inventory.add(0, 0, 2)
+        inventory.add(BLOCK_SIZE + 1, 0, 1)
+        inventory.add(BLOCK_SIZE + 1, 2, 1)
+        stock = inventory.stock_by_product()
+        self.assertEqual((stock[0], stock[2]), (3, 1))
+        occupancy = inventory.occupancy_by_producer()
+        self.assertEqual((occupancy[0], occupancy[1], occupancy[BLOCK_SIZE + 1]), (2, 0, 2))
+        self.assertEqual(list(inventory.full_producers(2)), [0, BLOCK_SIZE + 1])
+
+
+@unittest.skipIf(numpy is None, "ArrayInventory needs numpy")
+class TestArrayInventory(TestInventory):
+    """
+    Class that represents the unit testing for the inventories, run on ArrayInventory.
+    """
+
+    def new_inventory(self):
+        return ArrayInventory(3)
+
+
+class DictInventory:
+    """
+    Class that keeps the inventory in dictionaries. It doesn't synchronize itself,
+    the Marketplace holds the product and the producer locks while changing it.
+    """
+    # nested dictionary of type:
+    # { "producer_id" : { "product_id" : qty } }
+    queue: dict
+    # dictionary of type:
+    # { "producer_id" : size }, where size = sum of the qtys from the producer's queue
+    occupancy: dict
+
+    def __init__(self):
+        self.queue = {}
+        self.occupancy = {}
+
+    def add_producer(self, producer_id):
+        """
+        Makes room for the producer, if it's the first time it's seen.
+
+        :type producer_id: Int
+        :param producer_id: producer id
+        """
+        if producer_id not in self.queue:
+            self.occupancy[producer_id] = 0
+            self.queue[producer_id] = {}
+
+    def quantity(self, producer_id, product):
+        """
+        Returns how many units of the product the producer has in its queue.
+        """
+        return self.queue.get(producer_id, {}).get(product, 0)
+
+    def occupancy_of(self, producer_id):
+        """
+        Returns how many products the producer has in its queue.
+        """
+        return self.occupancy.get(producer_id, 0)
+
+    def add(self, producer_id, product, count):
+        """
+        Puts count units of the product in the producer's queue.
+
+        :type producer_id: Int
+        :param producer_id: a producer passed to add_producer()
+
+        :type product: Product
+        :param product: the product
+
+        :type count: Int
+        :param count: how many units
+        """
+        products = self.queue[producer_id]
+        # check if the current product doesn't exist and add it with qty = count
+        if product not in products:
+            products[product] = count
+        # if it already exists just increment the qty
+        else:
+            products[product] += count
+        self.occupancy[producer_id] += count
+
+    def remove(self, producer_id, product, count):
+        """
+        Takes count units of the product out of the producer's queue.
+
+        :returns how many units of the product are left in the queue
+        """
+        products = self.queue[producer_id]
+        products[product] -= count
+        self.occupancy[producer_id] -= count
+        return products[product]
+
+    def stock_by_product(self):
+        """
+        Returns a dictionary of type { "product_id" : qty }, summed over all the producers.
+        """
+        stock = {}
+        for products in list(self.queue.values()):
+            for product, quantity in list(products.items()):
+                stock[product] = stock.get(product, 0) + quantity
+        return stock
+
+    def occupancy_by_producer(self):
+        """
+        Returns a dictionary of type { "producer_id" : size }.
+        """
+        return dict(self.occupancy)
+
+    def full_producers(self, queue_size_per_producer):
+        """
+        Returns the ids of the producers whose queue is full.
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum size of a queue
+        """
+        return [producer_id for producer_id, size in list(self.occupancy.items())
+                if size >= queue_size_per_producer]
+
+
+class ArrayInventory:
+    """
+    Class that keeps the inventory in NumPy arrays: a row of quantities per producer
+    and a column per product id. The rows are allocated in blocks of BLOCK_SIZE
+    producers that are never moved, so growing the inventory doesn't race with the
+    threads updating the existing rows. Like DictInventory, it's synchronized by
+    the Marketplace, except for the growth, which has its own lock.
+    """
+
+    def __init__(self, num_products):
+        """
+        Constructor
+
+        :type num_products: Int
+        :param num_products: how many products there are, the products are the ids
+        0 .. num_products - 1 given by a ProductRegistry
+        """
+        if numpy is None:
+            raise ImportError("ArrayInventory needs numpy")
+        self.num_products = num_products
+        # list of arrays of shape (BLOCK_SIZE, num_products), the quantities
+        self.blocks = []
+        # list of arrays of shape (BLOCK_SIZE,), the occupancy of every producer
+        self.occupancy = []
+        # the number of rows in use, 1 + the biggest producer id seen
+        self.rows = 0
+        self.grow_lock = threading.Lock()
+
+    def add_producer(self, producer_id):
+        """
+        Makes room for the producer, allocating new blocks if needed.
+
+        :type producer_id: Int
+        :param producer_id: producer id
+        """
+        if producer_id < self.rows:
+            return
+        with self.grow_lock:
+            while len(self.blocks) * BLOCK_SIZE <= producer_id:
+                self.blocks.append(numpy.zeros((BLOCK_SIZE, self.num_products), numpy.int64))
+                self.occupancy.append(numpy.zeros(BLOCK_SIZE, numpy.int64))
+            self.rows = max(self.rows, producer_id + 1)
+
+    def quantity(self, producer_id, product):
+        """
+        Returns how many units of the product the producer has in its queue.
+        """
+        if producer_id >= self.rows:
+            return 0
+        return int(self.blocks[producer_id // BLOCK_SIZE][producer_id % BLOCK_SIZE, product])
+
+    def occupancy_of(self, producer_id):
+        """
+        Returns how many products the producer has in its queue.
+        """
+        if producer_id >= self.rows:
+            return 0
+        return int(self.occupancy[producer_id // BLOCK_SIZE][producer_id % BLOCK_SIZE])
+
+    def add(self, producer_id, product, count):
+        """
+        Puts count units of the product in the producer's queue.
+
+        :type producer_id: Int
+        :param producer_id: a producer passed to add_producer()
+
+        :type product: Int
+        :param product: the product id
+
+        :type count: Int
+        :param count: how many units
+        """
+        block, row = divmod(producer_id, BLOCK_SIZE)
+        self.blocks[block][row, product] += count
+        self.occupancy[block][row] += count
+
+    def remove(self, producer_id, product, count):
+        """
+        Takes count units of the product out of the producer's queue.
+
+        :returns how many units of the product are left in the queue
+        """
+        block, row = divmod(producer_id, BLOCK_SIZE)
+        quantities = self.blocks[block]
+        quantities[row, product] -= count
+        self.occupancy[block][row] -= count
+        return int(quantities[row, product])
+
+    def stock_by_product(self):
+        """
+        Returns an array with the quantity of every product, summed over all the producers.
+        """
+        stock = numpy.zeros(self.num_products, numpy.int64)
+        for quantities in list(self.blocks):
+            stock += quantities.sum(axis=0)
+        return stock
+
+    def occupancy_by_producer(self):
+        """
+        Returns an array with the occupancy of every producer, indexed by producer id.
+        """
+        rows = self.rows
+        if not rows:
+            return numpy.zeros(0, numpy.int64)
+        return numpy.concatenate(list(self.occupancy))[:rows]
+
+    def full_producers(self, queue_size_per_producer):
+        """
+        Returns an array with the ids of the producers whose queue is full.
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum size of a queue
+        """
+        return numpy.flatnonzero(self.occupancy_by_producer() >= queue_size_per_producer)
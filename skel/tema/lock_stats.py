@@ -0,0 +1,345 @@
+"""
+This module represents the lock instrumentation of the Marketplace: how long every
+operation waits for the locks it takes and how long it holds them.
+
+An instrumented lock finds the Marketplace operation that takes it from the call
+stack and adds the durations to per-thread histograms with log2 buckets, so
+recording is a few integer operations and never takes another lock. Walking the
+stack is the expensive part, so the locks can time only a random sample of the
+acquires, one in sample_every, every sampled duration counting sample_every times.
+The Marketplace only uses instrumented locks when it's built with lock_stats, so
+the disabled mode costs nothing.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2022
+"""
+import logging
+import random
+import sys
+import threading
+import time
+import unittest
+
+# the Marketplace methods that name a call site, a method used by another one
+# counts for the operation the callers know
+SITES = {"register_producer": "register_producer", "publish": "publish",
+         "new_cart": "new_cart", "add_to_cart": "add_to_cart", "add_many": "add_to_cart",
+         "reserve": "add_to_cart", "reserve_many": "add_to_cart",
+         "remove_from_cart": "remove_from_cart",
+         "remove_many": "remove_from_cart", "place_order": "place_order"}
+# the call site of the locks taken outside of the operations, like stock_by_product()
+OTHER_SITE = "other"
+# how many frames are searched for a call site
+MAX_DEPTH = 8
+# one acquire in SAMPLE_EVERY is timed with test.py --lock-stats
+SAMPLE_EVERY = 8
+
+WAIT = "wait"
+HOLD = "hold"
+
+
+class TestLockStats(unittest.TestCase):
+    """
+    Class that represents the unit testing for the lock instrumentation.
+    """
+
+    def test_histogram(self):
+        """
+        Test that the percentiles are the upper bounds of the buckets
+        """
+        histogram = Histogram()
+        for duration in [1000] * 98 + [1000000] * 2:
+            histogram.add(duration)
+        summary = histogram.summary()
+        self.assertEqual(summary["count"], 100)
+        self.assertEqual(summary["p50_us"], 1.024)
+        self.assertEqual(summary["p99_us"], 1048.576)
+        self.assertEqual(summary["max_us"], 1000.0)
+
+    def test_call_sites(self):
+        """
+        Test that the durations go to the operation that takes the lock
+        """
+        stats = LockStats()
+        lock = instrument(threading.Lock(), stats)
+
+        def publish():
+            with lock:
+                time.sleep(0.01)
+
+        publish()
+        with lock:
+            pass
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot["publish"][WAIT]["count"], 1)
+        self.assertGreaterEqual(snapshot["publish"][HOLD]["max_us"], 10000)
+        self.assertEqual(snapshot[OTHER_SITE][HOLD]["count"], 1)
+
+    def test_condition(self):
+        """
+        Test that a Condition on an instrumented RLock doesn't count its wait as held
+        """
+        stats = LockStats()
+        lock = instrument(threading.RLock(), stats)
+        condition = threading.Condition(lock)
+
+        def new_cart():
+            with lock, condition:
+                condition.wait(0.05)
+
+        new_cart()
+        snapshot = stats.snapshot()
+        # held before and after the wait
+        self.assertEqual(snapshot["new_cart"][HOLD]["count"], 2)
+        self.assertLess(snapshot["new_cart"][HOLD]["max_us"], 50000)
+
+    def test_sampling(self):
+        """
+        Test that the sampled acquires count for the ones that are not timed
+        """
+        stats = LockStats(sample_every=4)
+        lock = instrument(threading.RLock(), stats)
+
+        def place_order():
+            for _ in range(1000):
+                with lock, lock:
+                    pass
+
+        place_order()
+        snapshot = stats.snapshot()
+        # about 250 samples, the nested acquires are never timed
+        self.assertEqual(snapshot["place_order"][HOLD]["count"] % 4, 0)
+        self.assertLess(abs(snapshot["place_order"][HOLD]["count"] - 1000), 400)
+        self.assertEqual(snapshot["place_order"][WAIT]["count"],
+                         snapshot["place_order"][HOLD]["count"])
+        self.assertFalse(lock.depth)
+
+
+class Histogram:
+    """
+    Class that represents a histogram of durations, in nanoseconds. Bucket i counts
+    the durations with i bits, the ones from [2 ** (i - 1), 2 ** i).
+    """
+
+    def __init__(self):
+        self.buckets = [0] * 65
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, duration, weight=1):
+        """
+        Adds a duration, in nanoseconds, weight times.
+        """
+        self.buckets[duration.bit_length()] += weight
+        self.count += weight
+        self.total += duration * weight
+        self.max = max(self.max, duration)
+
+    def merge(self, other):
+        """
+        Adds the durations of another histogram to this one.
+        """
+        self.buckets = [mine + theirs for mine, theirs in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the bucket holding the given fraction of the
+        durations, in nanoseconds.
+        """
+        rank = fraction * self.count
+        seen = 0
+        for bits, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return 1 << bits
+        return 0
+
+    def summary(self):
+        """
+        Returns a dictionary with the count, the total in milliseconds and the p50,
+        p99 and max in microseconds.
+        """
+        return {"count": self.count, "total_ms": self.total / 1e6,
+                "p50_us": self.percentile(0.5) / 1e3, "p99_us": self.percentile(0.99) / 1e3,
+                "max_us": self.max / 1e3}
+
+
+def call_site():
+    """
+    Returns the call site of a lock, the first Marketplace operation from the stack.
+    """
+    frame = sys._getframe(2)  # pylint: disable=protected-access
+    for _ in range(MAX_DEPTH):
+        if frame is None:
+            break
+        site = SITES.get(frame.f_code.co_name)
+        if site is not None:
+            return site
+        frame = frame.f_back
+    return OTHER_SITE
+
+
+class LockStats:
+    """
+    Class that represents the wait and hold histograms of every call site. Every
+    thread records in its own histograms, snapshot() merges them.
+    """
+
+    def __init__(self, sample_every=1):
+        """
+        Constructor.
+
+        :type sample_every: Int
+        :param sample_every: the locks time one acquire in sample_every, at random,
+        and every timed one counts sample_every times; 1 times all of them
+        """
+        self.sample_every = sample_every
+        self.local = threading.local()
+        # the histograms of every thread that recorded something, of type
+        # [ { (site, WAIT or HOLD) : Histogram } ]
+        self.threads = []
+        self.threads_lock = threading.Lock()
+
+    def record(self, site, kind, duration):
+        """
+        Adds a duration, in nanoseconds, to the histogram of the site.
+        """
+        histograms = getattr(self.local, "histograms", None)
+        if histograms is None:
+            histograms = self.local.histograms = {}
+            with self.threads_lock:
+                self.threads.append(histograms)
+        histogram = histograms.get((site, kind))
+        if histogram is None:
+            histogram = histograms[site, kind] = Histogram()
+        histogram.add(duration, self.sample_every)
+
+    def snapshot(self):
+        """
+        Returns the summaries of every call site, of type
+        { site : { WAIT : summary, HOLD : summary } }, see Histogram.summary().
+        The threads keep recording, so the numbers may be a little behind.
+        """
+        with self.threads_lock:
+            threads = list(self.threads)
+        merged = {}
+        for histograms in threads:
+            for (site, kind), histogram in list(histograms.items()):
+                merged.setdefault(site, {WAIT: Histogram(), HOLD: Histogram()})[kind] \
+                    .merge(histogram)
+        return {site: {kind: histogram.summary() for kind, histogram in kinds.items()}
+                for site, kinds in sorted(merged.items())}
+
+    def log(self):
+        """
+        Writes the snapshot to the log, a line for every call site.
+        """
+        for site, kinds in self.snapshot().items():
+            for kind, summary in kinds.items():
+                logging.info("lock %s %s: count=%s total_ms=%.3f p50_us=%s p99_us=%s "
+                             "max_us=%.1f", site, kind, summary["count"], summary["total_ms"],
+                             summary["p50_us"], summary["p99_us"], summary["max_us"])
+
+
+class InstrumentedLock:
+    """
+    Lock that records, for the call site that takes it, how long it waited for it
+    and how long it held it. Only the owner changes the hold fields, the site of a
+    hold that is not sampled is None.
+    """
+
+    def __init__(self, lock, stats):
+        """
+        Constructor.
+
+        :type lock: Lock
+        :param lock: the lock that is instrumented
+
+        :type stats: LockStats
+        :param stats: gets the durations
+        """
+        self.lock = lock
+        self.stats = stats
+        # how many times the owner holds the lock, more than once for an RLock
+        self.depth = 0
+        self.hold_start = 0
+        self.site = OTHER_SITE
+
+    def acquire(self, blocking=True, timeout=-1):
+        """
+        Acquires the lock, like Lock.acquire().
+        """
+        if self.stats.sample_every > 1 and random.random() * self.stats.sample_every >= 1:
+            if not self.lock.acquire(blocking, timeout):
+                return False
+            self.depth += 1
+            if self.depth == 1:
+                self.site = None
+            return True
+        site = call_site()
+        start = time.perf_counter_ns()
+        if not self.lock.acquire(blocking, timeout):
+            return False
+        self.depth += 1
+        if self.depth == 1:
+            self.hold_start = time.perf_counter_ns()
+            self.site = site
+            self.stats.record(site, WAIT, self.hold_start - start)
+        return True
+
+    def release(self):
+        """
+        Releases the lock.
+        """
+        self.depth -= 1
+        if self.depth == 0 and self.site is not None:
+            self.stats.record(self.site, HOLD, time.perf_counter_ns() - self.hold_start)
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class InstrumentedRLock(InstrumentedLock):
+    """
+    InstrumentedLock for an RLock. A Condition fully releases an RLock while it
+    waits, through the methods below, so the wait is not counted as held.
+    """
+
+    # pylint: disable=protected-access
+    def _is_owned(self):
+        return self.lock._is_owned()
+
+    def _release_save(self):
+        if self.site is not None:
+            self.stats.record(self.site, HOLD, time.perf_counter_ns() - self.hold_start)
+        state = (self.lock._release_save(), self.depth, self.site)
+        self.depth = 0
+        return state
+
+    def _acquire_restore(self, state):
+        lock_state, depth, site = state
+        start = time.perf_counter_ns()
+        self.lock._acquire_restore(lock_state)
+        self.hold_start = time.perf_counter_ns()
+        self.depth = depth
+        self.site = site
+        if site is not None:
+            self.stats.record(site, WAIT, self.hold_start - start)
+
+
+def instrument(lock, stats):
+    """
+    Returns the instrumented version of a Lock or an RLock.
+    """
+    if hasattr(lock, "_release_save"):
+        return InstrumentedRLock(lock, stats)
+    return InstrumentedLock(lock, stats)
@@ -0,0 +1,298 @@
+"""
+This module configures the logging of the Marketplace.
+
+In the queue mode, the threads calling logging.info() only put the record in a bounded
+queue and a background thread formats and writes the records in batches.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2022
+"""
+import atexit
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+import unittest
+from logging.handlers import QueueHandler, RotatingFileHandler
+
+# logging modes
+SYNC_LOGGING = "sync"
+QUEUE_LOGGING = "queue"
+
+# what to do with a record when the queue is full
+BLOCK_WHEN_FULL = "block"
+DROP_WHEN_FULL = "drop"
+
+LOG_FORMAT = '%(asctime)s %(levelname)s  - %(funcName)s: %(message)s'
+
+
+class TestLogWriter(unittest.TestCase):
+    """
+    Class that represents the unit testing for the queue logging.
+    """
+
+    def test_writes_every_record_on_stop(self):
+        """
+        Test that stop() flushes the records that are still in the queue
+        """
+        target = RecordingHandler()
+        writer = LogWriter(target, queue.Queue())
+        handler = BoundedQueueHandler(writer.records, BLOCK_WHEN_FULL)
+        writer.start()
+        for i in range(100):
+            handler.handle(logging.makeLogRecord({"msg": "record %s", "args": (i,)}))
+        writer.stop()
+        self.assertEqual(target.messages, [f"record {i}" for i in range(100)])
+        self.assertGreater(target.flushes, 0)
+
+    def test_nothing_logged_after_stop(self):
+        """
+        Test that the records logged after stop() don't go to stderr
+        """
+        root = logging.getLogger()
+        saved = root.handlers[:]
+        for handler in saved:
+            root.removeHandler(handler)
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                pipeline = setup_logging(SYNC_LOGGING, os.path.join(directory, "test.log"))
+                pipeline.stop()
+                logging.info("after stop")
+                self.assertEqual(root.handlers, [_STOPPED])
+                # and a new pipeline can be started
+                pipeline = setup_logging(SYNC_LOGGING, os.path.join(directory, "test.log"))
+                self.assertEqual(root.handlers, [pipeline.handler])
+                pipeline.stop()
+        finally:
+            for handler in root.handlers[:]:
+                root.removeHandler(handler)
+            for handler in saved:
+                root.addHandler(handler)
+
+    def test_drops_when_full(self):
+        """
+        Test that the drop policy never blocks and counts the dropped records
+        """
+        handler = BoundedQueueHandler(queue.Queue(maxsize=2), DROP_WHEN_FULL)
+        for i in range(5):
+            handler.handle(logging.makeLogRecord({"msg": "record %s", "args": (i,)}))
+        self.assertEqual(handler.dropped, 3)
+
+
+class RecordingHandler(logging.Handler):
+    """
+    Handler that keeps the messages in memory, used by the unit tests.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+        self.flushes = 0
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+    def flush(self):
+        self.flushes += 1
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler that doesn't flush after every record, the LogWriter flushes
+    it once per batch.
+    """
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        """
+        Flushes everything written since the last call
+        """
+        RotatingFileHandler.flush(self)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Handler that puts the records in a bounded queue, without formatting them.
+    """
+
+    def __init__(self, records, policy):
+        """
+        Constructor.
+
+        :type records: Queue
+        :param records: the queue read by the LogWriter
+
+        :type policy: String
+        :param policy: BLOCK_WHEN_FULL or DROP_WHEN_FULL
+        """
+        QueueHandler.__init__(self, records)
+        self.policy = policy
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the message is formatted by the writer, the hot path only enqueues it
+        return record
+
+    def enqueue(self, record):
+        if self.policy == BLOCK_WHEN_FULL:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogWriter(threading.Thread):
+    """
+    Background thread that writes the queued records to the target handler.
+    """
+    # put in the queue by stop() after the last record
+    STOP = None
+
+    def __init__(self, target, records, batch_size=1000):
+        """
+        Constructor.
+
+        :type target: Handler
+        :param target: the handler that formats and writes the records
+
+        :type records: Queue
+        :param records: the queue filled by the BoundedQueueHandler
+
+        :type batch_size: Int
+        :param batch_size: the maximum number of records written between two flushes
+        """
+        threading.Thread.__init__(self, name="LogWriter", daemon=True)
+        self.target = target
+        self.records = records
+        self.batch_size = batch_size
+
+    def run(self):
+        running = True
+        while running:
+            # wait for a record, then take whatever else is already queued
+            batch = [self.records.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is self.STOP:
+                    running = False
+                else:
+                    self.target.handle(record)
+            getattr(self.target, "flush_batch", self.target.flush)()
+
+    def stop(self):
+        """
+        Writes the records that are still queued and waits for the thread to finish.
+        """
+        self.records.put(self.STOP)
+        self.join()
+
+
+class LogPipeline:
+    """
+    The handlers installed on the root logger by setup_logging().
+    """
+
+    def __init__(self, handler, writer=None):
+        """
+        Constructor.
+
+        :type handler: Handler
+        :param handler: the handler installed on the root logger
+
+        :type writer: LogWriter
+        :param writer: the background writer in the queue mode, None in the sync mode
+        """
+        self.handler = handler
+        self.writer = writer
+
+    def stop(self):
+        """
+        Flushes and closes the log file. Records logged afterwards are ignored.
+        """
+        root = logging.getLogger()
+        if self.handler not in root.handlers:
+            return
+        root.removeHandler(self.handler)
+        # logging.info() would configure a stderr handler for a root logger without any
+        if not root.handlers:
+            root.addHandler(_STOPPED)
+        if self.writer is not None:
+            self.writer.stop()
+            if self.handler.dropped:
+                self.writer.target.handle(logging.makeLogRecord({
+                    "levelno": logging.WARNING, "levelname": "WARNING", "funcName": "stop",
+                    "msg": "dropped %s records, the log queue was full",
+                    "args": (self.handler.dropped,)}))
+            self.writer.target.close()
+        self.handler.close()
+
+
+# the pipeline configured by setup_logging(), there is at most one per process
+_PIPELINES = []
+# left on the root logger by LogPipeline.stop()
+_STOPPED = logging.NullHandler()
+
+
+def setup_logging(mode=QUEUE_LOGGING, filename='marketplace.log', buffer_size=100000,
+                  policy=BLOCK_WHEN_FULL):
+    """
+    Configures the root logger to write INFO records to a rotating log file.
+    Like logging.basicConfig(), only the first call configures anything.
+
+    :type mode: String
+    :param mode: SYNC_LOGGING to write from the calling thread or QUEUE_LOGGING
+    to write from a background thread
+
+    :type filename: String
+    :param filename: the log file, rotated every 100000 bytes with 30 backups
+
+    :type buffer_size: Int
+    :param buffer_size: the maximum number of queued records in the queue mode
+
+    :type policy: String
+    :param policy: BLOCK_WHEN_FULL or DROP_WHEN_FULL, in the queue mode
+
+    :returns the LogPipeline of the process or None if the root logger was
+    configured by somebody else
+    """
+    root = logging.getLogger()
+    if _PIPELINES and _PIPELINES[0].handler in root.handlers:
+        return _PIPELINES[0]
+    if root.handlers == [_STOPPED]:
+        # the previous pipeline was stopped, start a new one
+        root.removeHandler(_STOPPED)
+    if root.handlers:
+        # somebody else configured the logging
+        return None
+    if mode not in (SYNC_LOGGING, QUEUE_LOGGING):
+        raise ValueError(f"unknown logging mode {mode}")
+
+    logging.Formatter.converter = time.gmtime
+    if mode == SYNC_LOGGING:
+        handler = RotatingFileHandler(filename, maxBytes=100000, backupCount=30)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        pipeline = LogPipeline(handler)
+    else:
+        target = BatchRotatingFileHandler(filename, maxBytes=100000, backupCount=30)
+        target.setFormatter(logging.Formatter(LOG_FORMAT))
+        writer = LogWriter(target, queue.Queue(maxsize=buffer_size))
+        writer.start()
+        pipeline = LogPipeline(BoundedQueueHandler(writer.records, policy), writer)
+        # the writer is a daemon thread, don't lose what is still queued at exit
+        atexit.register(pipeline.stop)
+
+    root.addHandler(pipeline.handler)
+    root.setLevel(logging.INFO)
+    _PIPELINES[:] = [pipeline]
+    return pipeline
@@ -5,11 +5,26 @@ Computer Systems Architecture Course
 Assignment 1
 March 2022
 """
+import os
+import tempfile
 import threading
 import logging
 import time
 import unittest
-from logging.handlers import RotatingFileHandler
+import urllib.request
+from collections import Counter, deque
+
+from tema.log_writer import setup_logging, QUEUE_LOGGING
+from tema import event_log as events
+from tema.product import ProductRegistry, Tea, Coffee
+from tema.inventory import DictInventory, ArrayInventory, numpy
+from tema.selection import STRATEGIES, FIRST_FIT, ROUND_ROBIN, Holders
+from tema.lock_stats import LockStats, instrument, WAIT, HOLD
+from tema import metrics as counters
+
+# locking modes of the Marketplace, see the Synchronization section from the README
+GLOBAL_LOCK = "global"
+STRIPED_LOCKS = "striped"
 
 
 class TestMarketplaceMethods(unittest.TestCase):
@@ -45,6 +60,39 @@ class TestMarketplaceMethods(unittest.TestCase):
         # should be False because queue is full
         self.assertEqual(self.marketplace.publish("0", "id1"), False)
 
+    def test_queue_occupancy(self):
+        """
+        Test the queue_occupancy func
+        """
+        # unknown producers have an empty queue
+        self.assertEqual(self.marketplace.queue_occupancy(0), 0)
+        self.marketplace.publish(0, "id1")
+        self.marketplace.publish(0, "id2")
+        self.assertEqual(self.marketplace.queue_occupancy(0), 2)
+        self.marketplace.new_cart()
+        self.marketplace.add_to_cart(0, "id1")
+        self.assertEqual(self.marketplace.queue_occupancy(0), 1)
+        self.marketplace.remove_from_cart(0, "id1")
+        self.assertEqual(self.marketplace.queue_occupancy(0), 2)
+
+    def test_publish_blocking(self):
+        """
+        Test that a blocking publish waits for a slot in the producer's queue
+        """
+        for _ in range(8):
+            self.marketplace.publish(0, "id1")
+        # nobody buys anything, so it should give up after the timeout
+        self.assertEqual(self.marketplace.publish(0, "id1", block=True, timeout=0.01), False)
+        results = []
+        producer = threading.Thread(target=lambda: results.append(
+            self.marketplace.publish(0, "id2", block=True, timeout=5)))
+        producer.start()
+        self.marketplace.new_cart()
+        self.marketplace.add_to_cart(0, "id1")
+        producer.join()
+        self.assertEqual(results, [True])
+        self.assertEqual(self.marketplace.queue_occupancy(0), 8)
+
     def test_new_cart(self):
         """
         Test the new_cart func
@@ -68,6 +116,38 @@ class TestMarketplaceMethods(unittest.TestCase):
         self.marketplace.publish("0", "id1")
         # now should work with product published above
         self.assertEqual(self.marketplace.add_to_cart(0, "id1"), True)
+        # the only unit was taken, so there is nothing left to add
+        self.assertEqual(self.marketplace.add_to_cart(0, "id1"), False)
+
+    def test_available_index(self):
+        """
+        Test that the product index follows the stock of every producer
+        """
+        self.marketplace.publish(0, "id1")
+        self.marketplace.publish(1, "id1")
+        self.assertEqual(list(self.marketplace.available["id1"]), [0, 1])
+        self.marketplace.new_cart()
+        self.marketplace.add_to_cart(0, "id1")
+        # producer 0 is out of stock and must not be picked anymore
+        self.assertEqual(list(self.marketplace.available["id1"]), [1])
+        self.marketplace.remove_from_cart(0, "id1")
+        self.assertEqual(set(self.marketplace.available["id1"]), {0, 1})
+
+    def test_add_to_cart_blocking(self):
+        """
+        Test that a blocking add_to_cart waits for the product to be published
+        """
+        self.marketplace.new_cart()
+        # nobody publishes id1, so it should give up after the timeout
+        self.assertEqual(self.marketplace.add_to_cart(0, "id1", block=True, timeout=0.01), False)
+        results = []
+        consumer = threading.Thread(target=lambda: results.append(
+            self.marketplace.add_to_cart(0, "id1", block=True, timeout=5)))
+        consumer.start()
+        self.marketplace.publish(0, "id1")
+        consumer.join()
+        self.assertEqual(results, [True])
+        self.assertEqual(self.marketplace.carts[0], {"id1": Counter({0: 1})})
 
     def test_remove_from_cart(self):
         """
@@ -85,8 +165,61 @@ class TestMarketplaceMethods(unittest.TestCase):
         self.marketplace.add_to_cart(0, "id1")
         # remove one
         self.marketplace.remove_from_cart(0, "id2")
-        # len of cart should be 2
-        self.assertEqual(len(self.marketplace.carts[0]) == 2, True)
+        # the cart keeps the 2 units of id1, both reserved from producer "0"
+        self.assertEqual(self.marketplace.reservations(0), {"id1": {"0": 2}})
+        # the last one removed drops the product from the cart
+        self.assertNotIn("id2", self.marketplace.carts[0])
+
+    def test_remove_returns_to_owner(self):
+        """
+        Test that a removed product goes back only to the producer it was taken from
+        """
+        self.marketplace.publish(0, "id1")
+        self.marketplace.new_cart()
+        self.marketplace.add_to_cart(0, "id1")
+        for _ in range(8):
+            self.marketplace.publish(1, "id1")
+        self.marketplace.add_to_cart(0, "id1")
+        self.assertEqual(self.marketplace.reservations(0), {"id1": {0: 1, 1: 1}})
+        self.marketplace.remove_many(0, "id1", 2)
+        # producer 1 is full again, it didn't get the unit of producer 0
+        self.assertEqual(self.marketplace.queue_occupancy(0), 1)
+        self.assertEqual(self.marketplace.queue_occupancy(1), 8)
+        self.assertEqual(self.marketplace.reservations(0), {})
+
+    def test_add_many(self):
+        """
+        Test the add_many and remove_many funcs
+        """
+        self.marketplace.publish(0, "id1")
+        self.marketplace.publish(1, "id1")
+        self.marketplace.publish(1, "id1")
+        self.marketplace.new_cart()
+        # only 3 units are available, best-effort takes them all
+        self.assertEqual(self.marketplace.add_many(0, "id1", 5), 3)
+        self.assertEqual(self.marketplace.queue_occupancy(0), 0)
+        self.assertEqual(self.marketplace.queue_occupancy(1), 0)
+        self.assertEqual(self.marketplace.add_many(0, "id1", 2, block=True, timeout=0.01), 0)
+        self.marketplace.remove_many(0, "id1", 2)
+        # the last units reserved go back first, to the producer they came from
+        self.assertEqual(self.marketplace.carts[0], {"id1": Counter({0: 1})})
+        self.assertEqual(self.marketplace.queue_occupancy(0), 0)
+        self.assertEqual(self.marketplace.queue_occupancy(1), 2)
+
+    def test_apply_operations(self):
+        """
+        Test the apply_operations func
+        """
+        for _ in range(3):
+            self.marketplace.publish(0, "id1")
+        self.marketplace.new_cart()
+        self.assertEqual(self.marketplace.apply_operations(0, [
+            {"type": "add", "product": "id1", "quantity": 3},
+            {"type": "remove", "product": "id1", "quantity": 1}]), True)
+        self.assertEqual(self.marketplace.carts[0], {"id1": Counter({0: 2})})
+        # only 1 unit is left, so the second add can't be completed
+        self.assertEqual(self.marketplace.apply_operations(0, [
+            {"type": "add", "product": "id1", "quantity": 2}], timeout=0.01), False)
 
     def test_place_order(self):
         """
@@ -106,51 +239,362 @@ class TestMarketplaceMethods(unittest.TestCase):
         self.assertEqual(self.marketplace.place_order(0), ['id1', 'id2', 'id3'])
 
 
-class Marketplace:
+class TestMarketplaceOptions(unittest.TestCase):
+    """
+    Class that represents the unit testing for the options of the Marketplace: the
+    locking modes, the selection strategies, the inventories and the instrumentation.
+    """
+
+    def setUp(self):
+        """
+        Constructor for setting up the tests
+        Initialize the marketplace with queue_limit = 8
+        """
+        self.marketplace = Marketplace(8)
+
+    def test_locking_modes(self):
+        """
+        Test that the global mode shares one lock and the striped mode doesn't
+        """
+        marketplace = Marketplace(8, locking=GLOBAL_LOCK)
+        marketplace.publish(0, "id1")
+        marketplace.publish(1, "id2")
+        self.assertIs(marketplace.product_locks["id1"], marketplace.product_locks["id2"])
+        self.assertIs(marketplace.producer_locks[0], marketplace.lock)
+        self.marketplace.publish(0, "id1")
+        self.marketplace.publish(1, "id2")
+        self.assertIsNot(self.marketplace.product_locks["id1"],
+                         self.marketplace.product_locks["id2"])
+        self.assertIsNot(self.marketplace.producer_locks[0], self.marketplace.producer_locks[1])
+        with self.assertRaises(ValueError):
+            Marketplace(8, locking="none")
+
+    def test_selection(self):
+        """
+        Test that the selection strategy chooses the producer of every unit
+        """
+        marketplace = Marketplace(8, selection=ROUND_ROBIN)
+        for producer_id in range(3):
+            marketplace.publish(producer_id, "id1")
+            marketplace.publish(producer_id, "id1")
+        cart_id = marketplace.new_cart()
+        taken = [marketplace.reserve(cart_id, "id1") for _ in range(4)]
+        self.assertEqual(taken, [0, 1, 2, 0])
+        self.assertEqual(marketplace.reserve_many(cart_id, "id1", 3), [1, 2])
+        self.assertRaises(ValueError, Marketplace, 8, selection="cheapest")
+
+    def test_place_order_frees_cart(self):
+        """
+        Test that place_order frees the cart and keeps a bounded history of orders
+        """
+        marketplace = Marketplace(8, order_history=2)
+        for i in range(3):
+            marketplace.publish(0, "id1")
+            cart_id = marketplace.new_cart()
+            marketplace.add_to_cart(cart_id, "id1")
+            self.assertEqual(marketplace.place_order(cart_id), ["id1"])
+            self.assertNotIn(cart_id, marketplace.carts)
+            self.assertNotIn(cart_id, marketplace.cart_locks)
+            # cart ids are never reused
+            self.assertEqual(cart_id, i)
+        self.assertEqual(marketplace.recent_orders(), [(1, ["id1"]), (2, ["id1"])])
+
+    def test_event_log(self):
+        """
+        Test that every operation is recorded in the event log
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "marketplace.events")
+            marketplace = Marketplace(8, event_log=events.EventLog(path))
+            producer_id = marketplace.register_producer()
+            marketplace.publish(producer_id, "id1")
+            cart_id = marketplace.new_cart()
+            marketplace.add_to_cart(cart_id, "id1")
+            marketplace.remove_from_cart(cart_id, "id1")
+            marketplace.place_order(cart_id)
+            marketplace.event_log.close()
+            self.assertEqual([(event["op"], event["result"]) for event in events.decode(path)],
+                             [("register_producer", 0), ("publish", 1), ("new_cart", 0),
+                              ("add_to_cart", 1), ("remove_from_cart", 1),
+                              ("place_order", 0)])
+
+    def test_registry(self):
+        """
+        Test that the interned products are keyed by id and materialized by place_order
+        """
+        registry = ProductRegistry()
+        tea = registry.intern(Tea("Linden", 9, "Herbal"))
+        coffee = registry.intern(Coffee("Arabica", 10, "5.02", "MEDIUM"))
+        self.assertEqual((tea, coffee, registry.intern(Tea("Linden", 9, "Herbal"))), (0, 1, 0))
+        marketplace = Marketplace(8, registry=registry)
+        marketplace.publish(0, tea)
+        marketplace.publish(0, coffee)
+        self.assertEqual(marketplace.inventory.queue[0], {0: 1, 1: 1})
+        cart_id = marketplace.new_cart()
+        marketplace.add_to_cart(cart_id, coffee)
+        self.assertEqual(marketplace.place_order(cart_id),
+                         [Coffee("Arabica", 10, "5.02", "MEDIUM")])
+
+    def test_lock_stats(self):
+        """
+        Test that every operation records its lock waits and holds, in both modes
+        """
+        self.assertEqual(self.marketplace.stats(), {})
+        # the holds of add_many(), counted instead of timed: the wait on the condition
+        # releases the product lock, so it's held twice, and the striped mode takes
+        # the producer and the cart locks and ids_lock too
+        for locking, add_holds in [(GLOBAL_LOCK, 4), (STRIPED_LOCKS, 6)]:
+            marketplace = Marketplace(8, locking=locking, lock_stats=True)
+            producer_id = marketplace.register_producer()
+            marketplace.publish(producer_id, "id1")
+            cart_id = marketplace.new_cart()
+            # waits on the condition of the product, which is not a lock hold
+            marketplace.add_many(cart_id, "id1", 2, block=True, timeout=0.05)
+            marketplace.remove_from_cart(cart_id, "id1")
+            marketplace.place_order(cart_id)
+            stats = marketplace.stats()
+            self.assertLessEqual({"register_producer", "publish", "new_cart", "add_to_cart",
+                                  "remove_from_cart", "place_order"}, set(stats))
+            for kinds in stats.values():
+                self.assertEqual(kinds[WAIT]["count"], kinds[HOLD]["count"])
+            self.assertEqual(stats["add_to_cart"][HOLD]["count"], add_holds)
+
+    def test_metrics(self):
+        """
+        Test that the operations are counted and served with the inventory gauges
+        """
+        marketplace = Marketplace(1, metrics=True)
+        marketplace.publish(0, "id1")
+        marketplace.publish(0, "id1")
+        marketplace.publish(1, "id2")
+        cart_id = marketplace.new_cart()
+        self.assertEqual(marketplace.add_many(cart_id, "id1", 2), 1)
+        marketplace.remove_from_cart(cart_id, "id1")
+        self.assertEqual(marketplace.metrics.snapshot(), [2, 1, 1, 1, 1, 0])
+        server = counters.MetricsServer(marketplace)
+        try:
+            with urllib.request.urlopen(server.url) as response:
+                text = response.read().decode()
+        finally:
+            server.stop()
+        for line in ['marketplace_publishes_total{result="rejected"} 1',
+                     "marketplace_add_retries_total 1",
+                     'marketplace_producer_occupancy{producer="1"} 1',
+                     "marketplace_open_carts 1",
+                     'marketplace_product_stock{product="id1"} 1']:
+            self.assertIn(line, text.splitlines())
+
+    @unittest.skipIf(numpy is None, "ArrayInventory needs numpy")
+    def test_array_inventory(self):
+        """
+        Test the marketplace and its snapshot queries on the array inventory
+        """
+        marketplace = Marketplace(2, inventory=ArrayInventory(3))
+        # the rows are allocated when the producers register, not by publish
+        self.assertEqual([marketplace.register_producer() for _ in range(2)], [0, 1])
+        self.assertEqual(marketplace.inventory.rows, 2)
+        marketplace.publish(0, 1)
+        marketplace.publish(0, 1)
+        marketplace.publish(1, 2)
+        self.assertEqual(marketplace.publish(0, 2), False)
+        cart_id = marketplace.new_cart()
+        marketplace.add_to_cart(cart_id, 1)
+        self.assertEqual(list(marketplace.stock_by_product()), [0, 1, 1])
+        self.assertEqual(list(marketplace.occupancy_by_producer()), [1, 1])
+        marketplace.remove_from_cart(cart_id, 1)
+        self.assertEqual(list(marketplace.full_producers()), [0])
+
+
+# the locks, the indexes and the optional instrumentation are all read on the hot
+# paths, grouping them in other objects would only add a lookup to every operation
+class Marketplace:  # pylint: disable=too-many-instance-attributes
     """
     Class that represents the Marketplace. It's the central part of the implementation.
     The producers and consumers use its methods concurrently.
+
+    Every method synchronizes itself. In the STRIPED_LOCKS mode there is a lock for
+    every producer queue, for every product (guarding its entry from the available
+    index) and for every cart. When more than one is needed they are taken in the
+    order: product lock, then producer lock. Cart locks and ids_lock are never held
+    together with another lock, except for ids_lock being taken briefly to create a
+    missing lock. In the GLOBAL_LOCK mode all of them are the same reentrant lock.
     """
     # generate an id for every producer that calls register_producer()
     producer_ids: int
-    # nested dictionary of type:
-    # { "producer_id" : { "product_id" : qty } }
-    queue: dict
+    # how many units of every product are in every producer's queue, a DictInventory
+    # or an ArrayInventory from tema/inventory.py
+    inventory: object
+    # reverse index of type:
+    # { "product_id" : Holders }, the ordered set of the producers that currently
+    # have the product in stock (qty > 0), see tema/selection.py
+    available: dict
 
-    # dictionary of type:
-    # { "cart_id" : [] }, where [] = list of products from the cart
+    # nested dictionary of type:
+    # { "cart_id" : { "product_id" : Counter } }, where Counter = { "producer_id" : qty }
+    # tells how many units of the product from the cart were taken from every producer,
+    # the cart is dropped when its order is placed
     carts: dict
     cart_ids: int
 
-    def __init__(self, queue_size_per_producer):
+    def __init__(self, queue_size_per_producer, *, locking=STRIPED_LOCKS,
+                 log_mode=QUEUE_LOGGING, event_log=None, registry=None, inventory=None,
+                 order_history=0, selection=FIRST_FIT, lock_stats=False, metrics=False):
         """
-        Constructor
+        Constructor, the options after queue_size_per_producer are keyword-only.
 
         :type queue_size_per_producer: Int
         :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type locking: String
+        :param locking: GLOBAL_LOCK to serialize every operation on a single lock or
+        STRIPED_LOCKS to use a lock per producer queue, per product and per cart
+
+        :type log_mode: String
+        :param log_mode: SYNC_LOGGING to write the log from the calling thread or
+        QUEUE_LOGGING to only enqueue the records and write them from a background thread
+
+        :type event_log: EventLog
+        :param event_log: if given, every operation is also recorded in this binary log,
+        closed by shutdown()
+
+        :type registry: ProductRegistry
+        :param registry: if given, the products are passed as their integer ids from it
+        and place_order() turns them back into products
+
+        :type inventory: DictInventory
+        :param inventory: where the quantities are kept, a new DictInventory by default
+        or an ArrayInventory for interned products
+
+        :type order_history: Int
+        :param order_history: how many of the last placed orders are kept for
+        recent_orders(), the older ones are evicted
+
+        :type selection: String
+        :param selection: how add_to_cart chooses between the producers that have the
+        product, one of the names from tema/selection.py, like FIRST_FIT, or a
+        function (holders, inventory, queue_size) -> producer_id
+
+        :type lock_stats: Bool or Int
+        :param lock_stats: if True, every operation records how long it waits for the
+        locks and how long it holds them, see stats(); the log gets them at shutdown().
+        An Int N only times one acquire in N, see LockStats
+
+        :type metrics: Bool
+        :param metrics: if True, the operations are counted in a Metrics from
+        tema/metrics.py, served with the inventory gauges by a MetricsServer
         """
+        if locking not in (GLOBAL_LOCK, STRIPED_LOCKS):
+            raise ValueError(f"unknown locking mode {locking}")
+        if isinstance(selection, str) and selection not in STRATEGIES:
+            raise ValueError(f"unknown selection strategy {selection}")
         self.queue_size_per_producer = queue_size_per_producer
         self.producer_ids = 0
-        self.queue = {}
+        self.inventory = DictInventory() if inventory is None else inventory
+        self.available = {}
+        self.select = STRATEGIES[selection] if isinstance(selection, str) else selection
         self.carts = {}
         self.cart_ids = 0
-        self.lock = threading.Lock()
-        self.handler = RotatingFileHandler('marketplace.log', maxBytes=100000, backupCount=30)
-        logging.basicConfig(handlers=[self.handler], level=logging.INFO,
-                            format='%(asctime)s %(levelname)s '
-                                   ' - %(funcName)s: %(message)s')
-        logging.Formatter.converter = time.gmtime
+        # the last order_history orders, of type (cart_id, list of products)
+        self.orders = deque(maxlen=order_history)
+        self.locking = locking
+        self.lock_stats = LockStats(int(lock_stats)) if lock_stats else None
+        # in the global mode every lock from below is this one, so it is reentrant
+        self.lock = self._instrumented(threading.RLock())
+        # guards the id generators and the creation of new locks
+        self.ids_lock = self._new_lock()
+        # dictionaries of type { "key" : lock }, filled lazily
+        self.producer_locks = {}
+        self.product_locks = {}
+        self.cart_locks = {}
+        # dictionary of type { "product_id" : Condition }, built on the product locks
+        # and notified every time a unit of the product becomes available
+        self.product_conditions = {}
+        # dictionary of type { "producer_id" : Condition }, built on the producer locks
+        # and notified every time a slot from the producer's queue is freed
+        self.producer_conditions = {}
+        self.log_pipeline = setup_logging(log_mode)
+        self.event_log = event_log
+        self.registry = registry
+        self.metrics = counters.Metrics() if metrics else None
+
+    def _new_lock(self):
+        """
+        Returns a fresh lock in the striped mode or the marketplace lock in the global one.
+        """
+        if self.locking == STRIPED_LOCKS:
+            return self._instrumented(threading.Lock())
+        return self.lock
+
+    def _instrumented(self, lock):
+        """
+        Returns the lock itself, or its instrumented version with lock_stats.
+        """
+        if self.lock_stats is None:
+            return lock
+        return instrument(lock, self.lock_stats)
+
+    def _holders_of(self, product):
+        """
+        Returns the Holders of the product from the available index, creating them
+        the first time. The caller must hold the product lock.
+        """
+        holders = self.available.get(product)
+        if holders is None:
+            holders = self.available[product] = Holders()
+        return holders
+
+    def _lock_of(self, locks, key):
+        """
+        Returns the lock of key from locks, creating it the first time it's needed.
+
+        :type locks: Dict
+        :param locks: one of producer_locks, product_locks or cart_locks
+
+        :type key: Any
+        :param key: the producer id, product or cart id that is guarded
+        """
+        lock = locks.get(key)
+        if lock is None:
+            with self.ids_lock:
+                lock = locks.setdefault(key, self._new_lock())
+        return lock
+
+    def _condition_of(self, conditions, locks, key):
+        """
+        Returns the condition of key from conditions, bound to its lock from locks.
+
+        :type conditions: Dict
+        :param conditions: product_conditions or producer_conditions
+
+        :type locks: Dict
+        :param locks: the matching product_locks or producer_locks
+
+        :type key: Any
+        :param key: the product or producer id that is waited for
+        """
+        condition = conditions.get(key)
+        if condition is None:
+            lock = self._lock_of(locks, key)
+            with self.ids_lock:
+                condition = conditions.setdefault(key, threading.Condition(lock))
+        return condition
 
     def register_producer(self):
         """
         Returns an id for the producer that calls this.
         """
-        producer_id = self.producer_ids
-        self.producer_ids += 1
+        with self.ids_lock:
+            producer_id = self.producer_ids
+            self.producer_ids += 1
+        # make room for its queue now, so publish() never grows the inventory for it
+        with self._lock_of(self.producer_locks, producer_id):
+            self.inventory.add_producer(producer_id)
         logging.info("registered producer")
+        if self.event_log is not None:
+            self.event_log.record(events.REGISTER_PRODUCER, producer_id, None, 0)
         return producer_id
 
-    def publish(self, producer_id, product):
+    def publish(self, producer_id, product, block=False, timeout=None):
         """
         Adds the product provided by the producer to the marketplace
 
@@ -160,41 +604,92 @@ class Marketplace:
         :type product: Product
         :param product: the Product that will be published in the Marketplace
 
+        :type block: Bool
+        :param block: if True and the producer's queue is full, wait until a consumer
+        takes a product out of it
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to block, None means forever
+
         :returns True or False. If the caller receives False, it should wait and then try again.
         """
         logging.info("start func with producer_id=%s, product=%s", producer_id, product)
-        # if producer_id is the first time in the marketplace, it needs a new entry
-        if producer_id not in self.queue:
-            self.queue[producer_id] = {}
-        # products is a dictionary of type { "product_id" : qty}
-        products = self.queue[producer_id]
-        # check if it didn't cross the limit by summing up the qtys
-        current_size = sum(products.values())
-        if current_size < self.queue_size_per_producer:
-            # check if the current product doesn't exist and add it with qty = 1
-            if product not in products:
-                products[product] = 1  # product is product_id and 1 represents the qty
-            # if it already exists just increment the qty
-            else:
-                products[product] += 1
-            logging.info("exit func ret=True")
-            return True
-        logging.info("exit func ret=False")
-        return False
+        if block:
+            # wait before taking the product lock, add_to_cart() needs it to free a slot
+            has_space = self._condition_of(self.producer_conditions, self.producer_locks,
+                                           producer_id)
+            with has_space:
+                has_space.wait_for(lambda: self.queue_occupancy(producer_id)
+                                   < self.queue_size_per_producer, timeout)
+        in_stock = self._condition_of(self.product_conditions, self.product_locks, product)
+        with in_stock, self._lock_of(self.producer_locks, producer_id):
+            # a registered producer already has its entry, this only makes one for the
+            # ids registered elsewhere, like the ones of the shards of a
+            # ShardedMarketplace
+            self.inventory.add_producer(producer_id)
+            # check if it didn't cross the limit
+            is_ok = self.inventory.occupancy_of(producer_id) < self.queue_size_per_producer
+            if is_ok:
+                self.inventory.add(producer_id, product, 1)
+                # the producer has stock for it now, so make it visible in the index
+                self._holders_of(product)[producer_id] = None
+                # and wake up a consumer waiting for it
+                in_stock.notify()
+        logging.info("exit func ret=%s", is_ok)
+        if self.event_log is not None:
+            self.event_log.record(events.PUBLISH, producer_id, product, int(is_ok))
+        if self.metrics is not None:
+            self.metrics.add(counters.PUBLISHED if is_ok else counters.REJECTED)
+        return is_ok
+
+    def queue_occupancy(self, producer_id):
+        """
+        Returns how many products the producer currently has in its queue.
+
+        :type producer_id: String
+        :param producer_id: producer id
+        """
+        return self.inventory.occupancy_of(producer_id)
+
+    def stock_by_product(self):
+        """
+        Returns how many units of every product are in the producers' queues, indexed
+        by product. It doesn't take any lock, so it's only a snapshot that may be
+        slightly out of date, which is enough for monitoring.
+        """
+        return self.inventory.stock_by_product()
+
+    def occupancy_by_producer(self):
+        """
+        Returns the occupancy of every producer's queue, indexed by producer id.
+        Like stock_by_product(), it's a snapshot taken without locks.
+        """
+        return self.inventory.occupancy_by_producer()
+
+    def full_producers(self):
+        """
+        Returns the ids of the producers whose queue is full.
+        Like stock_by_product(), it's a snapshot taken without locks.
+        """
+        return self.inventory.full_producers(self.queue_size_per_producer)
 
     def new_cart(self):
         """
-        Creates a new cart for the consumer
+        Creates a new cart for the consumer. The ids are never reused, so a stale id
+        of a placed order can't reach a newer cart.
 
         :returns an int representing the cart_id
         """
-        cart_id = self.cart_ids
-        self.carts[cart_id] = []
-        self.cart_ids += 1
+        with self.ids_lock:
+            cart_id = self.cart_ids
+            self.carts[cart_id] = {}
+            self.cart_ids += 1
         logging.info("created new cart")
+        if self.event_log is not None:
+            self.event_log.record(events.NEW_CART, cart_id, None, 0)
         return cart_id
 
-    def add_to_cart(self, cart_id, product):
+    def add_to_cart(self, cart_id, product, block=False, timeout=None):
         """
         Adds a product to the given cart. The method returns
 
@@ -204,23 +699,128 @@ class Marketplace:
         :type product: Product
         :param product: the product to add to cart
 
+        :type block: Bool
+        :param block: if True and the product is not available, wait until a producer
+        publishes it or another consumer removes it from its cart
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to block, None means forever
+
         :returns True or False. If the caller receives False, it should wait and then try again
         """
+        return self.reserve(cart_id, product, block, timeout) is not None
+
+    def reserve(self, cart_id, product, block=False, timeout=None):
+        """
+        Same as add_to_cart, but tells which producer the product was taken from.
+
+        :returns the producer_id or None if the product couldn't be added to the cart
+        """
         logging.info("start func with cart_id=%s, product=%s", cart_id, product)
-        # is there this product with qty != 0?
-        # if yes, add it then decrement the qty
+        taken = self._reserve_many(cart_id, product, 1, block, timeout)
+        producer_id = taken[0] if taken else None
+        logging.info("exit func with ret=%s", producer_id)
+        return producer_id
+
+    def add_many(self, cart_id, product, quantity, block=False, timeout=None):
+        """
+        Adds up to quantity units of a product to the given cart, taking the product lock
+        once for all of them instead of once per unit.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product: Product
+        :param product: the product to add to cart
+
+        :type quantity: Int
+        :param quantity: how many units to add
+
+        :type block: Bool
+        :param block: if True, keep waiting for new units until all of them are added
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to block, None means forever
+
+        :returns how many units were added. The ones that were added stay in the cart,
+        the caller should wait and then try again for the rest.
+        """
+        logging.info("start func with cart_id=%s, product=%s, quantity=%s",
+                     cart_id, product, quantity)
+        added = len(self._reserve_many(cart_id, product, quantity, block, timeout))
+        logging.info("exit func with ret=%s", added)
+        return added
+
+    def reserve_many(self, cart_id, product, quantity, block=False, timeout=None):
+        """
+        Same as add_many, but tells which producers the units were taken from.
+
+        :returns a list with the producer_id of every unit that was added
+        """
+        logging.info("start func with cart_id=%s, product=%s, quantity=%s",
+                     cart_id, product, quantity)
+        taken = self._reserve_many(cart_id, product, quantity, block, timeout)
+        logging.info("exit func with ret=%s", taken)
+        return taken
+
+    def _reserve_many(self, cart_id, product, quantity, block, timeout):
+        """
+        Moves up to quantity units of the product from the producers' queues to the cart.
+
+        :returns a list with the producer_id of every unit that was added
+        """
+        if cart_id not in self.carts:
+            return []
+        deadline = None if timeout is None else time.monotonic() + timeout
+        in_stock = self._condition_of(self.product_conditions, self.product_locks, product)
+        with in_stock:
+            taken = self._take(product, quantity)
+            while block and len(taken) < quantity:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                # the product lock is released while waiting
+                if not in_stock.wait_for(lambda: self.available.get(product), remaining):
+                    break
+                taken += self._take(product, quantity - len(taken))
+        if taken:
+            with self._lock_of(self.cart_locks, cart_id):
+                # remember where they came from, to give them back to the same producers
+                self.carts[cart_id].setdefault(product, Counter()).update(taken)
+        if self.event_log is not None:
+            self.event_log.record(events.ADD_TO_CART, cart_id, product, len(taken))
+        if self.metrics is not None:
+            self.metrics.add(counters.ADDED, len(taken))
+            if len(taken) < quantity:
+                self.metrics.add(counters.ADD_FAILED)
+        return taken
+
+    def _take(self, product, quantity):
+        """
+        Takes up to quantity units of the product out of the producers' queues.
+        The caller must hold the product lock.
+
+        :returns a list with the producer_id of every unit taken
+        """
+        taken = []
+        holders = self.available.get(product)
+        # is there a producer with this product with qty != 0?
+        # if yes, decrement the qty then add it
         # in this way, the product will be unavailable to other consumers
-        for products in self.queue.values():
-            if product in products:
-                if products[product] > 0:
-                    shopping_list = self.carts[cart_id]
-                    shopping_list.append(product)
-                    self.carts[cart_id] = shopping_list
-                    products[product] -= 1  # make it unavailable
-                    logging.info("exit func with ret=True")
-                    return True
-        logging.info("exit func with ret=False")
-        return False
+        while holders and len(taken) < quantity:
+            producer_id = self.select(holders, self.inventory, self.queue_size_per_producer)
+            has_space = self._condition_of(self.producer_conditions, self.producer_locks,
+                                           producer_id)
+            with has_space:
+                count = min(self.inventory.quantity(producer_id, product),
+                            quantity - len(taken))
+                # make them unavailable
+                left = self.inventory.remove(producer_id, product, count)
+                # slots were freed, wake up the producer if it's waiting for one
+                has_space.notify()
+                # the producer ran out of it, drop it from the index
+                if left == 0:
+                    del holders[producer_id]
+            taken += [producer_id] * count
+        return taken
 
     def remove_from_cart(self, cart_id, product):
         """
@@ -233,19 +833,162 @@ class Marketplace:
         :param product: the product to remove from cart
         """
         logging.info("start func with cart_id=%s, product=%s", cart_id, product)
-        shopping_list = self.carts[cart_id]
-        shopping_list.remove(product)
-        self.carts[cart_id] = shopping_list
-        for products in self.queue.values():
-            if product in products:
-                products[product] += 1  # make it available
+        self._release_many(cart_id, product, 1)
+
+    def remove_many(self, cart_id, product, quantity):
+        """
+        Removes quantity units of a product from cart, taking the product lock
+        once for all of them instead of once per unit.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type product: Product
+        :param product: the product to remove from cart
+
+        :type quantity: Int
+        :param quantity: how many units to remove
+        """
+        logging.info("start func with cart_id=%s, product=%s, quantity=%s",
+                     cart_id, product, quantity)
+        self._release_many(cart_id, product, quantity)
+
+    def _release_many(self, cart_id, product, quantity):
+        """
+        Moves quantity units of the product from the cart back to the producers' queues.
+
+        :returns a list of type [ (producer_id, qty) ], how many units went back to
+        every producer
+        """
+        with self._lock_of(self.cart_locks, cart_id):
+            cart = self.carts[cart_id]
+            owners = cart.get(product, Counter())
+            if sum(owners.values()) < quantity:
+                raise ValueError(f"cart {cart_id} doesn't have {quantity} of {product}")
+            # list of type [ (producer_id, qty) ], the last reserved units go back first
+            returned = []
+            left = quantity
+            for producer_id in reversed(list(owners)):
+                if left == 0:
+                    break
+                count = min(owners[producer_id], left)
+                returned.append((producer_id, count))
+                left -= count
+                owners[producer_id] -= count
+                if owners[producer_id] == 0:
+                    del owners[producer_id]
+            # keep only the products that are in the cart
+            if not owners:
+                del cart[product]
+        if self.event_log is not None:
+            self.event_log.record(events.REMOVE_FROM_CART, cart_id, product, quantity)
+        if self.metrics is not None:
+            self.metrics.add(counters.REMOVED, quantity)
+        in_stock = self._condition_of(self.product_conditions, self.product_locks, product)
+        with in_stock:
+            # give every unit back to the producer it was taken from; it may go over
+            # its queue size if it published in the freed slot meanwhile, then it
+            # waits until its units are bought again
+            for producer_id, count in returned:
+                with self._lock_of(self.producer_locks, producer_id):
+                    # make them available
+                    self.inventory.add(producer_id, product, count)
+                self._holders_of(product)[producer_id] = None
+            in_stock.notify(quantity)
+        return returned
+
+    def apply_operations(self, cart_id, ops, block=True, timeout=None):
+        """
+        Applies a whole list of cart operations, with one call to add_many() or
+        remove_many() per operation.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type ops: List
+        :param ops: dictionaries of type: {"type": "add", "product": "id2", "quantity": 1}
+
+        :type block: Bool
+        :param block: if True, wait for the products of every add operation
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to block on one operation
+
+        :returns True or False. If the caller receives False, an add operation couldn't
+        be completed and the operations after it were not applied
+        """
+        for operation in ops:
+            if operation["type"] == "add":
+                if self.add_many(cart_id, operation["product"], operation["quantity"],
+                                 block, timeout) < operation["quantity"]:
+                    return False
+            elif operation["type"] == "remove":
+                self.remove_many(cart_id, operation["product"], operation["quantity"])
+        return True
 
     def place_order(self, cart_id):
         """
-        Return a list with all the products in the cart.
+        Return a list with all the products in the cart. The cart is finalized: it's
+        freed and its id can't be used anymore.
 
         :type cart_id: Int
         :param cart_id: id cart
         """
         logging.info("start func with cart_id=%s and returned", cart_id)
-        return self.carts[cart_id]
+        with self._lock_of(self.cart_locks, cart_id):
+            cart = self.carts.pop(cart_id)
+        # nobody else uses the cart, so its lock can go too
+        self.cart_locks.pop(cart_id, None)
+        order = [product for product, owners in cart.items()
+                 for _ in range(sum(owners.values()))]
+        if self.registry is not None:
+            # the products were ints until now
+            order = self.registry.materialize(order)
+        if self.orders.maxlen:
+            self.orders.append((cart_id, order))
+        if self.event_log is not None:
+            self.event_log.record(events.PLACE_ORDER, cart_id, None, len(order))
+        if self.metrics is not None:
+            self.metrics.add(counters.ORDERS)
+        return order
+
+    def reservations(self, cart_id):
+        """
+        Returns where the products from the cart were taken from, as a dictionary of
+        type { "product_id" : { "producer_id" : qty } }.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+        """
+        with self._lock_of(self.cart_locks, cart_id):
+            return {product: dict(owners) for product, owners in self.carts[cart_id].items()}
+
+    def recent_orders(self):
+        """
+        Returns the last placed orders, at most order_history of them, as a list of
+        (cart_id, list of products) from the oldest to the newest.
+        """
+        return list(self.orders)
+
+    def stats(self):
+        """
+        Returns how long every operation waited for the locks and held them, of type
+        { operation : { "wait" : summary, "hold" : summary } }, where a summary has the
+        count, the total in milliseconds and the p50, p99 and max in microseconds.
+        Empty without lock_stats.
+        """
+        if self.lock_stats is None:
+            return {}
+        return self.lock_stats.snapshot()
+
+    def shutdown(self):
+        """
+        Writes the lock stats, if any, and the queued log records, then closes the log
+        file and the event log.
+        """
+        if self.lock_stats is not None:
+            self.lock_stats.log()
+        if self.log_pipeline is not None:
+            self.log_pipeline.stop()
+        if self.event_log is not None:
+            self.event_log.close()
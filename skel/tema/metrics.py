@@ -0,0 +1,222 @@
+"""
+This module represents the live metrics of the Marketplace: counters of its
+operations and gauges of its inventory, served over HTTP in the Prometheus text
+format.
+
+Every thread increments its own cell of counters, so an increment is a plain
+integer addition that can't lose an update and never takes a lock. A scrape sums
+the cells and reads the gauges from the lock-free snapshots of the Marketplace,
+so it never slows the producers and the consumers down.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2022
+"""
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# the counters, as indexes in a cell
+PUBLISHED = 0
+REJECTED = 1
+ADDED = 2
+ADD_FAILED = 3
+REMOVED = 4
+ORDERS = 5
+
+# the name, the labels and the help of every counter in the text format, in the
+# order of the indexes; the counters with the same name share their help line
+COUNTERS = [("marketplace_publishes_total", 'result="accepted"',
+             "Publish calls, by result"),
+            ("marketplace_publishes_total", 'result="rejected"', None),
+            ("marketplace_added_units_total", "", "Units added to carts"),
+            ("marketplace_add_retries_total", "",
+             "Add calls that got fewer units than asked, the consumer retries them"),
+            ("marketplace_removed_units_total", "", "Units removed from carts"),
+            ("marketplace_orders_total", "", "Orders placed")]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Class that represents the unit testing for the Metrics.
+    """
+
+    def test_threads(self):
+        """
+        Test that the increments of every thread are summed up
+        """
+        metrics = Metrics()
+
+        def publish():
+            for _ in range(1000):
+                metrics.add(PUBLISHED)
+            metrics.add(ADDED, 5)
+
+        threads = [threading.Thread(target=publish) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        totals = metrics.snapshot()
+        self.assertEqual(totals[PUBLISHED], 4000)
+        self.assertEqual(totals[ADDED], 20)
+        self.assertEqual(totals[ORDERS], 0)
+
+    def test_label(self):
+        """
+        Test that the label values are escaped
+        """
+        self.assertEqual(label('Tea(name="Linden")'), '"Tea(name=\\"Linden\\")"')
+
+
+class Metrics:
+    """
+    Class that represents the counters of a Marketplace, with a cell per thread.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        # the cells of every thread that counted something, of type [ [ count ] ]
+        # indexed by the counters
+        self.cells = []
+        self.cells_lock = threading.Lock()
+
+    def add(self, counter, amount=1):
+        """
+        Adds amount to a counter, like PUBLISHED.
+        """
+        cell = getattr(self.local, "cell", None)
+        if cell is None:
+            cell = self.local.cell = [0] * len(COUNTERS)
+            with self.cells_lock:
+                self.cells.append(cell)
+        cell[counter] += amount
+
+    def snapshot(self):
+        """
+        Returns the list of the counters summed over all the threads.
+        """
+        with self.cells_lock:
+            cells = list(self.cells)
+        return [sum(counts) for counts in zip([0] * len(COUNTERS), *cells)]
+
+
+def label(value):
+    """
+    Returns a label value of the text format, quoted and escaped.
+    """
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'"{value}"'
+
+
+def _items(values):
+    """
+    Returns the (key, value) pairs of a snapshot of the Marketplace, a dictionary from
+    the DictInventory or an array indexed by id from the ArrayInventory.
+    """
+    if isinstance(values, dict):
+        return list(values.items())
+    return enumerate(values.tolist())
+
+
+def render(marketplace):
+    """
+    Returns the metrics of the marketplace in the Prometheus text format. The counters
+    are only there if the marketplace was built with metrics=True.
+
+    :type marketplace: Marketplace
+    :param marketplace: the marketplace that is scraped
+    """
+    lines = []
+    if marketplace.metrics is not None:
+        for (name, labels, description), value in zip(COUNTERS,
+                                                      marketplace.metrics.snapshot()):
+            if description is not None:
+                lines += [f"# HELP {name} {description}", f"# TYPE {name} counter"]
+            lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+    lines += ["# HELP marketplace_queue_size_per_producer The maximum size of a queue",
+              "# TYPE marketplace_queue_size_per_producer gauge",
+              f"marketplace_queue_size_per_producer {marketplace.queue_size_per_producer}",
+              "# HELP marketplace_producer_occupancy Products in the queue of a producer",
+              "# TYPE marketplace_producer_occupancy gauge"]
+    lines += [f"marketplace_producer_occupancy{{producer={label(producer_id)}}} {size}"
+              for producer_id, size in _items(marketplace.occupancy_by_producer())]
+    lines += ["# HELP marketplace_open_carts Carts whose order wasn't placed yet",
+              "# TYPE marketplace_open_carts gauge",
+              f"marketplace_open_carts {len(marketplace.carts)}",
+              "# HELP marketplace_product_stock Units of a product in all the queues",
+              "# TYPE marketplace_product_stock gauge"]
+    registry = marketplace.registry
+    for product, quantity in _items(marketplace.stock_by_product()):
+        if registry is not None:
+            product = registry.product(product)
+        lines.append(f"marketplace_product_stock{{product={label(product)}}} {quantity}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the metrics of the server's marketplace on GET /metrics.
+    """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Sends the metrics, or 404 for any other path.
+        """
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render(self.server.marketplace).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        # a scrape every few seconds would flood stderr
+        pass
+
+
+class MetricsServer:
+    """
+    Class that represents the HTTP endpoint of the metrics, served by a daemon thread.
+    """
+
+    def __init__(self, marketplace, port=0, host="127.0.0.1"):
+        """
+        Constructor, starts serving.
+
+        :type marketplace: Marketplace
+        :param marketplace: the marketplace that is scraped
+
+        :type port: Int
+        :param port: the port to listen on, 0 picks a free one
+
+        :type host: String
+        :param host: the address to listen on, only the local host by default
+        """
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.marketplace = marketplace
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics",
+                                       daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        """
+        Returns the URL of the metrics.
+        """
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    def stop(self):
+        """
+        Stops serving and closes the socket.
+        """
+        self.server.shutdown()
+        self.server.server_close()
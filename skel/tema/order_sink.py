@@ -0,0 +1,235 @@
+"""
+This module represents the order sinks: where the consumers send the products of
+their placed orders, a "{name} bought {item}" line for each of them.
+
+A consumer gives a sink the whole result of place_order() at once, after the
+Marketplace released its locks. The BufferedSink formats the order in one string,
+queues it and writes the queued orders with a single large write once they pass
+its buffer size, so the consumers don't wait for the output line by line. The
+batches are written in the order they were queued.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2022
+"""
+import io
+import sys
+import threading
+import unittest
+
+
+class TestOrderSink(unittest.TestCase):
+    """
+    Class that represents the unit testing for the order sinks.
+    """
+
+    def test_memory(self):
+        """
+        Test that the memory sink keeps the lines of every order
+        """
+        sink = MemorySink()
+        sink.order("cons1", ["id1", "id2"])
+        sink.order("cons2", [])
+        self.assertEqual(sink.lines, ["cons1 bought id1", "cons1 bought id2"])
+
+    def test_buffered(self):
+        """
+        Test that the buffered sink writes every line of every thread in few writes
+        """
+        stream = CountingStream()
+        sink = BufferedSink(stream, buffer_size=1024)
+
+        def place_orders(name):
+            for _ in range(100):
+                sink.order(name, ["id1", "id2", "id3"])
+
+        threads = [threading.Thread(target=place_orders, args=(f"cons{i}",))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        sink.close()
+        lines = stream.getvalue().decode().splitlines()
+        self.assertEqual(len(lines), 1200)
+        self.assertEqual(lines.count("cons3 bought id2"), 100)
+        # about 20 bytes per line
+        self.assertLess(stream.writes, 40)
+        self.assertEqual(stream.closed, False)
+
+    def test_batch_order(self):
+        """
+        Test that the orders of a consumer are written in the order it placed them
+        """
+        stream = CountingStream()
+        # a batch for almost every order, so the threads write at the same time
+        sink = BufferedSink(stream, buffer_size=64)
+
+        def place_orders(name):
+            for i in range(500):
+                sink.order(name, [i])
+
+        threads = [threading.Thread(target=place_orders, args=(f"cons{i}",))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        sink.close()
+        bought = {}
+        for line in stream.getvalue().decode().splitlines():
+            name, _, item = line.split()
+            bought.setdefault(name, []).append(int(item))
+        self.assertEqual(bought, {f"cons{i}": list(range(500)) for i in range(8)})
+
+
+class CountingStream(io.BytesIO):
+    """
+    BytesIO that counts the writes, for the tests.
+    """
+
+    writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        return io.BytesIO.write(self, data)
+
+
+class OrderSink:
+    """
+    Class that represents where the placed orders go.
+    """
+
+    def order(self, name, items):
+        """
+        Receives the products of an order placed by a consumer.
+
+        :type name: String
+        :param name: the name of the consumer
+
+        :type items: List
+        :param items: the products returned by place_order()
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Writes what is still buffered. The sink can't be used after it.
+        """
+
+
+class PrintSink(OrderSink):
+    """
+    Sink that prints every line as soon as it gets it, the default of the consumers
+    that aren't given a sink.
+    """
+
+    def order(self, name, items):
+        for item in items:
+            print(f"{name} bought {item}")
+
+
+class MemorySink(OrderSink):
+    """
+    Sink that keeps the lines in a list, for the tests.
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def order(self, name, items):
+        # list.extend() is atomic, the lines of an order stay together
+        self.lines.extend([f"{name} bought {item}" for item in items])
+
+
+class BufferedSink(OrderSink):
+    """
+    Sink that queues the orders and writes them in batches of at least buffer_size
+    bytes to a binary stream.
+    """
+
+    def __init__(self, stream, buffer_size=1 << 16, close_stream=False):
+        """
+        Constructor.
+
+        :type stream: BinaryIO
+        :param stream: where the lines are written, like sys.stdout.buffer
+
+        :type buffer_size: Int
+        :param buffer_size: how many bytes are queued before they are written
+
+        :type close_stream: Bool
+        :param close_stream: if True, close() closes the stream too
+        """
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.close_stream = close_stream
+        # the orders waiting to be written and their size, guarded by buffer_lock
+        self.buffer = []
+        self.size = 0
+        self.buffer_lock = threading.Lock()
+        # keeps the batches whole, a write isn't atomic for every stream; it's taken
+        # before buffer_lock is released, so the batches are written in order
+        self.write_lock = threading.Lock()
+
+    def order(self, name, items):
+        if not items:
+            return
+        data = "".join([f"{name} bought {item}\n" for item in items]).encode()
+        with self.buffer_lock:
+            self.buffer.append(data)
+            self.size += len(data)
+            if self.size < self.buffer_size:
+                return
+            batch = self._take_buffer()
+            self.write_lock.acquire()  # pylint: disable=consider-using-with
+        # the others keep queueing while this one writes
+        self._write(batch)
+
+    def _take_buffer(self):
+        """
+        Empties the buffer and returns its contents. The caller holds buffer_lock.
+        """
+        batch = b"".join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        return batch
+
+    def _write(self, batch, flush=False):
+        """
+        Writes a batch, then releases write_lock, which the caller took before
+        releasing buffer_lock.
+        """
+        try:
+            if batch:
+                self.stream.write(batch)
+            if flush:
+                self.stream.flush()
+        finally:
+            self.write_lock.release()
+
+    def flush(self):
+        """
+        Writes everything that is queued.
+        """
+        with self.buffer_lock:
+            batch = self._take_buffer()
+            self.write_lock.acquire()  # pylint: disable=consider-using-with
+        self._write(batch, flush=True)
+
+    def close(self):
+        self.flush()
+        if self.close_stream:
+            self.stream.close()
+
+
+def open_sink(path=None):
+    """
+    Returns a BufferedSink that writes to a file, or to the standard output if path
+    is None.
+    """
+    if path is None:
+        # what was printed before goes first
+        sys.stdout.flush()
+        return BufferedSink(sys.stdout.buffer)
+    return BufferedSink(open(path, "wb"), close_stream=True)
@@ -0,0 +1,422 @@
+"""
+This module represents the worker-pool engine: the producers and the consumers are
+tasks run by a bounded ThreadPoolExecutor instead of an OS thread each.
+
+A task only uses the non-blocking Marketplace calls and runs until it would have to
+wait. Then it hands its worker back: a consumer missing a product parks until a
+producer publishes it or another consumer removes it from a cart, a producer with a
+full queue parks until a consumer takes its units, and the publish cooldowns are
+timers of the Scheduler. So a few workers run any number of participants, and a waiting
+participant never holds a thread.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2022
+"""
+import heapq
+import itertools
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from tema.config import participants, PRODUCER
+from tema.order_sink import PrintSink, MemorySink
+
+# what a producer with a full queue waits for, with its id
+SLOT = "slot"
+
+
+class TestPool(unittest.TestCase):
+    """
+    Class that represents the unit testing for the worker-pool engine.
+    """
+
+    def test_scheduler(self):
+        """
+        Test that the delayed tasks run after the others
+        """
+        scheduler = Scheduler(1)
+        order = []
+        done = threading.Event()
+        scheduler.submit(lambda: (order.append("late"), done.set()), 0.05)
+        scheduler.submit(lambda: order.append("now"))
+        self.assertEqual(done.wait(5), True)
+        scheduler.stop()
+        self.assertEqual(order, ["now", "late"])
+
+    def test_single_worker(self):
+        """
+        Test that consumers waiting for products don't keep the only worker from
+        the producer
+        """
+        # imported here, the marketplace module doesn't know about the pool
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        market_config = {
+            "marketplace": {"queue_size_per_producer": 2},
+            "producers": [{"name": "prod1", "products": [("id1", 1, 0.001)],
+                           "republish_wait_time": 0.01}],
+            "consumers": [{"name": f"cons{i}", "retry_wait_time": 0.001,
+                           "carts": [[{"type": "add", "product": "id1", "quantity": 2},
+                                      {"type": "remove", "product": "id1", "quantity": 1}],
+                                     [{"type": "add", "product": "id1", "quantity": 1}]]}
+                          for i in range(20)]
+        }
+        sink = MemorySink()
+        run_pool(Marketplace(**market_config["marketplace"]), participants(market_config),
+                 workers=1, sink=sink)
+        self.assertEqual(len(sink.lines), 40)
+        self.assertEqual(sink.lines.count("cons7 bought id1"), 2)
+
+    def test_failed_task(self):
+        """
+        Test that the exception of a consumer stops the run instead of hanging it
+        """
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        market_config = {"producers": [],
+                         "consumers": [{"name": "cons1", "retry_wait_time": 0.001,
+                                        "carts": [[{"type": "add", "product": "id1"}]]}]}
+        with self.assertRaises(KeyError):
+            run_pool(Marketplace(2), participants(market_config), workers=2)
+
+
+class Scheduler:
+    """
+    Class that represents the executor of the tasks: a bounded ThreadPoolExecutor
+    and a timer thread that hands it the delayed tasks when they are due.
+    """
+
+    def __init__(self, workers, on_error=None):
+        """
+        Constructor, starts the timer thread.
+
+        :type workers: Int
+        :param workers: the maximum number of threads running tasks
+
+        :type on_error: Callable
+        :param on_error: gets the exception of a failed task, which the executor
+        would keep in a Future nobody looks at
+        """
+        self.on_error = on_error
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="worker")
+        # heap of type [ (due time, sequence number, task) ]
+        self.delayed = []
+        self.sequence = itertools.count()
+        self.changed = threading.Condition()
+        self.stopped = False
+        self.timer = threading.Thread(target=self._run_timer, name="scheduler", daemon=True)
+        self.timer.start()
+
+    def submit(self, task, delay=0):
+        """
+        Runs task() on a worker, after delay seconds. Ignored after stop().
+        """
+        if delay <= 0:
+            with self.changed:
+                if not self.stopped:
+                    self.executor.submit(self._run, task)
+            return
+        with self.changed:
+            if self.stopped:
+                return
+            heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.sequence), task))
+            # only the timer waits on it, it may have to wake up sooner now
+            self.changed.notify()
+
+    def _run(self, task):
+        """
+        Runs a task on a worker.
+        """
+        try:
+            task()
+        except Exception as error:  # pylint: disable=broad-except
+            if self.on_error is None:
+                raise
+            self.on_error(error)
+
+    def _run_timer(self):
+        """
+        Submits the delayed tasks when they are due, until stop().
+        """
+        with self.changed:
+            while not self.stopped:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    self.executor.submit(self._run, heapq.heappop(self.delayed)[2])
+                timeout = self.delayed[0][0] - now if self.delayed else None
+                self.changed.wait(timeout)
+
+    def stop(self):
+        """
+        Drops the delayed and the queued tasks and waits for the running ones.
+        """
+        with self.changed:
+            self.stopped = True
+            self.delayed.clear()
+            self.changed.notify()
+        self.timer.join()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class Waiters:
+    """
+    Class that represents the parked tasks, in the order they parked, by what they
+    wait for: a product, or a free slot in the queue of a producer, (SLOT, producer_id).
+
+    Every wake up of a key bumps its version. A task reads the version before it
+    tries the Marketplace and only parks if it didn't change, so a wake up that
+    comes between the failed call and park() is never lost.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        # dictionary of type { key : { task : None } }
+        self.parked = {}
+        # dictionary of type { key : how many times it was woken up }
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def version(self, key):
+        """
+        Returns the version of key, for park().
+        """
+        with self.lock:
+            return self.versions.get(key, 0)
+
+    def park(self, key, step, version):
+        """
+        Parks a task until key is woken up, step() runs it again then.
+
+        :returns False if key was woken up since version was read, then the task
+        must try again instead of waiting
+        """
+        with self.lock:
+            if self.versions.get(key, 0) != version:
+                return False
+            self.parked.setdefault(key, {})[step] = None
+        return True
+
+    def wake(self, key, count=1):
+        """
+        Resumes the first count tasks waiting for key.
+        """
+        woken = []
+        with self.lock:
+            self.versions[key] = self.versions.get(key, 0) + 1
+            steps = self.parked.get(key)
+            while steps and len(woken) < count:
+                step = next(iter(steps))
+                del steps[step]
+                woken.append(step)
+        for step in woken:
+            self.scheduler.submit(step)
+
+
+class ProducerTask:
+    """
+    Class that represents a producer as a task: every step publishes the units of a
+    cooldown.
+    """
+
+    def __init__(self, scheduler, marketplace, waiters, products, **_):
+        """
+        Constructor.
+
+        :type scheduler: Scheduler
+        :param scheduler: runs the steps
+
+        :type marketplace: Marketplace
+        :param marketplace: a reference to the marketplace
+
+        :type waiters: Waiters
+        :param waiters: the parked tasks, shared by all of them
+
+        :type products: List()
+        :param products: a list of products that the producer will produce
+
+        The republish_wait_time of the configuration isn't needed, a consumer wakes the
+        producer up as soon as it has a free slot.
+        """
+        self.scheduler = scheduler
+        self.marketplace = marketplace
+        self.waiters = waiters
+        self.products = products
+        self.id_producer = None
+        # the product being published and how many of its units are published
+        self.index = 0
+        self.published = 0
+
+    def step(self):
+        """
+        Publishes units until there is a cooldown to wait or the queue is full.
+        """
+        if self.id_producer is None:
+            self.id_producer = self.marketplace.register_producer()
+        slot = (SLOT, self.id_producer)
+        while True:
+            product_id, qty, publish_cooldown = self.products[self.index]
+            version = self.waiters.version(slot)
+            if not self.marketplace.publish(self.id_producer, product_id):
+                # the consumers wake us up when they take our units
+                if self.waiters.park(slot, self.step, version):
+                    return
+                continue
+            self.waiters.wake(product_id)
+            self.published += 1
+            if self.published == qty:
+                self.published = 0
+                self.index = (self.index + 1) % len(self.products)
+            if publish_cooldown > 0:
+                self.scheduler.submit(self.step, publish_cooldown)
+                return
+
+
+# a thread would keep the cart being filled in local variables, a task keeps it in
+# attributes between its steps
+class ConsumerTask:  # pylint: disable=too-many-instance-attributes
+    """
+    Class that represents a consumer as a task: every step fills a cart as far as the
+    stock allows.
+    """
+
+    def __init__(self, scheduler, marketplace, waiters, *, name, carts, sink, done, **_):
+        """
+        Constructor, the arguments after waiters are keyword-only.
+
+        :type scheduler: Scheduler
+        :param scheduler: runs the steps
+
+        :type marketplace: Marketplace
+        :param marketplace: a reference to the marketplace
+
+        :type waiters: Waiters
+        :param waiters: the parked tasks, shared by all of them
+
+        :type name: String
+        :param name: the name of the consumer, printed for every bought product
+
+        :type carts: List
+        :param carts: a list of add and remove operations, or any iterable of them
+
+        :type sink: OrderSink
+        :param sink: gets the placed orders
+
+        :type done: Callable
+        :param done: called once the last order is placed
+
+        The retry_wait_time of the configuration isn't needed, the producers and the
+        other consumers wake the consumer up as soon as its product is available.
+        """
+        self.scheduler = scheduler
+        self.marketplace = marketplace
+        self.waiters = waiters
+        self.name = name
+        self.carts = iter(carts)
+        self.sink = sink
+        self.done = done
+        # the cart being filled, its operations and how many units of which product
+        # the current add operation still needs
+        self.cart_id = None
+        self.operations = None
+        self.product = None
+        self.remaining = 0
+
+    def step(self):
+        """
+        Applies the operations of the current cart until a product is missing, or
+        places the order and schedules the next cart.
+        """
+        if self.cart_id is None:
+            ops = next(self.carts, None)
+            if ops is None:
+                self.done()
+                return
+            self.cart_id = self.marketplace.new_cart()
+            self.operations = iter(ops)
+        while True:
+            if self.remaining:
+                version = self.waiters.version(self.product)
+                taken = self.marketplace.reserve_many(self.cart_id, self.product,
+                                                      self.remaining)
+                # the units were taken from the producers' queues
+                for producer_id in set(taken):
+                    self.waiters.wake((SLOT, producer_id))
+                self.remaining -= len(taken)
+                if self.remaining:
+                    # hand the worker back instead of waiting on it, publish() and
+                    # remove_many() wake us up
+                    if self.waiters.park(self.product, self.step, version):
+                        return
+                    continue
+            operation = next(self.operations, None)
+            if operation is None:
+                break
+            if operation["type"] == "add":
+                self.product = operation["product"]
+                self.remaining = operation["quantity"]
+            elif operation["type"] == "remove":
+                self.marketplace.remove_many(self.cart_id, operation["product"],
+                                             operation["quantity"])
+                self.waiters.wake(operation["product"], operation["quantity"])
+
+        self.sink.order(self.name, self.marketplace.place_order(self.cart_id))
+        self.cart_id = None
+        # the next cart goes to the back of the queue, so the others get a turn
+        self.scheduler.submit(self.step)
+
+
+def run_pool(marketplace, market_participants, workers, sink=None):
+    """
+    Runs the producers and the consumers as tasks on a pool of workers and returns
+    when all the consumers are done.
+
+    :type marketplace: Marketplace
+    :param marketplace: the marketplace they use
+
+    :type market_participants: Iterable
+    :param market_participants: tuples (PRODUCER or CONSUMER, the arguments of the
+    participant), from tema.config.participants() or stream_config()
+
+    :type workers: Int
+    :param workers: how many threads run the tasks
+
+    :type sink: OrderSink
+    :param sink: gets the placed orders, they are printed by default
+    """
+    if sink is None:
+        sink = PrintSink()
+    # how many consumers are not done and the exceptions of the failed tasks,
+    # guarded by finished
+    running = [0]
+    errors = []
+    finished = threading.Condition()
+
+    def consumer_done():
+        with finished:
+            running[0] -= 1
+            finished.notify()
+
+    def task_failed(error):
+        with finished:
+            errors.append(error)
+            finished.notify()
+
+    scheduler = Scheduler(workers, on_error=task_failed)
+    waiters = Waiters(scheduler)
+
+    for kind, kwargs in market_participants:
+        if kind == PRODUCER:
+            task = ProducerTask(scheduler, marketplace, waiters, **kwargs)
+        else:
+            with finished:
+                running[0] += 1
+            task = ConsumerTask(scheduler, marketplace, waiters, sink=sink,
+                                done=consumer_done, **kwargs)
+        scheduler.submit(task.step)
+
+    with finished:
+        finished.wait_for(lambda: running[0] == 0 or errors)
+    # the producers are dropped with their pending steps
+    scheduler.stop()
+    if errors:
+        raise errors[0]
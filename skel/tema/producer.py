@@ -27,8 +27,8 @@ class Producer(Thread):
         @param marketplace: a reference to the marketplace
 
         @type republish_wait_time: Time
-        @param republish_wait_time: the number of seconds that a producer must
-        wait until the marketplace becomes available
+        @param republish_wait_time: the maximum number of seconds that a producer
+        waits for a free slot before asking the marketplace again
 
         @type kwargs:
         @param kwargs: other arguments that are passed to the Thread's __init__()
@@ -38,20 +38,17 @@ class Producer(Thread):
         self.products = products
         # marketplace reference
         self.marketplace = marketplace
-        # when reached queue limit, wait this time
+        # when reached queue limit, wait at most this time for a free slot
         self.republish_wait_time = republish_wait_time
 
     def run(self):
-        with self.marketplace.lock:
-            self.id_producer = self.marketplace.register_producer()
+        self.id_producer = self.marketplace.register_producer()
         while True:
             for item in self.products:
                 (product_id, qty, publish_cooldown) = item
                 for _ in range(qty):
-                    while True:
-                        is_ok = self.marketplace.publish(self.id_producer, product_id)
-                        sleep(publish_cooldown)
-                        if is_ok is False:
-                            sleep(self.republish_wait_time)
-                        else:
-                            break
+                    # wait for a free slot in the queue, add_to_cart() wakes us up
+                    while not self.marketplace.publish(self.id_producer, product_id, block=True,
+                                                       timeout=self.republish_wait_time):
+                        pass
+                    sleep(publish_cooldown)
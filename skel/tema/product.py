@@ -33,3 +33,53 @@ class Coffee(Product):
     """
     acidity: str
     roast_level: str
+
+
+class ProductRegistry:
+    """
+    Class that interns the products: every distinct product gets a dense integer id,
+    so the Marketplace can key its dictionaries by ints instead of hashing and
+    comparing every field of the dataclasses. It is filled before the producers and
+    the consumers start, afterwards it is only read.
+    """
+
+    def __init__(self):
+        # list of type [ product ], indexed by the product id
+        self.products = []
+        # dictionary of type { product : product_id }
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.products)
+
+    def intern(self, product):
+        """
+        Returns the id of the product, assigning the next one if it's new.
+
+        :type product: Product
+        :param product: the product to intern
+        """
+        product_id = self.ids.get(product)
+        if product_id is None:
+            product_id = self.ids[product] = len(self.products)
+            self.products.append(product)
+        return product_id
+
+    def product(self, product_id):
+        """
+        Returns the product with the given id.
+
+        :type product_id: Int
+        :param product_id: an id returned by intern()
+        """
+        return self.products[product_id]
+
+    def materialize(self, product_ids):
+        """
+        Returns a list with the product of every id.
+
+        :type product_ids: List
+        :param product_ids: ids returned by intern()
+        """
+        products = self.products
+        return [products[product_id] for product_id in product_ids]
@@ -0,0 +1,156 @@
+"""
+This module offers the strategies used by the Marketplace to choose the producer
+that a product is taken from, when more than one of them has it in stock.
+
+A strategy is a function (holders, inventory, queue_size) -> producer_id, where
+holders is the Holders of the product, the ordered set of the producers that have
+it in stock, inventory is the inventory of the Marketplace and queue_size its
+queue_size_per_producer. It's called with the product lock held, so it may also
+reorder holders.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2022
+"""
+import random
+import unittest
+
+from tema.inventory import DictInventory
+
+# names of the built-in strategies
+FIRST_FIT = "first-fit"
+ROUND_ROBIN = "round-robin"
+FULLEST_FIRST = "fullest-first"
+RANDOM = "random"
+
+
+class TestSelection(unittest.TestCase):
+    """
+    Class that represents the unit testing for the selection strategies.
+    """
+
+    def setUp(self):
+        """
+        Producer 0 has 1 product, producer 1 has 3 and producer 2 has 2
+        """
+        self.inventory = DictInventory()
+        self.holders = Holders()
+        for producer_id, quantity in enumerate([1, 3, 2]):
+            self.inventory.add_producer(producer_id)
+            self.inventory.add(producer_id, "id1", quantity)
+            self.holders[producer_id] = None
+
+    def test_holders(self):
+        """
+        Test that the holders keep their order and their list after removals
+        """
+        del self.holders[0]
+        self.holders[0] = None
+        del self.holders[1]
+        self.assertEqual(list(self.holders), [2, 0])
+        self.assertEqual(sorted(self.holders.ids), [0, 2])
+        self.holders.move_to_end(2)
+        self.assertEqual(list(self.holders), [0, 2])
+        self.assertEqual(sorted(self.holders.ids), [0, 2])
+
+    def test_first_fit(self):
+        """
+        Test that first-fit always chooses the oldest holder
+        """
+        self.assertEqual([first_fit(self.holders, self.inventory, 3) for _ in range(3)],
+                         [0, 0, 0])
+
+    def test_round_robin(self):
+        """
+        Test that round-robin takes turns
+        """
+        self.assertEqual([round_robin(self.holders, self.inventory, 3) for _ in range(4)],
+                         [0, 1, 2, 0])
+
+    def test_fullest_first(self):
+        """
+        Test that fullest-first relieves a full producer and otherwise drains the
+        oldest holder, like first-fit
+        """
+        self.assertEqual(fullest_first(self.holders, self.inventory, 3), 1)
+        self.assertEqual(fullest_first(self.holders, self.inventory, 4), 0)
+
+    def test_random(self):
+        """
+        Test that random chooses only holders
+        """
+        self.assertIn(random_choice(self.holders, self.inventory, 3), self.holders)
+
+
+class Holders(dict):
+    """
+    Ordered set of the producers that have a product in stock, in the order they got
+    it, of type { "producer_id" : its position in ids }. ids has the same producers
+    in any order, so random_choice() picks one in O(1). The Marketplace only changes
+    it with the item assignment and del, which keep both up to date.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.ids = []
+
+    def __setitem__(self, producer_id, _):
+        # it keeps its place if it's already a holder
+        if producer_id not in self:
+            dict.__setitem__(self, producer_id, len(self.ids))
+            self.ids.append(producer_id)
+
+    def __delitem__(self, producer_id):
+        position = dict.pop(self, producer_id)
+        # the last of the list takes the place of the removed one
+        last = self.ids.pop()
+        if last != producer_id:
+            self.ids[position] = last
+            dict.__setitem__(self, last, position)
+
+    def move_to_end(self, producer_id):
+        """
+        Moves a holder at the end of the order, its position in ids doesn't change.
+        """
+        dict.__setitem__(self, producer_id, dict.pop(self, producer_id))
+
+
+def first_fit(holders, inventory, queue_size):  # pylint: disable=unused-argument
+    """
+    Chooses the producer that has had the product in stock for the longest time.
+    """
+    return next(iter(holders))
+
+
+def round_robin(holders, inventory, queue_size):  # pylint: disable=unused-argument
+    """
+    Chooses the producers in turns: the chosen one is moved at the end of holders.
+    """
+    producer_id = next(iter(holders))
+    holders.move_to_end(producer_id)
+    return producer_id
+
+
+def fullest_first(holders, inventory, queue_size):
+    """
+    Chooses the oldest holder whose queue is full, so a producer blocked waiting for
+    a free slot can publish again. When none is full it falls back to first-fit:
+    always taking from the fullest queues kept every queue almost full of products
+    nobody wanted, while draining the oldest holder keeps free slots.
+    """
+    for producer_id in holders:
+        if inventory.occupancy_of(producer_id) >= queue_size:
+            return producer_id
+    return next(iter(holders))
+
+
+def random_choice(holders, inventory, queue_size):  # pylint: disable=unused-argument
+    """
+    Chooses a random producer, in O(1) from the list of the holders.
+    """
+    return random.choice(holders.ids)
+
+
+# dictionary of type { "name" : strategy }
+STRATEGIES = {FIRST_FIT: first_fit, ROUND_ROBIN: round_robin,
+              FULLEST_FIRST: fullest_first, RANDOM: random_choice}
@@ -0,0 +1,516 @@
+"""
+This module represents the sharded Marketplace: the products are partitioned across
+worker processes, every one of them running its own Marketplace, so the
+operations on different shards don't share a GIL.
+
+The queue size of a producer is enforced across the shards: shard 0 also counts
+the products every producer has in all of them, a publish claims a slot there
+before going to the shard of its product and a reservation frees it.
+
+The product of every operation decides its shard: the product id itself modulo
+num_shards for interned products, the CRC32 of its repr() otherwise, which unlike
+hash() is the same in every process. The callers talk to the shards over
+multiprocessing connections, one per thread and shard, and a shard serves every
+connection from its own thread, so a blocking call only blocks its caller.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2022
+"""
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import unittest
+import zlib
+from collections import Counter
+from multiprocessing.connection import Listener, Client
+
+from tema.marketplace import Marketplace
+from tema.log_writer import setup_logging, QUEUE_LOGGING
+
+# the methods of the ShardMarketplace a shard serves
+SHARD_METHODS = {"register_producer", "publish", "new_cart", "reserve_many",
+                 "return_many", "place_order", "shutdown", "claim_slot", "free_slots",
+                 "restore_slots", "slots_of", "publish_counted", "reserve_counted",
+                 "return_counted"}
+
+
+class TestShardedMarketplace(unittest.TestCase):
+    """
+    Class that represents the unit testing for the ShardedMarketplace.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        """
+        Starts 2 shards with queue_limit = 8 once, they are slow to start
+        """
+        cls.marketplace = ShardedMarketplace(8, num_shards=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.marketplace.close()
+
+    def test_cart_across_shards(self):
+        """
+        Test that a cart can hold products from every shard
+        """
+        producer_id = self.marketplace.register_producer()
+        for product in [10, 11, 11]:
+            self.assertEqual(self.marketplace.publish(producer_id, product), True)
+        cart_id = self.marketplace.new_cart()
+        self.assertEqual(self.marketplace.add_many(cart_id, 11, 2), 2)
+        self.assertEqual(self.marketplace.add_to_cart(cart_id, 10), True)
+        self.marketplace.remove_from_cart(cart_id, 11)
+        self.assertEqual(sorted(self.marketplace.place_order(cart_id)), [10, 11])
+
+    def test_queue_across_shards(self):
+        """
+        Test that the queue size of a producer counts its products from every shard
+        """
+        producer_id = self.marketplace.register_producer()
+        # 20 and 21 go to different shards
+        for product in [20, 21] * 4:
+            self.assertEqual(self.marketplace.publish(producer_id, product), True)
+        self.assertEqual(self.marketplace.publish(producer_id, 21), False)
+        self.assertEqual(self.marketplace.publish(producer_id, 20, block=True, timeout=0.01),
+                         False)
+        self.assertEqual(self.marketplace.queue_occupancy(producer_id), 8)
+        # a reservation frees a slot, giving the unit back takes it again
+        cart_id = self.marketplace.new_cart()
+        self.assertEqual(self.marketplace.add_to_cart(cart_id, 21), True)
+        self.assertEqual(self.marketplace.queue_occupancy(producer_id), 7)
+        self.marketplace.remove_from_cart(cart_id, 21)
+        self.assertEqual(self.marketplace.publish(producer_id, 20), False)
+        self.marketplace.add_many(cart_id, 20, 4)
+        self.assertEqual(self.marketplace.place_order(cart_id), [20] * 4)
+        self.assertEqual(self.marketplace.queue_occupancy(producer_id), 4)
+
+    def test_stable_shard(self):
+        """
+        Test that a product gets the same shard in another process
+        """
+        products = ["Tea(name='Linden', price=9, type='Herbal')", "id1", 13]
+        child = subprocess.run(
+            [sys.executable, "-c", "from tema.sharded import shard_of; "
+             f"print([shard_of(product, 8) for product in {products!r}])"],
+            capture_output=True, text=True, check=True, env={"PYTHONHASHSEED": "1"},
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        shards = [shard_of(product, 8) for product in products]
+        self.assertEqual(child.stdout.strip(), str(shards))
+        self.assertEqual(shards[2], 5)
+
+
+def shard_of(product, num_shards):
+    """
+    Returns the shard of a product. hash() of a str or a dataclass changes with
+    every process, so the copies of the ShardedMarketplace in the clients would
+    disagree on it; the CRC32 of repr() doesn't.
+    """
+    if isinstance(product, int):
+        return product % num_shards
+    return zlib.crc32(repr(product).encode()) % num_shards
+
+
+class ShardMarketplace(Marketplace):
+    """
+    Class that represents the Marketplace of a shard. The one of shard 0 also counts
+    the slots every producer uses in all the shards, so the queue size holds for
+    the whole ShardedMarketplace.
+    """
+
+    def __init__(self, queue_size_per_producer, **kwargs):
+        Marketplace.__init__(self, queue_size_per_producer, **kwargs)
+        # dictionary of type { "producer_id" : used slots }, guarded by slots_changed
+        self.slots = {}
+        self.slots_changed = threading.Condition()
+
+    def claim_slot(self, producer_id, block=False, timeout=None):
+        """
+        Takes a slot of the producer's queue for a unit it's about to publish.
+
+        :returns True, or False if the queue stays full
+        """
+        with self.slots_changed:
+            if block:
+                self.slots_changed.wait_for(
+                    lambda: self.slots.get(producer_id, 0) < self.queue_size_per_producer,
+                    timeout)
+            if self.slots.get(producer_id, 0) >= self.queue_size_per_producer:
+                return False
+            self.slots[producer_id] = self.slots.get(producer_id, 0) + 1
+        return True
+
+    def free_slots(self, counts):
+        """
+        Frees the slots of the units taken out of the producers' queues.
+
+        :type counts: List
+        :param counts: a list of type [ (producer_id, qty) ]
+        """
+        with self.slots_changed:
+            for producer_id, count in counts:
+                self.slots[producer_id] -= count
+            self.slots_changed.notify_all()
+
+    def restore_slots(self, counts):
+        """
+        Takes the slots of the units given back to the producers, over the queue size
+        if they published in the freed slots meanwhile, like Marketplace.remove_many().
+
+        :type counts: List
+        :param counts: a list of type [ (producer_id, qty) ]
+        """
+        with self.slots_changed:
+            for producer_id, count in counts:
+                self.slots[producer_id] = self.slots.get(producer_id, 0) + count
+
+    def slots_of(self, producer_id):
+        """
+        Returns how many slots the producer uses in all the shards.
+        """
+        with self.slots_changed:
+            return self.slots.get(producer_id, 0)
+
+    def return_many(self, cart_id, product, quantity):
+        """
+        Same as remove_many(), and returns how many units went back to every
+        producer, of type [ (producer_id, qty) ].
+        """
+        logging.info("start func with cart_id=%s, product=%s, quantity=%s",
+                     cart_id, product, quantity)
+        return self._release_many(cart_id, product, quantity)
+
+    # the products of shard 0 need a single round trip, the slots are counted here
+
+    def publish_counted(self, producer_id, product, block=False, timeout=None):
+        """
+        Same as claim_slot() followed by publish(), in shard 0.
+        """
+        if not self.claim_slot(producer_id, block, timeout):
+            return False
+        if self.publish(producer_id, product):
+            return True
+        self.free_slots([(producer_id, 1)])
+        return False
+
+    def reserve_counted(self, cart_id, product, quantity, block=False, timeout=None):
+        """
+        Same as reserve_many() followed by free_slots(), in shard 0.
+        """
+        taken = self.reserve_many(cart_id, product, quantity, block, timeout)
+        if taken:
+            self.free_slots(list(Counter(taken).items()))
+        return taken
+
+    def return_counted(self, cart_id, product, quantity):
+        """
+        Same as return_many() followed by restore_slots(), in shard 0.
+        """
+        self.restore_slots(self.return_many(cart_id, product, quantity))
+
+
+def _serve(connection, marketplace):
+    """
+    Runs the requests that come on connection, until the caller closes it.
+    Every request is a tuple (method, args) and every reply a tuple (is_ok, result),
+    where result is the exception raised by the method if is_ok is False.
+    """
+    with connection:
+        while True:
+            try:
+                method, args = connection.recv()
+            except EOFError:
+                return
+            if method not in SHARD_METHODS:
+                connection.send((False, AttributeError(f"shards don't serve {method}")))
+                continue
+            try:
+                result = getattr(marketplace, method)(*args)
+            except Exception as error:  # pylint: disable=broad-except
+                # the caller raises it
+                connection.send((False, error))
+            else:
+                connection.send((True, result))
+
+
+def run_shard(index, queue_size_per_producer, log_mode, kwargs, ready):
+    """
+    The main function of a shard process.
+
+    :type index: Int
+    :param index: the number of the shard, the shard logs to marketplace.shard<index>.log
+
+    :type queue_size_per_producer: Int
+    :param queue_size_per_producer: the maximum size of a producer's queue in this shard
+
+    :type log_mode: String
+    :param log_mode: the logging mode of the shard's Marketplace
+
+    :type kwargs: Dict
+    :param kwargs: passed to the shard's Marketplace
+
+    :type ready: Connection
+    :param ready: gets the address the shard listens on
+    """
+    # the shards can't share the log file, every one of them has its own
+    setup_logging(log_mode, filename=f"marketplace.shard{index}.log")
+    marketplace = ShardMarketplace(queue_size_per_producer, log_mode=log_mode, **kwargs)
+    # only processes started by the same parent have the authkey
+    with Listener(family="AF_UNIX", authkey=multiprocessing.current_process().authkey) \
+            as listener:
+        ready.send(listener.address)
+        ready.close()
+        while True:
+            connection = listener.accept()
+            threading.Thread(target=_serve, args=(connection, marketplace),
+                             daemon=True).start()
+
+
+class ShardedMarketplace:
+    """
+    Class that represents a Marketplace split in shard processes. It has the
+    methods of the Marketplace used by the producers and the consumers.
+
+    The queue size of a producer holds for all the shards together: shard 0 counts
+    the slots, so a publish costs two round trips to the shards, and so does an
+    add that takes units, unless the product belongs to shard 0. The producer ids
+    are given by shard 0, so they are unique for every copy of the object, which
+    can be sent to other processes. A cart has a part in every shard it used,
+    place_order() collects all of them.
+    """
+    # dictionary of type:
+    # { "cart_id" : { "shard" : shard_cart_id } }, the cart ids in every shard
+    carts: dict
+
+    def __init__(self, queue_size_per_producer, num_shards=2, registry=None,
+                 log_mode=QUEUE_LOGGING, **kwargs):
+        """
+        Constructor, starts the shard processes.
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum size of a producer's queue, across
+        all the shards
+
+        :type num_shards: Int
+        :param num_shards: how many shard processes to start
+
+        :type registry: ProductRegistry
+        :param registry: if given, the products are passed as their integer ids from it
+        and place_order() turns them back into products
+
+        :type log_mode: String
+        :param log_mode: the logging mode of the shards
+
+        :type kwargs: Dict
+        :param kwargs: passed to the Marketplace of every shard, like locking or
+        selection; they are sent to the shards, so they must be picklable
+        """
+        self.num_shards = num_shards
+        self.registry = registry
+        # set by close()
+        self.closed = False
+        # the shards are started fresh, a forked copy of a process running threads
+        # could inherit locks held by them
+        context = multiprocessing.get_context("spawn")
+        self.processes = []
+        self.addresses = []
+        for index in range(num_shards):
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=run_shard, name=f"shard{index}", daemon=True,
+                                      args=(index, queue_size_per_producer, log_mode,
+                                            kwargs, sender))
+            process.start()
+            self.processes.append(process)
+            self.addresses.append(receiver.recv())
+            receiver.close()
+        self._init_local()
+
+    def _init_local(self):
+        """
+        Sets up the state that is not shared with other copies of the object.
+        """
+        # the connections of every thread, of type [ Connection ] indexed by shard
+        self.local = threading.local()
+        self.carts = {}
+        self.carts_lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"num_shards": self.num_shards, "registry": self.registry,
+                "addresses": self.addresses, "processes": [], "closed": False}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_local()
+
+    def _shard_of(self, product):
+        """
+        Returns the shard that owns the product.
+        """
+        return shard_of(product, self.num_shards)
+
+    def _call(self, shard, method, *args):
+        """
+        Runs a Marketplace method in a shard and returns its result.
+        """
+        connections = getattr(self.local, "connections", None)
+        if connections is None:
+            connections = self.local.connections = [None] * self.num_shards
+        connection = connections[shard]
+        if connection is None:
+            connection = connections[shard] = Client(
+                self.addresses[shard], authkey=multiprocessing.current_process().authkey)
+        try:
+            connection.send((method, args))
+            is_ok, result = connection.recv()
+        except (EOFError, OSError):
+            if not self.closed:
+                raise
+            # the shards were stopped under a thread that is still running, like the
+            # daemon producers; it waits here until the process exits
+            threading.Event().wait()
+        if not is_ok:
+            raise result
+        return result
+
+    def _cart_in(self, cart_id, shard):
+        """
+        Returns the id of the cart's part from the shard, creating it if needed.
+        """
+        parts = self.carts[cart_id]
+        if shard not in parts:
+            # only the consumer owning the cart uses it, but other carts may be created
+            shard_cart_id = self._call(shard, "new_cart")
+            with self.carts_lock:
+                parts[shard] = shard_cart_id
+        return parts[shard]
+
+    def register_producer(self):
+        """
+        Returns an id for the producer that calls this.
+        """
+        return self._call(0, "register_producer")
+
+    def publish(self, producer_id, product, block=False, timeout=None):
+        """
+        Adds the product provided by the producer to the shard that owns the product,
+        once shard 0 gave it a slot. The arguments and the result are the ones from
+        Marketplace.publish().
+        """
+        shard = self._shard_of(product)
+        if shard == 0:
+            return self._call(0, "publish_counted", producer_id, product, block, timeout)
+        if not self._call(0, "claim_slot", producer_id, block, timeout):
+            return False
+        # the shard's own limit can't be reached, it holds fewer units than shard 0
+        # counts, but the slot is not kept if it ever refuses it
+        if self._call(shard, "publish", producer_id, product):
+            return True
+        self._call(0, "free_slots", [(producer_id, 1)])
+        return False
+
+    def queue_occupancy(self, producer_id):
+        """
+        Returns how many products the producer currently has in all the shards.
+        """
+        return self._call(0, "slots_of", producer_id)
+
+    def new_cart(self):
+        """
+        Creates a new cart for the consumer, with a part in shard 0, so the cart
+        ids are unique for every copy of the object.
+
+        :returns an int representing the cart_id
+        """
+        cart_id = self._call(0, "new_cart")
+        with self.carts_lock:
+            self.carts[cart_id] = {0: cart_id}
+        return cart_id
+
+    def add_to_cart(self, cart_id, product, block=False, timeout=None):
+        """
+        Adds a product to the given cart, see Marketplace.add_to_cart().
+        """
+        return self.add_many(cart_id, product, 1, block, timeout) == 1
+
+    def add_many(self, cart_id, product, quantity, block=False, timeout=None):
+        """
+        Adds up to quantity units of a product to the given cart, see
+        Marketplace.add_many().
+        """
+        return len(self.reserve_many(cart_id, product, quantity, block, timeout))
+
+    def reserve_many(self, cart_id, product, quantity, block=False, timeout=None):
+        """
+        Adds up to quantity units of a product to the given cart, see
+        Marketplace.reserve_many().
+        """
+        shard = self._shard_of(product)
+        if shard == 0:
+            return self._call(0, "reserve_counted", self._cart_in(cart_id, 0), product,
+                              quantity, block, timeout)
+        taken = self._call(shard, "reserve_many", self._cart_in(cart_id, shard), product,
+                           quantity, block, timeout)
+        if taken:
+            self._call(0, "free_slots", list(Counter(taken).items()))
+        return taken
+
+    def remove_from_cart(self, cart_id, product):
+        """
+        Removes a product from cart, see Marketplace.remove_from_cart().
+        """
+        self.remove_many(cart_id, product, 1)
+
+    def remove_many(self, cart_id, product, quantity):
+        """
+        Removes quantity units of a product from cart, see Marketplace.remove_many().
+        """
+        shard = self._shard_of(product)
+        if shard == 0:
+            self._call(0, "return_counted", self._cart_in(cart_id, 0), product, quantity)
+            return
+        returned = self._call(shard, "return_many", self._cart_in(cart_id, shard), product,
+                              quantity)
+        self._call(0, "restore_slots", returned)
+
+    def place_order(self, cart_id):
+        """
+        Return a list with all the products in the cart, from all of its parts.
+        The cart is freed like in Marketplace.place_order().
+
+        :type cart_id: Int
+        :param cart_id: id cart
+        """
+        with self.carts_lock:
+            parts = self.carts.pop(cart_id)
+        order = []
+        for shard, shard_cart_id in parts.items():
+            order += self._call(shard, "place_order", shard_cart_id)
+        if self.registry is not None:
+            # the products were ints until now
+            order = self.registry.materialize(order)
+        return order
+
+    def shutdown(self):
+        """
+        Writes the queued log records of every shard and closes their log files.
+        The shards keep serving requests until close().
+        """
+        for shard in range(self.num_shards):
+            self._call(shard, "shutdown")
+
+    def close(self):
+        """
+        Shuts down and stops the shard processes started by this object.
+        """
+        if not self.processes:
+            return
+        self.shutdown()
+        self.closed = True
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        self.processes = []
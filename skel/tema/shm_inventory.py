@@ -0,0 +1,485 @@
+"""
+This module represents an inventory kept in a multiprocessing.shared_memory block,
+so producers and consumers running in different processes can publish and reserve
+products without sending messages to a broker process.
+
+The block is an array of int64:
+    [ next producer id | occupancy of every producer | stock of every product |
+      quantity of every product for every producer, product-major |
+      number of holders of every product | the holders of every product |
+      the position of every producer in the holders of every product ]
+where the holders of a product are the ids of the producers that have it in their
+queue, so a take looks only at them instead of every producer. The block is
+guarded by two sets of cross-process locks, one striped by product and one by
+producer; the quantities and the holders of a product only change under its lock.
+Like in the Marketplace, the product lock is taken before the producer lock. The
+products must be interned, the ids 0 .. num_products - 1.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2022
+"""
+import multiprocessing
+import time
+import unittest
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+# how many locks guard the products and how many guard the producers
+NUM_LOCKS = 64
+# how long a blocking call sleeps between two tries, the processes can't share
+# a condition variable cheaply
+POLL_INTERVAL = 0.001
+
+# where every section of the block starts, in int64 values
+Layout = namedtuple("Layout", ["occupancy", "stock", "quantities", "holder_counts",
+                               "holders", "positions"])
+
+
+class TestSharedInventory(unittest.TestCase):
+    """
+    Class that represents the unit testing for the SharedInventory and SharedMarketplace.
+    """
+
+    def setUp(self):
+        """
+        Initialize the inventory with 4 producers, 3 products and queue_limit = 8
+        """
+        self.inventory = SharedInventory(4, 3, 8)
+
+    def tearDown(self):
+        self.inventory.close()
+        self.inventory.unlink()
+
+    def test_publish_take(self):
+        """
+        Test the queue limit, the take and the give back
+        """
+        producer_id = self.inventory.register_producer()
+        for _ in range(8):
+            self.assertEqual(self.inventory.publish(producer_id, 1), True)
+        self.assertEqual(self.inventory.publish(producer_id, 2), False)
+        self.assertEqual(self.inventory.take(1, 3), [producer_id] * 3)
+        self.assertEqual(self.inventory.take(2, 1), [])
+        self.inventory.give_back(producer_id, 1, 2)
+        self.assertEqual(list(self.inventory.stock_by_product()), [0, 7, 0])
+        self.assertEqual(self.inventory.occupancy_of(producer_id), 7)
+
+    def test_holders(self):
+        """
+        Test that a take only finds the producers holding the product, even after
+        they ran out of it and published it again
+        """
+        producers = [self.inventory.register_producer() for _ in range(4)]
+        for producer_id in [producers[3], producers[1], producers[3]]:
+            self.inventory.publish(producer_id, 0)
+        self.assertEqual(self.inventory.holders_of(0), [producers[3], producers[1]])
+        self.assertEqual(self.inventory.take(0, 2), [producers[3]] * 2)
+        self.assertEqual(self.inventory.holders_of(0), [producers[1]])
+        self.inventory.give_back(producers[3], 0, 1)
+        self.inventory.publish(producers[0], 0)
+        self.assertEqual(sorted(self.inventory.take(0, 4)), [producers[0], producers[1],
+                                                            producers[3]])
+        self.assertEqual(self.inventory.holders_of(0), [])
+
+    def test_marketplace(self):
+        """
+        Test a cart of the SharedMarketplace
+        """
+        marketplace = SharedMarketplace(self.inventory)
+        producer_id = marketplace.register_producer()
+        marketplace.publish(producer_id, 0)
+        marketplace.publish(producer_id, 2)
+        cart_id = marketplace.new_cart()
+        self.assertEqual(marketplace.add_many(cart_id, 0, 2, block=True, timeout=0.01), 1)
+        self.assertEqual(marketplace.add_to_cart(cart_id, 2), True)
+        marketplace.remove_from_cart(cart_id, 0)
+        self.assertEqual(marketplace.place_order(cart_id), [2])
+        self.assertEqual(self.inventory.quantity(producer_id, 0), 1)
+
+    def test_processes(self):
+        """
+        Test that processes publishing and taking at once don't lose any update
+        """
+        with ProcessPoolExecutor(2, self.inventory.context, initializer=attach,
+                                 initargs=(self.inventory,)) as executor:
+            taken = sum(executor.map(_publish_and_take, [0, 1, 0, 1]))
+        # a take may find nothing while another process holds the last unit
+        stock = sum(self.inventory.stock_by_product())
+        self.assertEqual(taken + stock, 400)
+        self.assertEqual(sum(self.inventory.occupancy_by_producer()), stock)
+
+
+# the SharedInventory of a worker process, set by attach()
+_ATTACHED = []
+
+
+def attach(inventory):
+    """
+    Initializer of the worker processes, keeps the inventory they got.
+
+    :type inventory: SharedInventory
+    :param inventory: the inventory, it can only be sent to a process when it starts
+    """
+    _ATTACHED[:] = [inventory]
+
+
+def attached():
+    """
+    Returns the inventory the worker process got from attach().
+    """
+    return _ATTACHED[0]
+
+
+def _publish_and_take(producer_id):
+    """
+    Publishes and takes back 100 units of product 1, used by the unit tests.
+    """
+    inventory = attached()
+    taken = 0
+    for _ in range(100):
+        inventory.publish(producer_id, 1)
+        taken += len(inventory.take(1, 1))
+    return taken
+
+
+class SharedInventory:
+    """
+    Class that keeps the queue of every producer in shared memory. Unlike the
+    inventories from tema/inventory.py, it synchronizes itself and implements the
+    publish and the reservation, since the Marketplace's index and locks can't be
+    shared between processes.
+    """
+
+    def __init__(self, max_producers, num_products, queue_size_per_producer,
+                 num_locks=NUM_LOCKS, context=None):
+        """
+        Constructor, allocates the shared memory block. The object can be sent to
+        other processes when they are started, like a multiprocessing.Lock.
+
+        :type max_producers: Int
+        :param max_producers: how many producers can register
+
+        :type num_products: Int
+        :param num_products: how many products there are
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type num_locks: Int
+        :param num_locks: how many locks guard the products, and how many the producers
+
+        :type context: BaseContext
+        :param context: the multiprocessing context of the locks, the processes using
+        the inventory must be started with it; the spawn context by default
+        """
+        self.max_producers = max_producers
+        self.num_products = num_products
+        self.queue_size_per_producer = queue_size_per_producer
+        size = 8 * (1 + max_producers + 2 * num_products + 3 * max_producers * num_products)
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.context = context or multiprocessing.get_context("spawn")
+        self.ids_lock = self.context.Lock()
+        self.product_locks = [self.context.Lock() for _ in range(num_locks)]
+        self.producer_locks = [self.context.Lock() for _ in range(num_locks)]
+        self._map()
+
+    def _map(self):
+        """
+        Builds the int64 views of the shared memory block.
+        """
+        self.values = self.shm.buf.cast("q")
+        occupancy = 1
+        stock = occupancy + self.max_producers
+        quantities = stock + self.num_products
+        holder_counts = quantities + self.max_producers * self.num_products
+        holders = holder_counts + self.num_products
+        positions = holders + self.max_producers * self.num_products
+        self.layout = Layout(occupancy, stock, quantities, holder_counts, holders, positions)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        # the other process attaches to the block by its name
+        state["shm"] = self.shm.name
+        del state["values"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=state["shm"])
+        self._map()
+
+    def _product_lock(self, product):
+        return self.product_locks[product % len(self.product_locks)]
+
+    def _producer_lock(self, producer_id):
+        return self.producer_locks[producer_id % len(self.producer_locks)]
+
+    def _quantity_index(self, producer_id, product):
+        return self.layout.quantities + product * self.max_producers + producer_id
+
+    def _add_holder(self, product, producer_id):
+        """
+        Appends the producer to the holders of the product. The caller holds the
+        product lock.
+        """
+        values = self.values
+        count = values[self.layout.holder_counts + product]
+        values[self.layout.holders + product * self.max_producers + count] = producer_id
+        values[self.layout.positions + product * self.max_producers + producer_id] = count
+        values[self.layout.holder_counts + product] = count + 1
+
+    def _drop_holder(self, product, producer_id):
+        """
+        Removes the producer from the holders of the product, the last holder takes
+        its place. The caller holds the product lock.
+        """
+        values = self.values
+        holders = self.layout.holders + product * self.max_producers
+        positions = self.layout.positions + product * self.max_producers
+        count = values[self.layout.holder_counts + product] - 1
+        position = values[positions + producer_id]
+        last = values[holders + count]
+        values[holders + position] = last
+        values[positions + last] = position
+        values[self.layout.holder_counts + product] = count
+
+    def register_producer(self):
+        """
+        Returns an id for the producer that calls this, unique across processes.
+        """
+        with self.ids_lock:
+            producer_id = self.values[0]
+            if producer_id == self.max_producers:
+                raise ValueError(f"there is room for only {self.max_producers} producers")
+            self.values[0] = producer_id + 1
+        return producer_id
+
+    def publish(self, producer_id, product):
+        """
+        Adds a unit of the product to the producer's queue, if it's not full.
+
+        :returns True or False
+        """
+        values = self.values
+        occupancy = self.layout.occupancy + producer_id
+        index = self._quantity_index(producer_id, product)
+        with self._product_lock(product):
+            with self._producer_lock(producer_id):
+                if values[occupancy] >= self.queue_size_per_producer:
+                    return False
+                values[occupancy] += 1
+                values[index] += 1
+            values[self.layout.stock + product] += 1
+            if values[index] == 1:
+                self._add_holder(product, producer_id)
+        return True
+
+    def take(self, product, quantity):
+        """
+        Takes up to quantity units of the product out of the queues of its holders,
+        the first holder first. It only looks at the producers that have the product.
+
+        :returns a list with the producer_id of every unit taken
+        """
+        values = self.values
+        holder_count = self.layout.holder_counts + product
+        first_holder = self.layout.holders + product * self.max_producers
+        taken = []
+        with self._product_lock(product):
+            while len(taken) < quantity and values[holder_count] > 0:
+                producer_id = values[first_holder]
+                # the quantities of the product only change under its lock
+                index = self._quantity_index(producer_id, product)
+                count = min(values[index], quantity - len(taken))
+                with self._producer_lock(producer_id):
+                    values[index] -= count
+                    values[self.layout.occupancy + producer_id] -= count
+                values[self.layout.stock + product] -= count
+                taken += [producer_id] * count
+                if values[index] == 0:
+                    self._drop_holder(product, producer_id)
+        return taken
+
+    def give_back(self, producer_id, product, quantity):
+        """
+        Puts back quantity units of the product taken from the producer's queue.
+        """
+        values = self.values
+        index = self._quantity_index(producer_id, product)
+        with self._product_lock(product):
+            with self._producer_lock(producer_id):
+                values[self.layout.occupancy + producer_id] += quantity
+                values[index] += quantity
+            values[self.layout.stock + product] += quantity
+            # the producer didn't have the product anymore
+            if 0 < quantity == values[index]:
+                self._add_holder(product, producer_id)
+
+    def quantity(self, producer_id, product):
+        """
+        Returns how many units of the product the producer has in its queue.
+        """
+        return self.values[self._quantity_index(producer_id, product)]
+
+    def occupancy_of(self, producer_id):
+        """
+        Returns how many products the producer has in its queue.
+        """
+        return self.values[self.layout.occupancy + producer_id]
+
+    def holders_of(self, product):
+        """
+        Returns the ids of the producers that have the product in their queue, a
+        snapshot taken without locks.
+        """
+        start = self.layout.holders + product * self.max_producers
+        return self.values[start:start + self.values[self.layout.holder_counts + product]].tolist()
+
+    def stock_by_product(self):
+        """
+        Returns a list with the quantity of every product, a snapshot taken without locks.
+        """
+        stock = self.layout.stock
+        return self.values[stock:stock + self.num_products].tolist()
+
+    def occupancy_by_producer(self):
+        """
+        Returns a list with the occupancy of every producer, a snapshot taken without locks.
+        """
+        occupancy = self.layout.occupancy
+        return self.values[occupancy:occupancy + self.max_producers].tolist()
+
+    def full_producers(self):
+        """
+        Returns the ids of the producers whose queue is full, a snapshot taken without locks.
+        """
+        return [producer_id for producer_id, size in enumerate(self.occupancy_by_producer())
+                if size >= self.queue_size_per_producer]
+
+    def close(self):
+        """
+        Detaches this process from the shared memory block.
+        """
+        self.values.release()
+        self.shm.close()
+
+    def unlink(self):
+        """
+        Frees the shared memory block, called once by the process that created it.
+        """
+        self.shm.unlink()
+
+
+class SharedMarketplace:
+    """
+    Class that represents a Marketplace on top of a SharedInventory, with the
+    methods used by the producers and the consumers. Every process has its own
+    SharedMarketplace: the carts belong to the process that created them, the
+    products are shared. Blocking calls poll the inventory every POLL_INTERVAL.
+    It doesn't synchronize its carts, so it's used by a single thread.
+    """
+    # nested dictionary of type:
+    # { "cart_id" : { "product_id" : Counter } }, where Counter = { "producer_id" : qty }
+    carts: dict
+
+    def __init__(self, inventory):
+        """
+        Constructor
+
+        :type inventory: SharedInventory
+        :param inventory: the inventory shared with the other processes
+        """
+        self.inventory = inventory
+        self.carts = {}
+        self.cart_ids = 0
+
+    def register_producer(self):
+        """
+        Returns an id for the producer that calls this.
+        """
+        return self.inventory.register_producer()
+
+    def publish(self, producer_id, product, block=False, timeout=None):
+        """
+        Adds the product provided by the producer to the marketplace, see
+        Marketplace.publish().
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.inventory.publish(producer_id, product):
+            if not block or (deadline is not None and time.monotonic() >= deadline):
+                return False
+            time.sleep(POLL_INTERVAL)
+        return True
+
+    def new_cart(self):
+        """
+        Creates a new cart for the consumer, the ids are unique in this process.
+
+        :returns an int representing the cart_id
+        """
+        cart_id = self.cart_ids
+        self.carts[cart_id] = {}
+        self.cart_ids += 1
+        return cart_id
+
+    def add_to_cart(self, cart_id, product, block=False, timeout=None):
+        """
+        Adds a product to the given cart, see Marketplace.add_to_cart().
+        """
+        return self.add_many(cart_id, product, 1, block, timeout) == 1
+
+    def add_many(self, cart_id, product, quantity, block=False, timeout=None):
+        """
+        Adds up to quantity units of a product to the given cart, see
+        Marketplace.add_many().
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        taken = self.inventory.take(product, quantity)
+        while block and len(taken) < quantity:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            time.sleep(POLL_INTERVAL)
+            taken += self.inventory.take(product, quantity - len(taken))
+        if taken:
+            self.carts[cart_id].setdefault(product, Counter()).update(taken)
+        return len(taken)
+
+    def remove_from_cart(self, cart_id, product):
+        """
+        Removes a product from cart, see Marketplace.remove_from_cart().
+        """
+        self.remove_many(cart_id, product, 1)
+
+    def remove_many(self, cart_id, product, quantity):
+        """
+        Removes quantity units of a product from cart, giving every unit back to the
+        producer it was taken from, see Marketplace.remove_many().
+        """
+        owners = self.carts[cart_id].get(product, Counter())
+        if sum(owners.values()) < quantity:
+            raise ValueError(f"cart {cart_id} doesn't have {quantity} of {product}")
+        # the last reserved units go back first
+        for producer_id in reversed(list(owners)):
+            if quantity == 0:
+                break
+            count = min(owners[producer_id], quantity)
+            self.inventory.give_back(producer_id, product, count)
+            quantity -= count
+            owners[producer_id] -= count
+            if owners[producer_id] == 0:
+                del owners[producer_id]
+        if not owners:
+            self.carts[cart_id].pop(product, None)
+
+    def place_order(self, cart_id):
+        """
+        Return a list with all the products in the cart and free the cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+        """
+        cart = self.carts.pop(cart_id)
+        return [product for product, owners in cart.items()
+                for _ in range(sum(owners.values()))]
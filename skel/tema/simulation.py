@@ -0,0 +1,220 @@
+"""
+This module represents the simulation mode: the asyncio engine runs on an event loop
+with a virtual clock, so the sleeps and the timeouts of the producers and the
+consumers take no real time.
+
+Whenever every task waits, the loop moves its clock straight to the next timer
+instead of sleeping until it. The tasks see the same order of events as on a real
+clock without the scheduling noise, so the purchases are the same ones and hours of
+marketplace traffic are simulated in seconds.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2022
+"""
+import asyncio
+import selectors
+import time
+import unittest
+
+from tema.async_marketplace import run_market
+from tema.order_sink import MemorySink
+
+
+class TestSimulation(unittest.TestCase):
+    """
+    Class that represents the unit testing for the simulation mode.
+    """
+
+    @staticmethod
+    def market_config(quantities):
+        """
+        Returns a market where a producer needs 10 seconds for every product and
+        consumer i buys quantities[i] units
+        """
+        return {
+            "marketplace": {"queue_size_per_producer": 2},
+            "producers": [{"name": "prod1", "products": [("id1", 1, 10)],
+                           "republish_wait_time": 0.5}],
+            "consumers": [{"name": f"cons{i}", "retry_wait_time": 0.5,
+                           "carts": [[{"type": "add", "product": "id1", "quantity": quantity}]]}
+                          for i, quantity in enumerate(quantities)]
+        }
+
+    def test_sleep(self):
+        """
+        Test that the clock moves to the end of a sleep without waiting for it
+        """
+        loop = VirtualEventLoop()
+        start = time.monotonic()
+        loop.run_until_complete(asyncio.sleep(3600))
+        loop.close()
+        self.assertEqual(loop.clock.now(), 3600)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_simulate(self):
+        """
+        Test that the consumers buy everything, in simulated time
+        """
+        sink = MemorySink()
+        elapsed, is_done = simulate(self.market_config([3, 3]), sink=sink)
+        self.assertEqual(is_done, True)
+        self.assertEqual(sorted(sink.lines), ["cons0 bought id1"] * 3 + ["cons1 bought id1"] * 3)
+        # the 6th product is published after 5 cooldowns, then the producer finishes
+        # its last cooldown
+        self.assertEqual(elapsed, 60)
+
+    def test_until(self):
+        """
+        Test that the consumers are stopped at the end of the simulated time
+        """
+        sink = MemorySink()
+        elapsed, is_done = simulate(self.market_config([1, 5]), sink=sink, until=35)
+        self.assertEqual(is_done, False)
+        # the second consumer gets its 5th product after 50 seconds
+        self.assertEqual(sink.lines, ["cons0 bought id1"])
+        self.assertLess(elapsed, 50)
+
+    def test_stalled(self):
+        """
+        Test that a simulation where nothing can ever happen stops with an error
+        """
+        market_config = self.market_config([1])
+        market_config["producers"] = []
+        with self.assertRaises(SimulationStalled):
+            simulate(market_config)
+
+
+class SimulationStalled(RuntimeError):
+    """
+    Raised when every task of a simulation waits for something that can't happen.
+    """
+
+
+class VirtualClock:
+    """
+    Class that represents a clock that only moves when it is told to.
+    """
+
+    def __init__(self, start=0.0):
+        """
+        Constructor.
+
+        :type start: Float
+        :param start: the time the clock starts at, in seconds
+        """
+        self.start = start
+        # the event loop uses the seconds since the start: asyncio compares the times
+        # with a nanosecond resolution, which a float as big as time.time() doesn't have
+        self.elapsed = 0.0
+
+    def now(self):
+        """
+        Returns the current time of the clock.
+        """
+        return self.start + self.elapsed
+
+    def advance(self, seconds):
+        """
+        Moves the clock forward.
+        """
+        self.elapsed += seconds
+
+
+class VirtualSelector(selectors.BaseSelector):
+    """
+    Selector of the VirtualEventLoop: it never waits, it moves the clock by the
+    timeout instead when nothing is ready. The file descriptors are kept by a
+    DefaultSelector it wraps.
+    """
+
+    def __init__(self, clock):
+        """
+        Constructor.
+
+        :type clock: VirtualClock
+        :param clock: the clock of the event loop
+        """
+        self.clock = clock
+        self.selector = selectors.DefaultSelector()
+
+    def register(self, fileobj, events, data=None):
+        return self.selector.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self.selector.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self.selector.modify(fileobj, events, data)
+
+    def get_map(self):
+        return self.selector.get_map()
+
+    def close(self):
+        self.selector.close()
+
+    def select(self, timeout=None):
+        # the loop still has its own file descriptors, like the one that wakes it up
+        # from other threads, they are checked without waiting
+        events = self.selector.select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            raise SimulationStalled("every task waits and no timer is scheduled")
+        self.clock.advance(timeout)
+        return []
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    """
+    Event loop that runs on a VirtualClock: asyncio.sleep(), the timeouts and
+    loop.time() all use the virtual time.
+    """
+
+    def __init__(self, clock=None):
+        """
+        Constructor.
+
+        :type clock: VirtualClock
+        :param clock: the clock of the loop, a new one starting at 0 by default
+        """
+        self.clock = VirtualClock() if clock is None else clock
+        asyncio.SelectorEventLoop.__init__(self, VirtualSelector(self.clock))
+
+    def time(self):
+        """
+        Returns the virtual time, which the timers of the loop are scheduled on.
+        """
+        return self.clock.elapsed
+
+
+def simulate(market_config, sink=None, event_log=None, clock=None, until=None):
+    """
+    Runs the market configuration with the asyncio engine on a VirtualEventLoop.
+
+    :type market_config: Dict
+    :param market_config: the configuration returned by tema.config.load_config()
+
+    :type sink: OrderSink
+    :param sink: gets the placed orders, they are printed by default
+
+    :type event_log: EventLog
+    :param event_log: if given, every operation is also recorded in this binary log;
+    give it clock.now as its clock to record the simulated times
+
+    :type clock: VirtualClock
+    :param clock: the clock of the simulation, a new one starting at 0 by default
+
+    :type until: Float
+    :param until: if given, the consumers are stopped after this many simulated seconds,
+    the producers still finish their last cooldown
+
+    :returns a tuple (the simulated seconds, True if all the consumers are done)
+    """
+    loop = VirtualEventLoop(clock)
+    start = loop.time()
+    try:
+        is_done = loop.run_until_complete(run_market(market_config, sink, event_log, until))
+    finally:
+        loop.close()
+    return loop.time() - start, is_done
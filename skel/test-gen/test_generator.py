@@ -204,7 +204,7 @@ def generate_producers(count, products, basic_test):
         producer = {"name": PRODUCER_NAME_PREFIX + str(i + 1)}
 
         num_products_per_producer = random.randint(1, len(products.keys()))
-        products_to_produce = random.sample(products.keys(), num_products_per_producer)
+        products_to_produce = random.sample(list(products.keys()), num_products_per_producer)
 
         products_list = [[x, random.randint(1, max_quantity), round(random.uniform(0.05, 0.4), 2)]
                          for x in products_to_produce]
@@ -260,7 +260,7 @@ def generate_consumers(count, products, min_cart, max_cart,
             if len(products) < num_operations:
                 num_operations = len(products)
 
-            product_ids = random.sample(products.keys(), num_operations)
+            product_ids = random.sample(list(products.keys()), num_operations)
             operations = [{"type": ADD_TO_CART_OP, "product": x,
                            "quantity": random.randint(1, max_quantity)} for x in product_ids]
 
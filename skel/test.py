@@ -6,13 +6,159 @@ Assignment 1
 March 2020
 """
 
+import argparse
+import asyncio
 import sys
-from json import loads
+import time
 
 from tema.producer import Producer
 from tema.consumer import Consumer
 from tema.marketplace import Marketplace
-from tema.product import Product, Coffee, Tea
+from tema.sharded import ShardedMarketplace
+from tema.async_marketplace import run_market
+from tema.simulation import simulate, VirtualClock
+from tema.config import load_config, stream_config, participants, PRODUCER
+from tema.log_writer import setup_logging, SYNC_LOGGING, QUEUE_LOGGING
+from tema.event_log import EventLog
+from tema.inventory import ArrayInventory
+from tema.selection import STRATEGIES, FIRST_FIT
+from tema.metrics import MetricsServer
+from tema.pool import run_pool
+from tema.order_sink import open_sink
+from tema.lock_stats import SAMPLE_EVERY
+
+# ways of running the producers and the consumers
+THREADS_ENGINE = "threads"
+ASYNCIO_ENGINE = "asyncio"
+POOL_ENGINE = "pool"
+
+# where the marketplace keeps the quantities
+DICT_INVENTORY = "dict"
+ARRAY_INVENTORY = "array"
+
+
+def parse_args():
+    """
+    Parses the command line arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename", help="the market configuration (tests/*.in), or its "
+                                         "JSON-lines version (*.jsonl), streamed")
+    parser.add_argument("--engine", choices=[THREADS_ENGINE, ASYNCIO_ENGINE, POOL_ENGINE],
+                        default=THREADS_ENGINE,
+                        help="run every producer and consumer as a thread, as an "
+                             "asyncio task or as a task of a pool of --workers threads")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="with the pool engine, how many threads run the "
+                             "producers and the consumers")
+    parser.add_argument("-o", "--output", metavar="PATH",
+                        help="write the purchases to this file instead of the standard "
+                             "output")
+    parser.add_argument("--logging", choices=[SYNC_LOGGING, QUEUE_LOGGING],
+                        default=QUEUE_LOGGING,
+                        help="write marketplace.log from the calling threads or from "
+                             "a background thread")
+    parser.add_argument("--events", metavar="PATH",
+                        help="also record every operation in a binary event log, "
+                             "decoded with: python3 -m tema.event_log PATH")
+    parser.add_argument("--inventory", choices=[DICT_INVENTORY, ARRAY_INVENTORY],
+                        default=DICT_INVENTORY,
+                        help="keep the quantities in dictionaries or in a NumPy matrix")
+    parser.add_argument("--selection", choices=list(STRATEGIES), default=FIRST_FIT,
+                        help="how a consumer chooses between the producers of a product")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="split the products between this many marketplace "
+                             "processes, 0 keeps a single marketplace in this process")
+    parser.add_argument("--simulate", action="store_true",
+                        help="run the asyncio engine on a virtual clock, the sleeps "
+                             "and the timeouts take no real time")
+    parser.add_argument("--until", type=float, metavar="SECONDS",
+                        help="with --simulate, stop after this many simulated seconds")
+    parser.add_argument("--lock-stats", action="store_true",
+                        help="measure how long every operation waits for the locks and "
+                             "holds them, the log gets the histograms at the end")
+    parser.add_argument("--lock-sample", type=int, default=SAMPLE_EVERY, metavar="N",
+                        help="with --lock-stats, time one acquire in N, 1 times all of "
+                             f"them (default {SAMPLE_EVERY})")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                        help="count the operations and serve them with the inventory "
+                             "gauges on http://127.0.0.1:PORT/metrics during the run")
+    args = parser.parse_args()
+    if args.simulate and (args.engine != THREADS_ENGINE or args.shards):
+        parser.error("--simulate always uses the asyncio engine, without --shards")
+    if args.until is not None and not args.simulate:
+        parser.error("--until only works with --simulate")
+    if args.metrics_port is not None and (args.engine == ASYNCIO_ENGINE or args.shards
+                                          or args.simulate):
+        parser.error("--metrics-port only works with the threads and the pool engines, "
+                     "without --shards")
+    if args.shards and (args.engine == ASYNCIO_ENGINE or args.events
+                        or args.inventory != DICT_INVENTORY):
+        parser.error("--shards only works with the threads and the pool engines, without "
+                     "--events and with the dict inventory")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    return args
+
+
+def run_threads(market_config, event_log=None, num_shards=0, metrics_port=None,
+                stream=None, workers=0, sink=None):
+    """
+        Build the Producer, Consumer and Marketplace models and run them as threads,
+        or as tasks of a pool of workers threads if workers isn't 0. The consumers
+        send their orders to sink.
+        The participants come from stream, as returned by stream_config(), or from
+        the lists of market_config; every one of them starts as soon as it's built.
+    """
+    # build the marketplace
+    metrics_server = None
+    if num_shards:
+        marketplace = ShardedMarketplace(**market_config['marketplace'],
+                                         num_shards=num_shards)
+    else:
+        marketplace = Marketplace(**market_config['marketplace'], event_log=event_log,
+                                  metrics=metrics_port is not None)
+        if metrics_port is not None:
+            metrics_server = MetricsServer(marketplace, metrics_port)
+            print(f"serving the metrics on {metrics_server.url}", file=sys.stderr)
+
+    # build and start the producers and the consumers
+    market_participants = participants(market_config) if stream is None else stream
+    if workers:
+        run_pool(marketplace, market_participants, workers, sink)
+    else:
+        consumers = []
+        for kind, kwargs in market_participants:
+            if kind == PRODUCER:
+                Producer(**kwargs, marketplace=marketplace, daemon=True).start()
+            else:
+                consumer = Consumer(**kwargs, marketplace=marketplace, sink=sink)
+                consumer.start()
+                consumers.append(consumer)
+
+        for consumer in consumers:
+            consumer.join()
+
+    if num_shards:
+        # the shards write their logs and stop, the producers are killed at exit
+        marketplace.close()
+    else:
+        marketplace.shutdown()
+    if metrics_server is not None:
+        metrics_server.stop()
+
+
+def apply_options(marketplace_config, args):
+    """
+        Add the Marketplace options from the command line to the keyword arguments
+        of the Marketplace from the market configuration.
+    """
+    marketplace_config['selection'] = args.selection
+    marketplace_config['lock_stats'] = args.lock_stats and args.lock_sample
+    if args.shards:
+        marketplace_config['log_mode'] = args.logging
+    if args.inventory == ARRAY_INVENTORY:
+        marketplace_config['inventory'] = ArrayInventory(len(marketplace_config['registry']))
 
 
 def main():
@@ -20,53 +166,49 @@ def main():
         Convert the market_configuration input file into specific models:
         Producer, Consumer, Marketplace
     """
+    args = parse_args()
+    stream = None
+    if args.filename.endswith(".jsonl"):
+        market_config, stream = stream_config(args.filename)
+    else:
+        market_config = load_config(args.filename)
+    apply_options(market_config['marketplace'], args)
+    log_pipeline = setup_logging(args.logging)
+    # a simulation starts now, so its events get believable timestamps
+    clock = VirtualClock(time.time()) if args.simulate else None
+    event_log = None
+    if args.events:
+        event_log = EventLog(args.events, market_config['marketplace'].get('registry'),
+                             clock=time.time if clock is None else clock.now)
+
+    if stream is not None and (args.simulate or args.engine == ASYNCIO_ENGINE):
+        # the asyncio engine takes lists, the carts are still read lazily
+        market_config['producers'] = []
+        market_config['consumers'] = []
+        for kind, kwargs in stream:
+            market_config['producers' if kind == PRODUCER else 'consumers'].append(kwargs)
+
+    # the purchases are written in large batches, not a line at a time
+    sink = open_sink(args.output)
     try:
-        filename = sys.argv[1]
-    except IndexError:
-        print("no input file specified")
-        raise SystemExit
-
-    with open(filename) as input_file:
-        market_config = loads(input_file.read())
-
-    # turn product definitions into actual products
-    products = {}
-
-    for k, products_dict in market_config['products'].items():
-        params = {k: products_dict[k] for k in products_dict.keys() if k != 'product_type'}
-        products[k] = globals()[products_dict['product_type']](**params)
-    del market_config['products']
-
-    # turn product ids into products in producers
-    for producer in market_config['producers']:
-        producer['products'] = [(products[i], quantity, sleep_time)
-                                for i, quantity, sleep_time
-                                in producer['products']]
-
-    # turn product ids into products in consumer order lists and expected carts
-    for consumer in market_config['consumers']:
-        for cart in consumer['carts']:
-            for operation in cart:
-                operation['product'] = products[operation['product']]
-
-    # build the marketplace
-    marketplace = Marketplace(**market_config['marketplace'])
-
-    # build and start the producers
-    producers = [Producer(**p_market_config, marketplace=marketplace, daemon=True)
-                 for p_market_config in market_config['producers']]
-    for producer in producers:
-        producer.start()
-
-    # build and start the consumers
-    consumers = [Consumer(**c_market_config, marketplace=marketplace)
-                 for c_market_config in market_config['consumers']]
-
-    for consumer in consumers:
-        consumer.start()
-
-    for consumer in consumers:
-        consumer.join()
+        if args.simulate:
+            elapsed, is_done = simulate(market_config, sink, event_log, clock, args.until)
+            print(f"simulated {elapsed:.2f} seconds"
+                  + ("" if is_done else ", the consumers were stopped"), file=sys.stderr)
+        elif args.engine == ASYNCIO_ENGINE:
+            asyncio.run(run_market(market_config, sink, event_log))
+        else:
+            run_threads(market_config, event_log, args.shards, args.metrics_port, stream,
+                        args.workers if args.engine == POOL_ENGINE else 0, sink)
+    finally:
+        # the orders placed before a consumer failed are written too
+        sink.close()
+        if 'carts_file' in market_config:
+            market_config['carts_file'].close()
+        # write what is still queued before the producers are killed
+        log_pipeline.stop()
+        if event_log is not None:
+            event_log.close()
 
 
 if __name__ == '__main__':